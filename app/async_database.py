@@ -0,0 +1,111 @@
+"""
+Асинхронный интерфейс к базе данных.
+
+Все функции модуля ``app.database`` синхронные (sqlite3), поэтому их прямой
+вызов из ``async def`` обработчиков aiogram и эндпоинтов FastAPI блокирует
+цикл событий на время каждого запроса. Этот модуль повторяет публичные
+функции ``app.database`` в виде корутин, которые выполняются в отдельном
+пуле потоков:
+
+    from app import async_database as db
+
+    positions = await db.get_positions(group_id)
+
+Размер пула задаётся переменной окружения DB_EXECUTOR_WORKERS. Каждый
+поток пула держит собственное долгоживущее соединение (см.
+``database.db_connection``), так что число открытых соединений ограничено
+размером пула.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, TypeVar
+
+from app import database, settlement
+
+T = TypeVar("T")
+
+DB_EXECUTOR_WORKERS: int = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполняет синхронную функцию работы с базой в пуле потоков БД."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _offload(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Оборачивает синхронную функцию ``app.database`` в корутину."""
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        return await run_sync(func, *args, **kwargs)
+
+    return wrapper
+
+
+# Пользователи
+save_user = _offload(database.save_user)
+get_user = _offload(database.get_user)
+get_users = _offload(database.get_users)
+resolve_login = _offload(database.resolve_login)
+resolve_logins = _offload(database.resolve_logins)
+get_all_users = _offload(database.get_all_users)
+
+# Позиции чека
+add_positions = _offload(database.add_positions)
+get_positions = _offload(database.get_positions)
+set_positions = _offload(database.set_positions)
+load_positions = _offload(database.load_positions)
+persist_positions = _offload(database.persist_positions)
+
+# Распознанные чеки
+get_receipt_scan_by_file = _offload(database.get_receipt_scan_by_file)
+find_receipt_scan = _offload(database.find_receipt_scan)
+save_receipt_scan = _offload(database.save_receipt_scan)
+link_receipt_file = _offload(database.link_receipt_file)
+
+# Кэш ответов LLM
+get_llm_response = _offload(database.get_llm_response)
+put_llm_response = _offload(database.put_llm_response)
+prune_llm_responses = _offload(database.prune_llm_responses)
+
+# Версии состояния групп
+get_group_version = _offload(database.get_group_version)
+get_positions_if_changed = _offload(database.get_positions_if_changed)
+get_group_versions = _offload(database.get_group_versions)
+load_group_claims = _offload(database.load_group_claims)
+
+# Выбор пользователей
+save_selected_positions = _offload(database.save_selected_positions)
+apply_selection_changes = _offload(database.apply_selection_changes)
+get_selected_positions = _offload(database.get_selected_positions)
+get_group_selected_positions = _offload(database.get_group_selected_positions)
+get_unassigned_positions = _offload(database.get_unassigned_positions)
+
+# Платежи, долги и расчёт
+add_payment = _offload(database.add_payment)
+add_payments = _offload(database.add_payments)
+get_payments = _offload(database.get_payments)
+save_debts = _offload(database.save_debts)
+load_group_snapshot = _offload(database.load_group_snapshot)
+load_group_balances = _offload(database.load_group_balances)
+get_position_allocations = _offload(database.get_position_allocations)
+rebuild_group_balances = _offload(database.rebuild_group_balances)
+projection_groups = _offload(database.projection_groups)
+calculate_group_balance = _offload(database.calculate_group_balance)
+settle_group = _offload(settlement.settle_group)
+check_group_balances = _offload(settlement.check_group_balances)
+archive_group_data = _offload(database.archive_group_data)
+clear_group_data = _offload(database.clear_group_data)
+finalize_group = _offload(database.finalize_group)
+
+# Служебное
+ping = _offload(database.ping)
+
+# Отладочный просмотр таблиц
+fetch_table = _offload(database.fetch_table)
@@ -10,10 +10,14 @@ from config import settings
 from handlers import auth as auth_handlers
 from handlers import receipts as receipt_handlers
 from middlewares.auth_required import AuthRequiredMiddleware
+from middlewares.chat_lock import ChatLockMiddleware
+from services import image_prep
 
 
 async def main() -> None:
     print("Bot_token:", settings.bot_token)
+    # Пул подготовки изображений форкается до появления других потоков
+    await image_prep.start()
     
     bot = Bot(
         token=settings.bot_token,
@@ -33,9 +37,15 @@ async def main() -> None:
 
     # Подмешиваем middleware только к группам, где id < 0
     dp.message.middleware(AuthRequiredMiddleware())
+    # Изменяющие обработчики (флаг chat_lock) одного чата — строго по очереди
+    dp.message.middleware(ChatLockMiddleware())
+    dp.callback_query.middleware(ChatLockMiddleware())
     print("Bot started.")
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        image_prep.shutdown()
 
 if __name__ == "__main__":
     try:
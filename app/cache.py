@@ -0,0 +1,149 @@
+"""
+Внутрипроцессные кэши.
+
+``TTLCache`` — LRU‑кэш ограниченного размера, записи которого устаревают
+через заданное время. На нём построен кэш проверки регистрации, который
+использует ``AuthRequiredMiddleware``: вместо запроса к базе на каждое
+сообщение в группе результат ``get_user`` запоминается
+
+* для зарегистрированных — надолго (AUTH_CACHE_TTL секунд);
+* для незарегистрированных — ненадолго (AUTH_CACHE_NEGATIVE_TTL секунд),
+  чтобы пользователь, только что прошедший /start, не ждал истечения
+  кэша, даже если инвалидация почему‑то не сработала.
+
+Также кэшируется поиск Telegram‑id по username
+(``database.resolve_logins``): найденные логины — на LOGIN_CACHE_TTL
+секунд, ненайденные — на AUTH_CACHE_NEGATIVE_TTL.
+
+``database.save_user`` сбрасывает запись пользователя через
+``invalidate_user``. Кэши живут в памяти одного процесса.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from app import metrics
+
+AUTH_CACHE_TTL: float = float(os.getenv("AUTH_CACHE_TTL", "600"))
+AUTH_CACHE_NEGATIVE_TTL: float = float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", "30"))
+AUTH_CACHE_MAXSIZE: int = int(os.getenv("AUTH_CACHE_MAXSIZE", "10000"))
+LOGIN_CACHE_TTL: float = float(os.getenv("LOGIN_CACHE_TTL", "600"))
+
+# Отличает «нет в кэше» от закэшированного None
+MISSING: Any = object()
+
+
+class TTLCache:
+    """LRU‑кэш на OrderedDict: не больше maxsize записей, каждая живёт ttl секунд."""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """Возвращает значение или MISSING, если записи нет или она устарела."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISSING
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Кэш проверки регистрации: user_id → True (зарегистрирован) / False (нет)
+registered_users = TTLCache(AUTH_CACHE_MAXSIZE, AUTH_CACHE_TTL)
+unregistered_users = TTLCache(AUTH_CACHE_MAXSIZE, AUTH_CACHE_NEGATIVE_TTL)
+
+
+def get_registration(user_id: int) -> bool | None:
+    """
+    Возвращает закэшированный статус регистрации: True/False или None, если
+    его нужно запросить из базы. Обновляет метрики auth_cache.*.
+    """
+    if registered_users.get(user_id) is not MISSING:
+        metrics.incr("auth_cache.hit")
+        return True
+    if unregistered_users.get(user_id) is not MISSING:
+        metrics.incr("auth_cache.negative_hit")
+        return False
+    metrics.incr("auth_cache.miss")
+    return None
+
+
+def remember_registration(user_id: int, registered: bool) -> None:
+    """Запоминает результат проверки регистрации из базы."""
+    if registered:
+        registered_users.set(user_id, True)
+        unregistered_users.invalidate(user_id)
+    else:
+        unregistered_users.set(user_id, False)
+    metrics.set_gauge("auth_cache.size", len(registered_users))
+    metrics.set_gauge("auth_cache.negative_size", len(unregistered_users))
+
+
+# Кэш поиска по username: нормализованный логин → telegram_id (None — не найден)
+login_ids = TTLCache(AUTH_CACHE_MAXSIZE, LOGIN_CACHE_TTL)
+unknown_logins = TTLCache(AUTH_CACHE_MAXSIZE, AUTH_CACHE_NEGATIVE_TTL)
+
+
+def get_login_id(login_cf: str) -> Any:
+    """
+    Возвращает закэшированный telegram_id для нормализованного логина, None
+    для логина, которого нет в базе, или MISSING, если нужно спросить базу.
+    Обновляет метрики login_cache.*.
+    """
+    user_id = login_ids.get(login_cf)
+    if user_id is not MISSING:
+        metrics.incr("login_cache.hit")
+        return user_id
+    if unknown_logins.get(login_cf) is not MISSING:
+        metrics.incr("login_cache.negative_hit")
+        return None
+    metrics.incr("login_cache.miss")
+    return MISSING
+
+
+def remember_login_id(login_cf: str, user_id: int | None) -> None:
+    """Запоминает результат поиска логина в базе."""
+    if user_id is None:
+        unknown_logins.set(login_cf, None)
+    else:
+        login_ids.set(login_cf, user_id)
+
+
+def invalidate_user(user_id: int) -> None:
+    """Сбрасывает закэшированные данные пользователя (после изменения в accounts)."""
+    registered_users.invalidate(user_id)
+    unregistered_users.invalidate(user_id)
+    # Логин мог смениться или появиться у нового пользователя; старую запись
+    # по id не найти, а регистрации редки — сбрасываем кэш логинов целиком.
+    login_ids.clear()
+    unknown_logins.clear()
+    metrics.incr("auth_cache.invalidations")
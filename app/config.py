@@ -12,6 +12,8 @@ class Settings:
     admin_id: int
     allowed_banks: tuple[str, ...]
     bot_username: str  # имя бота (например, myawesome_bot) для формирования deep‑links
+    metrics_token: str  # токен для /metrics мини‑приложения; пусто — эндпоинт выключен
+    init_data_max_age: int  # сколько секунд initData мини‑приложения считается действительным
 
     @classmethod
     def from_env(cls) -> "Settings":
@@ -23,6 +25,8 @@ class Settings:
             admin_id=int(os.getenv("ADMIN_ID", "0")),
             allowed_banks=tuple(os.getenv("ALLOWED_BANKS", "T-Bank,Sber,Alfa").split(",")),
             bot_username=os.getenv("BOT_USERNAME", ""),
+            metrics_token=os.getenv("METRICS_TOKEN", ""),
+            init_data_max_age=int(os.getenv("WEBAPP_INIT_DATA_MAX_AGE", "86400")),
         )
 
 settings = Settings.from_env()
@@ -24,7 +24,9 @@
     - group_id TEXT (идентификатор чата/группы)
     - name     TEXT
     - quantity REAL
-    - price    REAL
+    - price    INTEGER (цена в копейках)
+    - receipt_scan_id INTEGER (ссылка на receipt_scans.id, если позиция из
+      распознанного чека)
 
 * selected_positions: хранит выбор пользователей. Поля:
     - id          INTEGER PRIMARY KEY AUTOINCREMENT
@@ -32,19 +34,47 @@
     - user_tg_id  TEXT (Telegram‑идентификатор пользователя)
     - position_id INTEGER (ссылка на positions.id, может быть NULL)
     - quantity    REAL
-    - price       REAL
+    - price       INTEGER (цена в копейках)
+  Для позиции из чека у участника не больше одной строки: (group_id,
+  user_tg_id, position_id) уникален и служит ключом upsert.
+
+* llm_cache: ответы текстовых запросов к LLM с временем жизни (см.
+  get_llm_response).
+
+* receipt_scans / receipt_files: распознанные чеки (с ключом фискального
+  QR‑кода, если он прочитан) и file_unique_id их фотографий в Telegram —
+  повторно присланный чек не распознаётся заново (см. find_receipt_scan).
+
+Денежные поля (price, amount) во всех таблицах хранятся целым числом
+копеек. Функции этого модуля, работающие с позициями и платежами,
+по‑прежнему принимают и возвращают суммы в рублях и переводят их на
+границе (см. ``app.money``); расчёт по группе ведётся в копейках.
 
 По умолчанию база данных создаётся в файле `database.db` рядом с этим модулем.
-Функция init_db() вызывается при импорте, чтобы гарантировать наличие
-необходимых таблиц.
+Функция init_db() вызывается при импорте и применяет недостающие миграции
+из списка MIGRATIONS; номер версии схемы хранится в PRAGMA user_version.
+Данные между перезапусками сохраняются (кроме режима DB_RESET_ON_START).
+
+Соединения с базой долгоживущие: каждый поток получает одно соединение,
+которое открывается один раз (режим WAL, synchronous=NORMAL, busy_timeout,
+mmap_size и cache_size из выбранного профиля) и выдаётся через контекстный
+менеджер db_connection().
 """
 
-from collections import defaultdict
-from typing import Any
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator
 import os
 import json
 import sqlite3
 import logging
+import threading
+import time
+
+from app import metrics
+from app.cache import MISSING, get_login_id, invalidate_user, remember_login_id
+from app.money import from_kopecks, to_kopecks
+
 logging.basicConfig(
     level=logging.DEBUG,  # максимум информации
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -60,35 +90,214 @@ logger = logging.getLogger("webapp")
 # рассчитывается относительно расположения текущего файла (app/database.py)
 # и поднимается на один уровень вверх. Таким образом и бот, и мини‑приложение
 # работают с одним файлом ``database.db``, расположенным в корне проекта.
-DB_PATH: str = os.path.join(os.path.dirname(os.path.dirname(__file__)), "database.db")
+DB_PATH: str = os.getenv("DATABASE_PATH") or os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "database.db"
+)
+
+# Профили настроек SQLite. cache_size задаётся в KiB (отрицательное
+# значение), mmap_size — в байтах. Профиль выбирается переменной
+# окружения DB_PROFILE; по умолчанию используется "default".
+PRAGMA_PROFILES: dict[str, dict[str, int]] = {
+    "low_memory": {"cache_size": -2_000, "mmap_size": 0},
+    "default": {"cache_size": -16_000, "mmap_size": 64 * 1024 * 1024},
+    "throughput": {"cache_size": -64_000, "mmap_size": 256 * 1024 * 1024},
+}
+DB_PROFILE: str = os.getenv("DB_PROFILE", "default")
+# Сколько миллисекунд ждать снятия блокировки другим процессом (бот и
+# мини‑приложение пишут в один файл), прежде чем вернуть SQLITE_BUSY.
+DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# Соединение текущего потока и реестр всех открытых соединений (нужен,
+# чтобы закрыть их перед удалением файла базы).
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+
+def _configure_connection(conn: sqlite3.Connection) -> None:
+    """Применяет PRAGMA‑настройки выбранного профиля к соединению."""
+    profile = PRAGMA_PROFILES.get(DB_PROFILE, PRAGMA_PROFILES["default"])
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size={profile['cache_size']}")
+    conn.execute(f"PRAGMA mmap_size={profile['mmap_size']}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
 
 def get_db_connection() -> sqlite3.Connection:
-    """Создаёт и возвращает новое соединение с базой данных.
+    """Создаёт и возвращает новое отдельное соединение с базой данных.
 
-    Мы отключаем проверку потока (check_same_thread=False), так как
-    соединения могут использоваться в асинхронном коде, где разные
-    корутины работают в разных потоках. Каждое обращение получает
-    собственное соединение, поэтому закрывайте его после использования.
+    Соединение настраивается так же, как и соединения из пула, но не
+    переиспользуется: закройте его после использования. Для обычной
+    работы используйте db_connection().
     """
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    _configure_connection(conn)
     return conn
 
-def init_db() -> None:
-    """Создаёт необходимые таблицы, если они не существуют."""
-    # Перед созданием таблиц удаляем существующий файл базы данных. Это
-    # гарантирует, что приложение всегда начинает работу с чистой базой.
-    # Если необходимо сохранять данные между перезапусками, закомментируйте
-    # строку ниже.
+
+def _thread_connection() -> sqlite3.Connection:
+    """Возвращает долгоживущее соединение текущего потока, открывая его при первом обращении."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = get_db_connection()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+@contextmanager
+def db_connection() -> Iterator[sqlite3.Connection]:
+    """Выдаёт соединение текущего потока в рамках одной транзакции.
+
+    При успешном выходе из блока незавершённая транзакция фиксируется,
+    при исключении — откатывается. Само соединение не закрывается и
+    используется повторно следующими вызовами из этого же потока.
+    """
+    conn = _thread_connection()
     try:
-        if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
-            logger.debug(f"Удалён существующий файл базы данных: {DB_PATH}")
-    except Exception:
-        pass
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.executescript(
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+
+def close_all_connections() -> None:
+    """Закрывает все соединения пула (например, перед удалением файла базы)."""
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _connections.clear()
+    _local.__dict__.pop("conn", None)
+
+
+# Флаг для разработки: при запуске удалить файл базы и начать с пустой
+# схемы (прежнее поведение). По умолчанию данные сохраняются между
+# перезапусками, а схема доводится до актуальной версии миграциями.
+DB_RESET_ON_START: bool = os.getenv("DB_RESET_ON_START", "").strip().lower() in {"1", "true", "yes", "on"}
+
+# Распределение стоимости выборов по позициям и участникам — содержимое
+# таблицы position_allocations (суммы в копейках). Правила те же, что в
+# app.settlement.compute_costs:
+#
+# * явный выбор (quantity > 0) стоит quantity × цена, округлённые до копейки
+#   (floor(x + 0.5); floor выражен через CAST, так как математические
+#   функции SQLite собраны не везде);
+# * остаток позиции (исходное количество минус явные выборы) делится между
+#   отметками «поровну» (quantity < 0) методом наибольшего остатка: каждому
+#   целая часть доли, лишние копейки — первым по user_id;
+# * выбор без позиции в чеке оплачивается по цене из самого выбора; такие
+#   выборы учитываются под position_id = 0.
+#
+# Сумма явных выборов и число отметок считаются группировкой по позиции,
+# номер отметки по user_id — окном ROW_NUMBER только по строкам «поровну».
+# {where} — условие на строки selected_positions (алиас sp): одна группа,
+# её отдельные позиции или все группы сразу (заполнение в миграции).
+_ALLOCATION_CTES = """
+sel AS (
+    SELECT sp.group_id,
+           CAST(sp.user_tg_id AS INTEGER) AS user_id,
+           COALESCE(p.id, 0) AS pos_id,
+           COALESCE(sp.quantity, 0) AS qty,
+           COALESCE(p.price, sp.price, 0) AS price,
+           COALESCE(p.quantity, 0) AS pos_qty
+    FROM selected_positions AS sp
+    LEFT JOIN positions AS p ON p.id = sp.position_id AND p.group_id = sp.group_id
+    WHERE {where} AND sp.user_tg_id IS NOT NULL
+),
+per_pos AS (
+    SELECT group_id,
+           pos_id,
+           MAX(pos_qty) AS pos_qty,
+           MAX(price) AS price,
+           TOTAL(CASE WHEN qty > 0 THEN qty END) AS manual_qty,
+           SUM(qty < 0) AS equal_count
+    FROM sel
+    WHERE pos_id != 0
+    GROUP BY group_id, pos_id
+    HAVING equal_count > 0
+),
+equal_split AS (
+    SELECT group_id, pos_id, user_id, equal_count, rn, leftover,
+           (leftover % equal_count + equal_count) % equal_count AS rest
+    FROM (
+        SELECT sel.group_id,
+               sel.pos_id,
+               sel.user_id,
+               per_pos.equal_count,
+               ROW_NUMBER() OVER (PARTITION BY sel.group_id, sel.pos_id ORDER BY sel.user_id) AS rn,
+               CAST(x AS INTEGER) - (x < CAST(x AS INTEGER)) AS leftover
+        -- CROSS JOIN фиксирует порядок: строки «поровну» ищут свою позицию
+        -- в небольшом per_pos, а не наоборот
+        FROM sel
+        CROSS JOIN (
+            SELECT group_id, pos_id, equal_count, MAX(pos_qty - manual_qty, 0) * price + 0.5 AS x
+            FROM per_pos
+        ) AS per_pos ON per_pos.group_id = sel.group_id AND per_pos.pos_id = sel.pos_id
+        WHERE sel.qty < 0
+    )
+),
+charges AS (
+    -- Явные выборы; строки без стоимости (нулевое количество, «поровну» без
+    -- позиции) дают 0 и отмечают участника как выбравшего
+    SELECT group_id, pos_id, user_id,
+           COALESCE(CAST(x AS INTEGER) - (x < CAST(x AS INTEGER)), 0) AS cost,
+           x IS NOT NULL AS charged
+    FROM (
+        SELECT group_id, pos_id, user_id, CASE WHEN qty > 0 THEN qty * price + 0.5 END AS x
+        FROM sel
+        WHERE qty >= 0 OR pos_id = 0
+    )
+    UNION ALL
+    SELECT group_id, pos_id, user_id, (leftover - rest) / equal_count + (rn <= rest), 1
+    FROM equal_split
+)
+"""
+
+# Строки position_allocations для выборов, отобранных условием {where}.
+_ALLOCATIONS_SQL = (
+    "INSERT INTO position_allocations (group_id, position_id, user_id, cost, charges, selections)\n"
+    "WITH" + _ALLOCATION_CTES + """
+SELECT group_id, pos_id, user_id, SUM(cost), SUM(charged), COUNT(*)
+FROM charges
+GROUP BY group_id, pos_id, user_id
+"""
+)
+
+# Строки group_balances: распределения позиций и платежи, сложенные по
+# участникам. {where} — условие на group_id обеих таблиц.
+_BALANCES_SQL = """
+INSERT INTO group_balances (group_id, user_id, cost, paid, charges, selections, payments)
+SELECT group_id, user_id, SUM(cost), SUM(paid), SUM(charges), SUM(selections), SUM(payments)
+FROM (
+    SELECT group_id, user_id, cost, 0 AS paid, charges, selections, 0 AS payments
+    FROM position_allocations
+    WHERE {where}
+    UNION ALL
+    SELECT group_id, CAST(tg_user_id AS INTEGER), 0, COALESCE(amount, 0), 0, 0, 1
+    FROM payments
+    WHERE {where} AND tg_user_id IS NOT NULL
+)
+GROUP BY group_id, user_id
+"""
+
+# Версионированные миграции схемы. Элемент списка с индексом i переводит
+# базу с версии i на версию i + 1; номер применённой версии хранится в
+# PRAGMA user_version. Выпущенные миграции не редактируются: любое
+# изменение схемы добавляется новым элементом в конец списка.
+MIGRATIONS: list[tuple[str, ...]] = [
+    # 1: исходная схема. CREATE TABLE IF NOT EXISTS позволяет подхватить
+    # базы, созданные до появления миграций (user_version = 0).
+    (
         """
         CREATE TABLE IF NOT EXISTS accounts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -97,14 +306,18 @@ def init_db() -> None:
             telegram_login TEXT,
             bank TEXT,
             telegram_id TEXT UNIQUE
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS positions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             group_id TEXT,
             name TEXT,
             quantity REAL,
             price REAL
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS selected_positions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             group_id TEXT,
@@ -113,26 +326,28 @@ def init_db() -> None:
             quantity REAL,
             price REAL,
             FOREIGN KEY (position_id) REFERENCES positions(id)
-        );
-
-        -- Новая таблица для хранения внесённых платежей. Сохраняем, кто
-        -- внёс платёж (tg_user_id), для какой группы (group_id), сумму
-        -- платежа (amount) и опциональное описание или список позиций,
-        -- за которые был внесён платёж (positions). Формат поля
-        -- positions: JSON‑строка или произвольный текст.
+        )
+        """,
+        # Новая таблица для хранения внесённых платежей. Сохраняем, кто
+        # внёс платёж (tg_user_id), для какой группы (group_id), сумму
+        # платежа (amount) и опциональное описание или список позиций,
+        # за которые был внесён платёж (positions). Формат поля
+        # positions: JSON‑строка или произвольный текст.
+        """
         CREATE TABLE IF NOT EXISTS payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             tg_user_id TEXT,
             group_id TEXT,
             amount REAL,
             positions TEXT
-        );
-
-        -- Архивные таблицы для хранения завершённых чеков. После выполнения
-        -- финального клиринга данные из текущих таблиц переносятся в
-        -- соответствующие архивные таблицы и удаляются из основных. Это
-        -- позволяет держать рабочие таблицы пустыми между расчётами,
-        -- одновременно сохраняя историю для отладочных целей.
+        )
+        """,
+        # Архивные таблицы для хранения завершённых чеков. После выполнения
+        # финального клиринга данные из текущих таблиц переносятся в
+        # соответствующие архивные таблицы и удаляются из основных. Это
+        # позволяет держать рабочие таблицы пустыми между расчётами,
+        # одновременно сохраняя историю для отладочных целей.
+        """
         CREATE TABLE IF NOT EXISTS archived_positions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             group_id TEXT,
@@ -140,7 +355,9 @@ def init_db() -> None:
             quantity REAL,
             price REAL,
             archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS archived_selected_positions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             group_id TEXT,
@@ -149,7 +366,9 @@ def init_db() -> None:
             quantity REAL,
             price REAL,
             archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS archived_payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             tg_user_id TEXT,
@@ -157,46 +376,534 @@ def init_db() -> None:
             amount REAL,
             positions TEXT,
             archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-
-        -- Таблица для сохранения результатов расчётов долей.
-        -- Каждая запись описывает, сколько пользователь должен
-        -- заплатить по итогам расчёта для конкретного чека (receipt).
-        -- Поля:
-        --   id          — первичный ключ
-        --   receipt_id  — идентификатор расчёта (чаще всего совпадает с chat.id группы)
-        --   user_tg_id  — идентификатор пользователя, который должен заплатить
-        --   amount      — сумма долга пользователя (в рублях)
-        --   created_at  — время создания записи (UTC)
+        )
+        """,
+        # Таблица для сохранения результатов расчётов долей.
+        # Каждая запись описывает, сколько пользователь должен
+        # заплатить по итогам расчёта для конкретного чека (receipt).
+        # Поля:
+        #   id          — первичный ключ
+        #   receipt_id  — идентификатор расчёта (чаще всего совпадает с chat.id группы)
+        #   user_tg_id  — идентификатор пользователя, который должен заплатить
+        #   amount      — сумма долга пользователя (в рублях)
+        #   created_at  — время создания записи (UTC)
+        """
         CREATE TABLE IF NOT EXISTS debts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             receipt_id TEXT,
             user_tg_id TEXT,
             amount REAL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
+        )
+        """,
+    ),
+    # 2: индексы для запросов в разрезе группы. Без них выборки по
+    # group_id, user_tg_id, receipt_id и поиск position_id в
+    # save_selected_positions сканируют таблицы целиком.
+    (
+        # Поиск id позиции по (group_id, name, price) в
+        # save_selected_positions; префикс group_id обслуживает
+        # get_positions, load_group_snapshot, архивирование и очистку группы.
+        "CREATE INDEX IF NOT EXISTS idx_positions_group_name_price ON positions (group_id, name, price)",
+        # Выбор пользователя в группе (перезапись в save_selected_positions)
+        # и выборки по group_id.
+        "CREATE INDEX IF NOT EXISTS idx_selected_positions_group_user ON selected_positions (group_id, user_tg_id)",
+        # Обратная ссылка на позицию: выбор по конкретной позиции чека.
+        "CREATE INDEX IF NOT EXISTS idx_selected_positions_position ON selected_positions (position_id)",
+        # Покрывающий индекс для суммы платежей по участникам группы.
+        "CREATE INDEX IF NOT EXISTS idx_payments_group_user_amount ON payments (group_id, tg_user_id, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_accounts_telegram_login ON accounts (telegram_login)",
+        "CREATE INDEX IF NOT EXISTS idx_debts_receipt ON debts (receipt_id)",
+    ),
+    # 3: денежные поля (price, amount) хранятся целым числом копеек. Тип
+    # столбца в SQLite не меняется через ALTER, поэтому таблицы
+    # пересоздаются с переносом данных (id сохраняются), а индексы
+    # миграции 2 создаются заново.
+    (
         """
-    )
-    conn.commit()
-    conn.close()
-
-    # После создания таблиц очищаем таблицы positions и selected_positions.
-    # Это позволяет избежать ситуаций, когда в базе данных остаются
-    # устаревшие данные от предыдущих запусков (например, при тестировании).
-    # Если вам требуется сохранение данных между перезапусками, удалите
-    # строки ниже.
+        CREATE TABLE positions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT,
+            name TEXT,
+            quantity REAL,
+            price INTEGER
+        )
+        """,
+        "INSERT INTO positions_new (id, group_id, name, quantity, price) "
+        "SELECT id, group_id, name, quantity, CAST(ROUND(price * 100) AS INTEGER) FROM positions",
+        "DROP TABLE positions",
+        "ALTER TABLE positions_new RENAME TO positions",
+        """
+        CREATE TABLE selected_positions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT,
+            user_tg_id TEXT,
+            position_id INTEGER,
+            quantity REAL,
+            price INTEGER,
+            FOREIGN KEY (position_id) REFERENCES positions(id)
+        )
+        """,
+        "INSERT INTO selected_positions_new (id, group_id, user_tg_id, position_id, quantity, price) "
+        "SELECT id, group_id, user_tg_id, position_id, quantity, CAST(ROUND(price * 100) AS INTEGER) FROM selected_positions",
+        "DROP TABLE selected_positions",
+        "ALTER TABLE selected_positions_new RENAME TO selected_positions",
+        """
+        CREATE TABLE payments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_user_id TEXT,
+            group_id TEXT,
+            amount INTEGER,
+            positions TEXT
+        )
+        """,
+        "INSERT INTO payments_new (id, tg_user_id, group_id, amount, positions) "
+        "SELECT id, tg_user_id, group_id, CAST(ROUND(amount * 100) AS INTEGER), positions FROM payments",
+        "DROP TABLE payments",
+        "ALTER TABLE payments_new RENAME TO payments",
+        """
+        CREATE TABLE debts_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id TEXT,
+            user_tg_id TEXT,
+            amount INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "INSERT INTO debts_new (id, receipt_id, user_tg_id, amount, created_at) "
+        "SELECT id, receipt_id, user_tg_id, CAST(ROUND(amount * 100) AS INTEGER), created_at FROM debts",
+        "DROP TABLE debts",
+        "ALTER TABLE debts_new RENAME TO debts",
+        """
+        CREATE TABLE archived_positions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT,
+            name TEXT,
+            quantity REAL,
+            price INTEGER,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "INSERT INTO archived_positions_new (id, group_id, name, quantity, price, archived_at) "
+        "SELECT id, group_id, name, quantity, CAST(ROUND(price * 100) AS INTEGER), archived_at FROM archived_positions",
+        "DROP TABLE archived_positions",
+        "ALTER TABLE archived_positions_new RENAME TO archived_positions",
+        """
+        CREATE TABLE archived_selected_positions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT,
+            user_tg_id TEXT,
+            position_id INTEGER,
+            quantity REAL,
+            price INTEGER,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "INSERT INTO archived_selected_positions_new (id, group_id, user_tg_id, position_id, quantity, price, archived_at) "
+        "SELECT id, group_id, user_tg_id, position_id, quantity, CAST(ROUND(price * 100) AS INTEGER), archived_at FROM archived_selected_positions",
+        "DROP TABLE archived_selected_positions",
+        "ALTER TABLE archived_selected_positions_new RENAME TO archived_selected_positions",
+        """
+        CREATE TABLE archived_payments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_user_id TEXT,
+            group_id TEXT,
+            amount INTEGER,
+            positions TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "INSERT INTO archived_payments_new (id, tg_user_id, group_id, amount, positions, archived_at) "
+        "SELECT id, tg_user_id, group_id, CAST(ROUND(amount * 100) AS INTEGER), positions, archived_at FROM archived_payments",
+        "DROP TABLE archived_payments",
+        "ALTER TABLE archived_payments_new RENAME TO archived_payments",
+        "CREATE INDEX idx_positions_group_name_price ON positions (group_id, name, price)",
+        "CREATE INDEX idx_selected_positions_group_user ON selected_positions (group_id, user_tg_id)",
+        "CREATE INDEX idx_selected_positions_position ON selected_positions (position_id)",
+        "CREATE INDEX idx_payments_group_user_amount ON payments (group_id, tg_user_id, amount)",
+        "CREATE INDEX idx_debts_receipt ON debts (receipt_id)",
+    ),
+    # 4: поиск пользователя по username без учёта регистра. В столбце
+    # telegram_login_cf хранится нормализованный логин (normalize_login:
+    # без "@", casefold), по нему строится индекс; индекс по исходному
+    # telegram_login больше не нужен. Функция normalize_login
+    # регистрируется на соединении в migrate().
+    (
+        "ALTER TABLE accounts ADD COLUMN telegram_login_cf TEXT",
+        "UPDATE accounts SET telegram_login_cf = normalize_login(telegram_login)",
+        "DROP INDEX IF EXISTS idx_accounts_telegram_login",
+        "CREATE INDEX idx_accounts_telegram_login_cf ON accounts (telegram_login_cf)",
+    ),
+    # 5: журнал завершённых расчётов. request_key — ключ идемпотентности
+    # (чат и сообщение, запустившее /finalize): повторная доставка того же
+    # апдейта не выполняет расчёт второй раз.
+    (
+        """
+        CREATE TABLE finalizations (
+            request_key TEXT PRIMARY KEY,
+            group_id TEXT NOT NULL,
+            receipt_id TEXT NOT NULL,
+            transfers TEXT NOT NULL,
+            finalized_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX idx_finalizations_group ON finalizations (group_id)",
+    ),
+    # 6: проекции для расчёта без пересчёта сырых строк. position_allocations —
+    # стоимость каждой позиции для каждого участника (position_id = 0 — выборы
+    # без позиции в чеке), group_balances — итог по участнику группы: стоимость,
+    # платежи и число строк, из которых они сложены (selections, charges —
+    # выборы со стоимостью, payments). Обе таблицы обновляются функциями записи
+    # этого модуля и заполняются из текущих данных.
+    (
+        """
+        CREATE TABLE position_allocations (
+            group_id TEXT NOT NULL,
+            position_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            cost INTEGER NOT NULL,
+            charges INTEGER NOT NULL,
+            selections INTEGER NOT NULL,
+            PRIMARY KEY (group_id, position_id, user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE group_balances (
+            group_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            cost INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            charges INTEGER NOT NULL DEFAULT 0,
+            selections INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID
+        """,
+        _ALLOCATIONS_SQL.format(where="sp.group_id IS NOT NULL"),
+        _BALANCES_SQL.format(where="group_id IS NOT NULL"),
+    ),
+    # 7: версия состояния группы — счётчик, который увеличивает каждая
+    # функция записи этого модуля. Строка группы не удаляется и после
+    # завершения расчёта, поэтому версия только растёт; 0 — группа без данных.
+    (
+        """
+        CREATE TABLE group_versions (
+            group_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO group_versions (group_id, version)
+        SELECT group_id, 1 FROM (
+            SELECT group_id FROM positions
+            UNION SELECT group_id FROM selected_positions
+            UNION SELECT group_id FROM payments
+        ) WHERE group_id IS NOT NULL
+        """,
+    ),
+    # 8: не больше одной строки выбора на участника и позицию чека — ключ
+    # для upsert в apply_selection_changes. Дубликаты сводятся в строку с
+    # наименьшим id (явные количества складываются, иначе остаётся отметка
+    # «поровну»), проекции строятся заново. Уникальный индекс заменяет
+    # индекс (group_id, user_tg_id): его префикс обслуживает те же запросы.
+    (
+        """
+        UPDATE selected_positions AS sp SET quantity = d.quantity
+        FROM (
+            SELECT MIN(id) AS keep_id,
+                   CASE WHEN TOTAL(CASE WHEN quantity > 0 THEN quantity END) > 0
+                        THEN TOTAL(CASE WHEN quantity > 0 THEN quantity END)
+                        ELSE MIN(quantity) END AS quantity
+            FROM selected_positions
+            WHERE position_id IS NOT NULL
+            GROUP BY group_id, user_tg_id, position_id
+            HAVING COUNT(*) > 1
+        ) AS d
+        WHERE sp.id = d.keep_id
+        """,
+        """
+        DELETE FROM selected_positions
+        WHERE position_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM selected_positions
+            WHERE position_id IS NOT NULL
+            GROUP BY group_id, user_tg_id, position_id
+        )
+        """,
+        "DROP INDEX IF EXISTS idx_selected_positions_group_user",
+        "CREATE UNIQUE INDEX idx_selected_positions_user_position "
+        "ON selected_positions (group_id, user_tg_id, position_id)",
+        "DELETE FROM position_allocations",
+        "DELETE FROM group_balances",
+        _ALLOCATIONS_SQL.format(where="sp.group_id IS NOT NULL"),
+        _BALANCES_SQL.format(where="group_id IS NOT NULL"),
+    ),
+    # 9: распознанные чеки для поиска повторно присланных фотографий.
+    # receipt_scans — результат распознавания и ключ фискального QR‑кода
+    # (уникален, если прочитан). receipt_files — file_unique_id фотографий
+    # Telegram, по которым чек уже распознан. positions.receipt_scan_id —
+    # из какого чека добавлена позиция: один чек не добавляется в группу
+    # дважды.
+    (
+        """
+        CREATE TABLE receipt_scans (
+            id INTEGER PRIMARY KEY,
+            fiscal_key TEXT,
+            items TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE UNIQUE INDEX idx_receipt_scans_fiscal_key ON receipt_scans (fiscal_key) "
+        "WHERE fiscal_key IS NOT NULL",
+        """
+        CREATE TABLE receipt_files (
+            file_unique_id TEXT PRIMARY KEY,
+            scan_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "ALTER TABLE positions ADD COLUMN receipt_scan_id INTEGER",
+    ),
+    # 10: общий для бота и мини‑приложения кэш ответов текстовых запросов к
+    # LLM (см. services.llm_cache). key — хеш модели, версии промпта и
+    # нормализованного текста, value — ответ в JSON, latency_ms —
+    # длительность исходного запроса. По индексу expires_at удаляются
+    # устаревшие записи и самые старые при превышении размера.
+    (
+        """
+        CREATE TABLE llm_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            latency_ms REAL NOT NULL DEFAULT 0,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX idx_llm_cache_expires_at ON llm_cache (expires_at)",
+    ),
+]
+
+# Версия схемы, которую ожидает код.
+SCHEMA_VERSION: int = len(MIGRATIONS)
+
+
+def normalize_login(login: str | None) -> str | None:
+    """Приводит Telegram‑username к виду для поиска: без "@", casefold.
+
+    Пустое значение даёт None. Результат хранится в accounts.telegram_login_cf.
+    """
+    if not login:
+        return None
+    normalized = str(login).strip().lstrip("@").casefold()
+    return normalized or None
+
+
+def _remove_db_files() -> None:
+    """Удаляет файл базы вместе с журналами WAL (используется только при DB_RESET_ON_START)."""
+    close_all_connections()
+    for suffix in ("", "-wal", "-shm"):
+        path = DB_PATH + suffix
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logger.debug(f"Удалён файл базы данных: {path}")
+        except Exception:
+            pass
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Возвращает номер версии схемы, записанный в файле базы."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы.
+
+    Если база уже актуальна, выполняется одно чтение PRAGMA user_version,
+    поэтому время запуска не зависит от объёма данных. Иначе миграции
+    применяются в одной транзакции BEGIN IMMEDIATE: при одновременном
+    старте бота и мини‑приложения схему обновит только один процесс,
+    второй дождётся блокировки и увидит уже новую версию.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    current = get_schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        if current > SCHEMA_VERSION:
+            logger.warning(
+                f"Версия схемы базы ({current}) новее ожидаемой кодом ({SCHEMA_VERSION})"
+            )
+        return current
+    # Python‑функции, на которые ссылаются миграции
+    conn.create_function("normalize_login", 1, normalize_login, deterministic=True)
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM positions")
-        cur.execute("DELETE FROM selected_positions")
+        current = get_schema_version(conn)
+        for version in range(current, SCHEMA_VERSION):
+            for statement in MIGRATIONS[version]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            logger.info(f"Применена миграция схемы базы данных до версии {version + 1}")
         conn.commit()
-    finally:
-        conn.close()
+    except BaseException:
+        conn.rollback()
+        raise
+    return max(current, SCHEMA_VERSION)
+
+
+def ping() -> int:
+    """Проверяет доступность базы и возвращает версию схемы.
+
+    Читает только заголовок файла (PRAGMA user_version), поэтому время
+    выполнения не зависит от объёма данных. Используется health‑проверкой.
+    """
+    with db_connection() as conn:
+        return get_schema_version(conn)
+
+
+def init_db() -> None:
+    """Готовит базу к работе: применяет недостающие миграции схемы.
+
+    Данные между перезапусками сохраняются. Для разработки можно задать
+    DB_RESET_ON_START=1 — тогда файл базы удаляется и схема создаётся
+    заново.
+    """
+    if DB_RESET_ON_START:
+        _remove_db_files()
+    with db_connection() as conn:
+        migrate(conn)
 
 # Инициализируем базу данных при импорте.
 init_db()
 
+# ---------------------------------------------------------------------------
+# Версии состояния групп
+# ---------------------------------------------------------------------------
+# Каждая функция записи увеличивает group_versions.version в своей
+# транзакции. Мини‑приложение отдаёт версию как ETag и по ней отвечает
+# 304 Not Modified, а при сохранении выбора сверяет версию, которую видел
+# клиент (оптимистическая блокировка).
+
+_VERSION_UPSERT = (
+    "INSERT INTO group_versions (group_id, version) VALUES (?, 1) "
+    "ON CONFLICT (group_id) DO UPDATE SET version = version + 1"
+)
+
+
+class StaleVersionError(Exception):
+    """Состояние группы изменилось после того, как клиент его прочитал."""
+
+    def __init__(self, group_id: str, expected: int, current: int) -> None:
+        super().__init__(f"Версия группы {group_id} — {current}, клиент ожидал {expected}")
+        self.group_id = group_id
+        self.expected = expected
+        self.current = current
+
+
+def _bump_version(cur: sqlite3.Cursor, group_id: str, expected: int | None = None) -> int:
+    """
+    Увеличивает версию группы и возвращает новую.
+
+    Если передан expected, а версия до увеличения была другой, выбрасывает
+    StaleVersionError — функция записи откатывает транзакцию. Проверка не
+    требует отдельного чтения: сравнивается значение из RETURNING.
+    """
+    cur.execute(_VERSION_UPSERT + " RETURNING version", (str(group_id),))
+    version = cur.fetchone()[0]
+    if expected is not None and version != expected + 1:
+        metrics.incr("group_version.conflict")
+        raise StaleVersionError(str(group_id), expected, version - 1)
+    return version
+
+
+def _bump_versions(cur: sqlite3.Cursor, group_ids: Iterable[str]) -> None:
+    """Увеличивает версии нескольких групп."""
+    cur.executemany(_VERSION_UPSERT, [(str(group_id),) for group_id in group_ids])
+
+
+def get_group_version(group_id: str) -> int:
+    """Возвращает текущую версию группы (0, если данных группы ещё не было)."""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT version FROM group_versions WHERE group_id = ?", (str(group_id),)
+        ).fetchone()
+    return row[0] if row else 0
+
+
+def get_group_versions(group_ids: Iterable[str]) -> dict[str, int]:
+    """
+    Возвращает версии нескольких групп одним запросом (порциями по
+    _IN_CHUNK): {group_id: версия}. Групп без данных в результате нет.
+    """
+    ids = sorted({str(group_id) for group_id in group_ids})
+    result: dict[str, int] = {}
+    if not ids:
+        return result
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for start in range(0, len(ids), _IN_CHUNK):
+            chunk = ids[start:start + _IN_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT group_id, version FROM group_versions WHERE group_id IN ({placeholders})",
+                chunk,
+            )
+            result.update((row[0], row[1]) for row in cur.fetchall())
+    return result
+
+
+def load_group_claims(group_id: str) -> tuple[int, list[sqlite3.Row], list[sqlite3.Row]]:
+    """
+    Загружает состояние группы для обновлений мини‑приложения в реальном времени.
+
+    Все запросы выполняются в одной читающей транзакции.
+
+    Returns:
+        tuple: (версия группы; позиции с полями id, name, quantity, price в
+        порядке id, цена в копейках; выборы с полями position_id, user_id,
+        quantity — сумма ручного выбора, equal — 1, если участник делит
+        позицию поровну).
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        conn.execute("BEGIN")
+        cur.execute("SELECT version FROM group_versions WHERE group_id = ?", (str(group_id),))
+        row = cur.fetchone()
+        version = row[0] if row else 0
+        cur.execute(
+            "SELECT id, name, quantity, price FROM positions WHERE group_id = ? ORDER BY id",
+            (str(group_id),),
+        )
+        positions = cur.fetchall()
+        cur.execute(
+            "SELECT position_id, CAST(user_tg_id AS INTEGER) AS user_id, "
+            "SUM(MAX(quantity, 0)) AS quantity, MAX(quantity < 0) AS equal "
+            "FROM selected_positions WHERE group_id = ? AND position_id IS NOT NULL "
+            "GROUP BY position_id, user_tg_id",
+            (str(group_id),),
+        )
+        return version, positions, cur.fetchall()
+
+
+def get_positions_if_changed(group_id: str, known_version: int | None = None) -> tuple[int, list | None]:
+    """
+    Возвращает версию группы и её позиции, если версия отличается от known_version.
+
+    Версия и позиции читаются в одной транзакции, поэтому соответствуют
+    друг другу. Если версия совпала с known_version, позиции не читаются и
+    вместо списка возвращается None.
+
+    Returns:
+        tuple: (версия группы; список позиций как в get_positions, но с
+        полем id — для выбора через apply_selection_changes, или None).
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        conn.execute("BEGIN")
+        cur.execute("SELECT version FROM group_versions WHERE group_id = ?", (str(group_id),))
+        row = cur.fetchone()
+        version = row[0] if row else 0
+        if known_version is not None and version == known_version:
+            return version, None
+        return version, _read_positions(cur, group_id, with_ids=True)
+
 # ---------------------------------------------------------------------------
 # В этой версии модуля мы исключили все глобальные структуры хранения
 # данных. Все сведения о пользователях, позициях, выборе пользователей и
@@ -355,56 +1062,197 @@ def _load_detailed_positions() -> None:
         print(f"Ошибка при загрузке детальных выбранных позиций: {e}")
 
 
-def save_selected_positions(group_id: str, user_id: int, positions: list[dict]) -> None:
+def save_selected_positions(
+    group_id: str, user_id: int, positions: list[dict], expected_version: int | None = None
+) -> int:
     """
     Сохраняет выбранные пользователем позиции для указанной группы.
 
-    Если `positions` непустой, перезаписывает выбор пользователя. Если передан
-    пустой список, удаляет существующий выбор пользователя. После обновления
-    пересчитывает агрегированное представление и сохраняет как детальное, так и
-    агрегированное представления в файл.
+    Если `positions` непустой, заменяет им выбор пользователя в таблице
+    selected_positions; пустой список удаляет прежний выбор. Позиции
+    сопоставляются с позициями чека по названию и цене. Перезаписываются
+    только изменившиеся строки, и распределение стоимости пересчитывается
+    только для их позиций.
 
     Args:
         group_id: Строковый идентификатор группы (например, chat.id).
         user_id: Идентификатор пользователя Telegram, сделавшего выбор.
         positions: Список позиций (словарей с ключами name, quantity, price).
-    """
-    """Сохраняет выбранные пользователем позиции для указанной группы.
+        expected_version: Версия группы, которую видел клиент. Если с тех пор
+            группа изменилась, выбор не сохраняется и выбрасывается
+            StaleVersionError. None — без проверки.
 
-    Данные записываются в таблицу `selected_positions`. Перед вставкой
-    удаляется предыдущий выбор пользователя для данной группы. После
-    обновления база данных синхронизируется с in‑memory структурами
-    SELECTED_POSITIONS и GROUP_SELECTIONS.
+    Returns:
+        int: новая версия группы.
     """
     # Сохраняем в базу данных
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Удаляем прежний выбор этого пользователя в группе
-    cur.execute(
-        "DELETE FROM selected_positions WHERE group_id = ? AND user_tg_id = ?",
-        (str(group_id), str(user_id)),
-    )
-    if positions:
-        for pos in positions:
-            name = pos.get('name')
-            quantity = pos.get('quantity')
-            price = pos.get('price')
-            # Находим id исходной позиции, если она существует
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Версия увеличивается первой записью транзакции: дальнейшие чтения
+        # идут уже под блокировкой записи, а устаревший выбор отклоняется
+        # до каких‑либо изменений.
+        version = _bump_version(cur, group_id, expected_version)
+        rows: list[tuple] = []
+        if positions:
+            # id исходных позиций находим одним запросом: первая (по id)
+            # позиция группы с такими же названием и ценой.
             cur.execute(
-                "SELECT id FROM positions WHERE group_id = ? AND name = ? AND price = ? ORDER BY id LIMIT 1",
-                (str(group_id), name, price),
+                "SELECT name, price, MIN(id) AS id FROM positions WHERE group_id = ? GROUP BY name, price",
+                (str(group_id),),
             )
-            row = cur.fetchone()
-            position_id = row['id'] if row else None
+            position_ids = {
+                (row['name'], row['price']): row['id']
+                for row in cur.fetchall()
+                if row['name'] is not None and row['price'] is not None
+            }
+            for pos in positions:
+                name = pos.get('name')
+                price = to_kopecks(pos.get('price'))
+                try:
+                    position_id = position_ids.get((name, price))
+                except TypeError:
+                    position_id = None
+                rows.append((position_id, pos.get('quantity'), price))
+        # Прежний выбор сравнивается с новым: перезаписываются только
+        # изменившиеся строки, и распределение пересчитывается только для
+        # их позиций
+        cur.execute(
+            "SELECT position_id, quantity, price FROM selected_positions WHERE group_id = ? AND user_tg_id = ?",
+            (str(group_id), str(user_id)),
+        )
+        previous_rows = cur.fetchall()
+        previous = {row[0]: (row[1], row[2]) for row in previous_rows if row[0] is not None}
+        desired = _merge_selections(rows)
+        changed = _write_selections(cur, group_id, user_id, {
+            position_id: desired.get(position_id)
+            for position_id in previous.keys() | desired.keys()
+            if previous.get(position_id) != desired.get(position_id)
+        })
+        # Выборы без позиции в чеке не имеют ключа — их набор заменяется целиком
+        previous_orphans = Counter((row[1], row[2]) for row in previous_rows if row[0] is None)
+        orphans = Counter((quantity, price) for position_id, quantity, price in rows if position_id is None)
+        if orphans != previous_orphans:
             cur.execute(
-                "INSERT INTO selected_positions (group_id, user_tg_id, position_id, quantity, price) VALUES (?, ?, ?, ?, ?)",
-                (str(group_id), str(user_id), position_id, quantity, price),
+                "DELETE FROM selected_positions WHERE group_id = ? AND user_tg_id = ? AND position_id IS NULL",
+                (str(group_id), str(user_id)),
+            )
+            cur.executemany(
+                "INSERT INTO selected_positions (group_id, user_tg_id, position_id, quantity, price) VALUES (?, ?, NULL, ?, ?)",
+                [(str(group_id), str(user_id), quantity, price) for quantity, price in orphans.elements()],
             )
-    conn.commit()
-    conn.close()
+            changed.add(None)
+        _refresh_positions(cur, group_id, changed)
     # Не обновляем in‑memory SELECTED_POSITIONS или GROUP_SELECTIONS и не
     # сохраняем данные в JSON‑файлы. Все данные о выборе хранятся
     # исключительно в таблице selected_positions базы данных.
+    return version
+
+
+def apply_selection_changes(
+    group_id: str,
+    user_id: int,
+    changes: dict[int, float | None],
+    expected_version: int | None = None,
+) -> int:
+    """
+    Применяет изменения выбора участника по отдельным позициям.
+
+    В отличие от save_selected_positions, прежний выбор не перечитывается и
+    не перезаписывается: каждая изменённая позиция — один upsert (или
+    удаление) по ключу (group_id, user_tg_id, position_id). Цена берётся из
+    позиции чека; позиции, которых нет в группе, пропускаются.
+
+    Args:
+        group_id: Идентификатор группы (чата).
+        user_id: Идентификатор пользователя Telegram.
+        changes: position_id → количество (отрицательное — «поровну») или
+            None — снять выбор позиции.
+        expected_version: Версия группы, которую видел клиент (см.
+            save_selected_positions).
+
+    Returns:
+        int: новая версия группы.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        version = _bump_version(cur, group_id, expected_version)
+        ids = sorted({int(position_id) for position_id, quantity in changes.items() if quantity is not None})
+        prices: dict[int, int] = {}
+        for start in range(0, len(ids), _IN_CHUNK):
+            chunk = ids[start:start + _IN_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT id, price FROM positions WHERE group_id = ? AND id IN ({placeholders})",
+                [str(group_id), *chunk],
+            )
+            prices.update((row[0], row[1]) for row in cur.fetchall())
+        writes: dict[int, tuple[float, int] | None] = {}
+        for position_id, quantity in changes.items():
+            position_id = int(position_id)
+            if quantity is None:
+                writes[position_id] = None
+            elif position_id in prices:
+                writes[position_id] = (quantity, prices[position_id])
+        _refresh_positions(cur, group_id, _write_selections(cur, group_id, user_id, writes))
+    return version
+
+
+def _merge_selections(rows: list[tuple]) -> dict[int, tuple[float | None, int]]:
+    """
+    Сводит строки выбора (position_id, quantity, price) к одной на позицию.
+
+    Несколько строк одной позиции появляются, когда в чеке есть одинаковые
+    строки (они сопоставляются первой позиции): явные количества
+    складываются, иначе остаётся отметка «поровну».
+    """
+    grouped: dict[int, list[tuple]] = {}
+    for position_id, quantity, price in rows:
+        if position_id is not None:
+            grouped.setdefault(position_id, []).append((quantity, price))
+    merged: dict[int, tuple[float | None, int]] = {}
+    for position_id, items in grouped.items():
+        if len(items) == 1:
+            merged[position_id] = items[0]
+            continue
+        quantities = [quantity for quantity, _price in items if quantity is not None]
+        positive = [quantity for quantity in quantities if quantity > 0]
+        quantity = sum(positive) if positive else (min(quantities) if quantities else None)
+        merged[position_id] = (quantity, items[0][1])
+    return merged
+
+
+def _write_selections(
+    cur: sqlite3.Cursor,
+    group_id: str,
+    user_id: int,
+    changes: dict[int, tuple[float | None, int] | None],
+) -> set[int | None]:
+    """
+    Записывает выбор участника по позициям: position_id → (количество, цена)
+    или None — удалить. Строка с теми же значениями не перезаписывается.
+    Возвращает id позиций, строки которых действительно изменились.
+    """
+    changed: set[int | None] = set()
+    for position_id, value in changes.items():
+        if value is None:
+            cur.execute(
+                "DELETE FROM selected_positions WHERE group_id = ? AND user_tg_id = ? AND position_id = ? "
+                "RETURNING position_id",
+                (str(group_id), str(user_id), position_id),
+            )
+        else:
+            cur.execute(
+                "INSERT INTO selected_positions (group_id, user_tg_id, position_id, quantity, price) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (group_id, user_tg_id, position_id) DO UPDATE SET "
+                "quantity = excluded.quantity, price = excluded.price "
+                "WHERE quantity IS NOT excluded.quantity OR price IS NOT excluded.price "
+                "RETURNING position_id",
+                (str(group_id), str(user_id), position_id, *value),
+            )
+        if cur.fetchall():
+            changed.add(position_id)
+    return changed
 
 def get_selected_positions(group_id: str) -> dict[int, list[dict]]:
     """
@@ -433,20 +1281,19 @@ def get_selected_positions(group_id: str) -> dict[int, list[dict]]:
     Returns:
         dict[int, list[dict]]: отображение user_id → список выбранных позиций.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT sp.user_tg_id, sp.quantity, sp.price, p.name
-        FROM selected_positions sp
-        LEFT JOIN positions p ON sp.position_id = p.id
-        WHERE sp.group_id = ?
-        ORDER BY sp.id
-        """,
-        (str(group_id),),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT sp.user_tg_id, sp.position_id, sp.quantity, sp.price, p.name
+            FROM selected_positions sp
+            LEFT JOIN positions p ON sp.position_id = p.id
+            WHERE sp.group_id = ?
+            ORDER BY sp.id
+            """,
+            (str(group_id),),
+        )
+        rows = cur.fetchall()
     result: dict[int, list[dict]] = {}
     for row in rows:
         try:
@@ -456,7 +1303,12 @@ def get_selected_positions(group_id: str) -> dict[int, list[dict]]:
         if uid is None:
             continue
         name = row['name'] if row['name'] is not None else ''
-        item = {'name': name, 'quantity': row['quantity'], 'price': row['price']}
+        item = {
+            'name': name,
+            'quantity': row['quantity'],
+            'price': from_kopecks(row['price']),
+            'position_id': row['position_id'],
+        }
         result.setdefault(uid, []).append(item)
     # Не обновляем in‑memory SELECTED_POSITIONS или GROUP_SELECTIONS.
     return result
@@ -480,24 +1332,23 @@ def get_group_selected_positions(group_id: str) -> list[dict]:
         list[dict]: список выбранных позиций (каждый элемент —
         словарь с ключами name, quantity, price).
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT sp.quantity, sp.price, p.name
-        FROM selected_positions sp
-        LEFT JOIN positions p ON sp.position_id = p.id
-        WHERE sp.group_id = ?
-        ORDER BY sp.id
-        """,
-        (str(group_id),),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT sp.quantity, sp.price, p.name
+            FROM selected_positions sp
+            LEFT JOIN positions p ON sp.position_id = p.id
+            WHERE sp.group_id = ?
+            ORDER BY sp.id
+            """,
+            (str(group_id),),
+        )
+        rows = cur.fetchall()
     result: list[dict] = []
     for row in rows:
         name = row['name'] if row['name'] is not None else ''
-        result.append({'name': name, 'quantity': row['quantity'], 'price': row['price']})
+        result.append({'name': name, 'quantity': row['quantity'], 'price': from_kopecks(row['price'])})
     # Не обновляем in‑memory GROUP_SELECTIONS.
     return result
 
@@ -506,6 +1357,14 @@ def get_group_selected_positions(group_id: str) -> list[dict]:
 # процессах и не имеют общей памяти.
 POSITIONS_FILE: str = os.path.join(os.path.dirname(__file__), 'positions.json')
 
+def _position_rows(group_id: str, positions: list) -> list[tuple]:
+    """Готовит строки для пакетной вставки в таблицу positions (цена в рублях → копейки)."""
+    return [
+        (str(group_id), pos.get('name'), pos.get('quantity'), to_kopecks(pos.get('price')))
+        for pos in positions
+    ]
+
+
 def persist_positions(positions: dict[str, list]) -> None:
     """Сохраняет все позиции в базу данных.
 
@@ -516,19 +1375,25 @@ def persist_positions(positions: dict[str, list]) -> None:
     Args:
         positions: словарь group_id → список позиций.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Удаляем все записи
-    cur.execute("DELETE FROM positions")
-    # Вставляем новые
-    for group_id, pos_list in positions.items():
-        for pos in pos_list:
-            cur.execute(
-                "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
-                (str(group_id), pos.get('name'), pos.get('quantity'), pos.get('price')),
-            )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        conn.execute("BEGIN IMMEDIATE")
+        # Версия меняется у групп, у которых были или появятся позиции
+        cur.execute("SELECT DISTINCT group_id FROM positions")
+        changed_groups = {row[0] for row in cur.fetchall()} | {str(g) for g in positions}
+        # Удаляем все записи
+        cur.execute("DELETE FROM positions")
+        # Вставляем новые
+        rows: list[tuple] = []
+        for group_id, pos_list in positions.items():
+            rows.extend(_position_rows(group_id, pos_list))
+        cur.executemany(
+            "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        for group_id in _projection_groups(cur):
+            _rebuild_group(cur, group_id)
+        _bump_versions(cur, changed_groups)
     # Не обновляем in‑memory POSITIONS. Данные берутся строго из базы данных.
 
 def load_positions() -> dict[str, list]:
@@ -541,15 +1406,14 @@ def load_positions() -> dict[str, list]:
     Returns:
         dict[str, list]: словарь, где ключ — group_id, значение — список позиций.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT group_id, name, quantity, price FROM positions ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT group_id, name, quantity, price FROM positions ORDER BY id")
+        rows = cur.fetchall()
     result: dict[str, list] = {}
     for row in rows:
         g_id = str(row['group_id'])
-        item = {'name': row['name'], 'quantity': row['quantity'], 'price': row['price']}
+        item = {'name': row['name'], 'quantity': row['quantity'], 'price': from_kopecks(row['price'])}
         result.setdefault(g_id, []).append(item)
     return result
 
@@ -567,38 +1431,41 @@ def save_user(user_id: int, data: dict[str, Any]) -> None:
     В таблице accounts поле telegram_id используется для хранения строкового
     представления user_id, поэтому для обновления записи ищем по нему.
     Если запись существует, обновляем её; иначе вставляем новую.
-    После обновления синхронизируем глобальный словарь USERS.
+    После записи сбрасывается кэш проверки регистрации (``app.cache``).
     """
     # Извлекаем данные из словаря
     full_name = data.get('full_name') or data.get('fio')
     phone = data.get('phone') or data.get('phone_number')
     bank = data.get('bank')
     telegram_login = data.get('telegram_login')
+    telegram_login_cf = normalize_login(telegram_login)
     telegram_id = str(user_id)
 
     # Запись в базу данных
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Проверяем, существует ли пользователь по telegram_id
-    cur.execute("SELECT id FROM accounts WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    if row:
-        # Обновляем существующую запись
-        cur.execute(
-            "UPDATE accounts SET phone_number = ?, full_name = ?, telegram_login = ?, bank = ? WHERE telegram_id = ?",
-            (phone, full_name, telegram_login, bank, telegram_id),
-        )
-    else:
-        # Вставляем новую запись
-        cur.execute(
-            "INSERT INTO accounts (phone_number, full_name, telegram_login, bank, telegram_id) VALUES (?, ?, ?, ?, ?)",
-            (phone, full_name, telegram_login, bank, telegram_id),
-        )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Проверяем, существует ли пользователь по telegram_id
+        cur.execute("SELECT id FROM accounts WHERE telegram_id = ?", (telegram_id,))
+        row = cur.fetchone()
+        if row:
+            # Обновляем существующую запись
+            cur.execute(
+                "UPDATE accounts SET phone_number = ?, full_name = ?, telegram_login = ?, "
+                "telegram_login_cf = ?, bank = ? WHERE telegram_id = ?",
+                (phone, full_name, telegram_login, telegram_login_cf, bank, telegram_id),
+            )
+        else:
+            # Вставляем новую запись
+            cur.execute(
+                "INSERT INTO accounts (phone_number, full_name, telegram_login, telegram_login_cf, bank, telegram_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (phone, full_name, telegram_login, telegram_login_cf, bank, telegram_id),
+            )
 
-    # В этой версии данные пользователя хранятся только в базе данных. Никакие
-    # in‑memory словари не обновляются.
+    # В этой версии данные пользователя хранятся только в базе данных. Сбрасываем
+    # лишь закэшированный статус регистрации, чтобы middleware сразу увидело
+    # нового пользователя.
+    invalidate_user(user_id)
 
 
 def get_all_users():
@@ -608,11 +1475,10 @@ def get_all_users():
     содержит дополнительные элементы, они будут объединены с данными из базы.
     Возвращается итератор, совместимый с предыдущей версией.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, phone_number, full_name, bank, telegram_login FROM accounts")
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT telegram_id, phone_number, full_name, bank, telegram_login FROM accounts")
+        rows = cur.fetchall()
     result: list[tuple[int, dict[str, Any]]] = []
     for row in rows:
         try:
@@ -621,44 +1487,126 @@ def get_all_users():
             uid = None
         if uid is None:
             continue
-        user_dict: dict[str, Any] = {
-            'full_name': row['full_name'],
-            'phone': row['phone_number'],
-            'bank': row['bank'],
-        }
-        # telegram_login необязателен
-        if row['telegram_login']:
-            user_dict['telegram_login'] = row['telegram_login']
-        result.append((uid, user_dict))
+        result.append((uid, _user_from_row(row)))
     return result
 
+def _user_from_row(row: sqlite3.Row) -> dict[str, Any]:
+    """Собирает словарь профиля из строки таблицы accounts."""
+    user_dict: dict[str, Any] = {
+        'full_name': row['full_name'],
+        'phone': row['phone_number'],
+        'bank': row['bank'],
+    }
+    # telegram_login необязателен
+    if row['telegram_login']:
+        user_dict['telegram_login'] = row['telegram_login']
+    return user_dict
+
+
 def get_user(user_id: int) -> dict[str, Any] | None:
     """Возвращает профиль пользователя по его Telegram‑идентификатору.
 
-    Сначала пытается найти пользователя в базе данных (поле telegram_id).
-    Если не найден, возвращает данные из in‑memory словаря USERS, если они есть.
+    Если пользователь не найден в базе (поле telegram_id), возвращает None.
+    Для нескольких пользователей используйте get_users — один запрос вместо N.
     """
     telegram_id = str(user_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT phone_number, full_name, bank, telegram_login FROM accounts WHERE telegram_id = ?",
-        (telegram_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT phone_number, full_name, bank, telegram_login FROM accounts WHERE telegram_id = ?",
+            (telegram_id,),
+        )
+        row = cur.fetchone()
     if row:
-        user_dict: dict[str, Any] = {
-            'full_name': row['full_name'],
-            'phone': row['phone_number'],
-            'bank': row['bank'],
-        }
-        if row['telegram_login']:
-            user_dict['telegram_login'] = row['telegram_login']
-        return user_dict
+        return _user_from_row(row)
     # Если не найдено в базе, возвращаем None. Никакого fallback к in‑memory нет.
     return None
 
+
+# Не больше стольких параметров в одном IN (...) — с запасом до лимита SQLite
+_IN_CHUNK = 500
+
+
+def get_users(user_ids: Iterable[int]) -> dict[int, dict[str, Any]]:
+    """Возвращает профили сразу нескольких пользователей: {user_id: профиль}.
+
+    Профили читаются одним запросом ``telegram_id IN (...)`` (для очень
+    длинных списков — несколькими порциями по _IN_CHUNK). Незарегистрированных
+    пользователей в результате нет.
+    """
+    telegram_ids = sorted({str(int(uid)) for uid in user_ids})
+    result: dict[int, dict[str, Any]] = {}
+    if not telegram_ids:
+        return result
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for start in range(0, len(telegram_ids), _IN_CHUNK):
+            chunk = telegram_ids[start:start + _IN_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(
+                "SELECT telegram_id, phone_number, full_name, bank, telegram_login "
+                f"FROM accounts WHERE telegram_id IN ({placeholders})",
+                chunk,
+            )
+            for row in cur.fetchall():
+                result[int(row['telegram_id'])] = _user_from_row(row)
+    return result
+
+
+def resolve_logins(usernames: Iterable[str | None]) -> dict[str, int]:
+    """Находит Telegram‑id пользователей по их username: {username: telegram_id}.
+
+    Username сравниваются без учёта регистра и "@" (см. normalize_login) по
+    индексированному столбцу accounts.telegram_login_cf; все имена, которых
+    нет в кэше (``app.cache``), ищутся одним запросом. Если логин
+    встречается у нескольких записей, берётся самая ранняя. Ненайденных
+    имён в результате нет.
+    """
+    result: dict[str, int] = {}
+    pending: dict[str, list[str]] = {}
+    for name in usernames:
+        login_cf = normalize_login(name)
+        if login_cf is None:
+            continue
+        cached = get_login_id(login_cf)
+        if cached is MISSING:
+            pending.setdefault(login_cf, []).append(name)
+        elif cached is not None:
+            result[name] = cached
+    if not pending:
+        return result
+    found: dict[str, int] = {}
+    logins = list(pending)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for start in range(0, len(logins), _IN_CHUNK):
+            chunk = logins[start:start + _IN_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(
+                "SELECT telegram_login_cf, telegram_id FROM accounts "
+                f"WHERE telegram_login_cf IN ({placeholders}) ORDER BY id",
+                chunk,
+            )
+            for row in cur.fetchall():
+                try:
+                    found.setdefault(row['telegram_login_cf'], int(row['telegram_id']))
+                except (TypeError, ValueError):
+                    continue
+    for login_cf, names in pending.items():
+        user_id = found.get(login_cf)
+        remember_login_id(login_cf, user_id)
+        if user_id is not None:
+            for name in names:
+                result[name] = user_id
+    return result
+
+
+def resolve_login(username: str | None) -> int | None:
+    """Возвращает Telegram‑id пользователя по username (с "@" или без) или None."""
+    if not username:
+        return None
+    return resolve_logins([username]).get(username)
+
 def save_receipt(receipt_id: str, items: dict[str, float]) -> None:
     """Сохраняет информацию о чеке.
 
@@ -667,7 +1615,7 @@ def save_receipt(receipt_id: str, items: dict[str, float]) -> None:
     """
     pass
 
-def save_debts(receipt_id: str, mapping: dict[int, float]) -> None:
+def save_debts(receipt_id: str, mapping: dict[int, int]) -> None:
     """Сохраняет расчётные долги для указанного расчёта (чека).
 
     Каждая пара ``user_id → amount`` из переданного ``mapping`` вставляется
@@ -680,12 +1628,14 @@ def save_debts(receipt_id: str, mapping: dict[int, float]) -> None:
     Args:
         receipt_id: идентификатор расчёта/чека (обычно идентификатор
             группового чата).
-        mapping: отображение user_id → сумма долга. Значения суммы
-            округляются до двух знаков после запятой.
+        mapping: отображение user_id → сумма долга в копейках (как в
+            ``Settlement.debts``).
     """
-    # Открываем соединение с базой данных
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_connection() as conn:
+        _write_debts(conn.cursor(), receipt_id, mapping)
+
+
+def _write_debts(cur: sqlite3.Cursor, receipt_id: str, mapping: dict[int, int]) -> None:
     # Удаляем существующие записи для данного чека. Это обеспечивает,
     # что при повторном расчёте данные будут перезаписаны.
     cur.execute(
@@ -693,18 +1643,18 @@ def save_debts(receipt_id: str, mapping: dict[int, float]) -> None:
         (str(receipt_id),),
     )
     # Вставляем новые записи
+    rows = []
     for uid, amount in (mapping or {}).items():
         try:
             uid_str = str(uid)
-            amt = round(float(amount), 2)
+            amt = int(amount)
         except Exception:
             continue
-        cur.execute(
-            "INSERT INTO debts (receipt_id, user_tg_id, amount) VALUES (?, ?, ?)",
-            (str(receipt_id), uid_str, amt),
-        )
-    conn.commit()
-    conn.close()
+        rows.append((str(receipt_id), uid_str, amt))
+    cur.executemany(
+        "INSERT INTO debts (receipt_id, user_tg_id, amount) VALUES (?, ?, ?)",
+        rows,
+    )
 
 """
 In‑memory storage for users, receipts, positions and assignments.
@@ -741,7 +1691,7 @@ ASSIGNMENTS: dict[str, dict[int, list[int]]] = defaultdict(lambda: defaultdict(l
 # Сессии текстового расчёта: receipt_id -> {collecting: bool, messages: list[str]}
 TEXT_SESSIONS: dict[str, dict[str, object]] = defaultdict(lambda: {"collecting": False, "messages": []})
 
-def add_positions(group_id: str, new_positions: list) -> None:
+def add_positions(group_id: str, new_positions: list, receipt_scan_id: int | None = None) -> bool:
     """
     Добавляет новые позиции для указанной группы. Если группа уже существует, позиции
     добавляются в конец списка. После обновления данные сохраняются в файл.
@@ -749,18 +1699,32 @@ def add_positions(group_id: str, new_positions: list) -> None:
     Args:
         group_id: строковый идентификатор группы (например, chat.id в строковом виде).
         new_positions: список позиций (словари с полями name, quantity, price).
+        receipt_scan_id: распознанный чек (receipt_scans.id), из которого взяты
+            позиции. Если позиции этого чека в группе уже есть, ничего не
+            добавляется.
+
+    Returns:
+        bool: False, если чек уже был добавлен в группу.
     """
     # Сохраняем позиции в базу данных и обновляем in‑memory словарь.
     # Получаем соединение для выполнения транзакции.
-    conn = get_db_connection()
-    cur = conn.cursor()
-    for pos in new_positions:
-        cur.execute(
-            "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
-            (str(group_id), pos.get('name'), pos.get('quantity'), pos.get('price')),
+    # Проекции не меняются: на новые позиции ещё нет выборов.
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if receipt_scan_id is not None:
+            conn.execute("BEGIN IMMEDIATE")
+            cur.execute(
+                "SELECT 1 FROM positions WHERE group_id = ? AND receipt_scan_id = ? LIMIT 1",
+                (str(group_id), receipt_scan_id),
+            )
+            if cur.fetchone() is not None:
+                return False
+        cur.executemany(
+            "INSERT INTO positions (group_id, name, quantity, price, receipt_scan_id) VALUES (?, ?, ?, ?, ?)",
+            [row + (receipt_scan_id,) for row in _position_rows(group_id, new_positions)],
         )
-    conn.commit()
-    conn.close()
+        _bump_version(cur, group_id)
+    return True
     # Не обновляем in‑memory список POSITIONS. Данные берутся строго из базы.
 
 def get_positions(group_id: str | None = None) -> list:
@@ -774,32 +1738,32 @@ def get_positions(group_id: str | None = None) -> list:
     Returns:
         list: копия списка позиций.
     """
-    # Подключаемся к базе данных и создаём курсор
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if group_id is None:
+    # Берём соединение текущего потока и создаём курсор
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if group_id is not None:
+            return _read_positions(cur, group_id)
         cur.execute("SELECT group_id, name, quantity, price FROM positions ORDER BY id")
         rows = cur.fetchall()
-        # Закрываем соединение сразу после выборки
-        conn.close()
-        combined: list[dict] = []
-        for row in rows:
-            item = {'name': row['name'], 'quantity': row['quantity'], 'price': row['price']}
-            combined.append(item)
-        return combined
-    else:
-        cur.execute(
-            "SELECT name, quantity, price FROM positions WHERE group_id = ? ORDER BY id",
-            (str(group_id),),
-        )
-        rows = cur.fetchall()
-        # Закрываем соединение
-        conn.close()
-        result = [
-            {'name': row['name'], 'quantity': row['quantity'], 'price': row['price']}
-            for row in rows
-        ]
-        return result
+    combined: list[dict] = []
+    for row in rows:
+        item = {'name': row['name'], 'quantity': row['quantity'], 'price': from_kopecks(row['price'])}
+        combined.append(item)
+    return combined
+
+
+def _read_positions(cur: sqlite3.Cursor, group_id: str, with_ids: bool = False) -> list[dict]:
+    cur.execute(
+        "SELECT id, name, quantity, price FROM positions WHERE group_id = ? ORDER BY id",
+        (str(group_id),),
+    )
+    result = []
+    for row in cur.fetchall():
+        item = {'name': row['name'], 'quantity': row['quantity'], 'price': from_kopecks(row['price'])}
+        if with_ids:
+            item['id'] = row['id']
+        result.append(item)
+    return result
 
 def set_positions(group_id: str, positions: list) -> None:
     """
@@ -810,19 +1774,144 @@ def set_positions(group_id: str, positions: list) -> None:
         group_id: идентификатор группы.
         positions: новый список позиций.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM positions WHERE group_id = ?", (str(group_id),))
-    if positions:
-        for pos in positions:
-            cur.execute(
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM positions WHERE group_id = ?", (str(group_id),))
+        if positions:
+            cur.executemany(
                 "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
-                (str(group_id), pos.get('name'), pos.get('quantity'), pos.get('price')),
+                _position_rows(group_id, positions),
             )
-    conn.commit()
-    conn.close()
+        # Выборы ссылаются на удалённые позиции — распределение группы строится заново
+        _rebuild_group(cur, group_id)
+        _bump_version(cur, group_id)
     # Не обновляем in‑memory POSITIONS. Данные берутся из базы данных.
 
+def _scan_items(value: str) -> list[dict]:
+    return [
+        {'name': item['name'], 'quantity': item['quantity'], 'price': from_kopecks(item['price'])}
+        for item in json.loads(value)
+    ]
+
+
+def get_receipt_scan_by_file(file_unique_id: str) -> tuple[int, list[dict]] | None:
+    """
+    Ищет чек, уже распознанный по фотографии с этим file_unique_id Telegram.
+
+    Returns:
+        (id чека, позиции) или None. Позиции — словари name, quantity, price
+        (в рублях), как в get_positions.
+    """
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT s.id, s.items FROM receipt_files AS f "
+            "JOIN receipt_scans AS s ON s.id = f.scan_id WHERE f.file_unique_id = ?",
+            (file_unique_id,),
+        ).fetchone()
+    return (row['id'], _scan_items(row['items'])) if row is not None else None
+
+
+def find_receipt_scan(fiscal_key: str) -> tuple[int, list[dict]] | None:
+    """
+    Ищет уже распознанный чек по ключу фискального QR‑кода («ФН:ФД:ФП»).
+
+    Returns:
+        (id чека, позиции) или None.
+    """
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT id, items FROM receipt_scans WHERE fiscal_key = ?", (fiscal_key,)
+        ).fetchone()
+    return (row['id'], _scan_items(row['items'])) if row is not None else None
+
+
+def save_receipt_scan(
+    items: list,
+    fiscal_key: str | None = None,
+    file_unique_id: str | None = None,
+) -> int:
+    """
+    Сохраняет распознанный чек, возвращает его id.
+
+    Если чек с тем же ключом QR‑кода уже сохранён (его распознали
+    параллельно), возвращается id сохранённого.
+    """
+    value = json.dumps(
+        [
+            {'name': pos.get('name'), 'quantity': pos.get('quantity'), 'price': to_kopecks(pos.get('price'))}
+            for pos in items
+        ],
+        ensure_ascii=False,
+    )
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR IGNORE INTO receipt_scans (fiscal_key, items) VALUES (?, ?)",
+            (fiscal_key or None, value),
+        )
+        if cur.rowcount:
+            scan_id = cur.lastrowid
+        else:
+            cur.execute("SELECT id FROM receipt_scans WHERE fiscal_key = ?", (fiscal_key,))
+            scan_id = cur.fetchone()[0]
+        if file_unique_id:
+            _link_receipt_file(cur, file_unique_id, scan_id)
+    return scan_id
+
+
+def link_receipt_file(file_unique_id: str, scan_id: int) -> None:
+    """Запоминает, что фотография с file_unique_id — уже распознанный чек scan_id."""
+    with db_connection() as conn:
+        _link_receipt_file(conn.cursor(), file_unique_id, scan_id)
+
+
+def _link_receipt_file(cur: sqlite3.Cursor, file_unique_id: str, scan_id: int) -> None:
+    cur.execute(
+        "INSERT OR REPLACE INTO receipt_files (file_unique_id, scan_id) VALUES (?, ?)",
+        (file_unique_id, scan_id),
+    )
+
+def get_llm_response(key: str) -> tuple[str, float] | None:
+    """Возвращает (ответ в JSON, длительность исходного запроса в мс) или None."""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT value, latency_ms FROM llm_cache WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+    return (row['value'], row['latency_ms']) if row is not None else None
+
+
+def put_llm_response(key: str, value: str, latency_ms: float, ttl: float) -> None:
+    """Сохраняет ответ LLM на ttl секунд."""
+    with db_connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, latency_ms, expires_at) VALUES (?, ?, ?, ?)",
+            (key, value, latency_ms, time.time() + ttl),
+        )
+
+
+def prune_llm_responses(max_rows: int) -> int:
+    """
+    Удаляет устаревшие ответы и самые старые сверх max_rows.
+
+    Returns:
+        int: число удалённых записей.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+        deleted = cur.rowcount
+        # Время жизни у всех записей одинаковое: раньше истекают самые старые
+        cur.execute(
+            "SELECT expires_at FROM llm_cache ORDER BY expires_at DESC LIMIT 1 OFFSET ?",
+            (max_rows,),
+        )
+        row = cur.fetchone()
+        if row is not None:
+            cur.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (row[0],))
+            deleted += cur.rowcount
+    return deleted
+
 def init_assignments(receipt_id: str) -> None:
     """Initialise (or reset) the assignments mapping for a given receipt."""
     ASSIGNMENTS[receipt_id] = defaultdict(list)
@@ -869,26 +1958,57 @@ def add_payment(group_id: str, tg_user_id: int, amount: float, positions: list[d
                    Если передан список, он будет сериализован в JSON. Если передана строка,
                    она будет сохранена как есть. Если None, поле positions будет NULL.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Преобразуем positions в строку, если необходимо
-    pos_value: str | None
+    add_payments(group_id, [(tg_user_id, amount, positions)])
+
+
+def _payment_positions_value(positions: list[dict] | str | None) -> str | None:
+    """Преобразует описание платежа в значение поля payments.positions."""
     if positions is None:
-        pos_value = None
-    elif isinstance(positions, str):
-        pos_value = positions
-    else:
-        try:
-            pos_value = json.dumps(positions, ensure_ascii=False)
-        except Exception:
-            # В случае ошибки сериализации сохраняем строковое представление
-            pos_value = str(positions)
-    cur.execute(
-        "INSERT INTO payments (tg_user_id, group_id, amount, positions) VALUES (?, ?, ?, ?)",
-        (str(tg_user_id), str(group_id), float(amount), pos_value),
-    )
-    conn.commit()
-    conn.close()
+        return None
+    if isinstance(positions, str):
+        return positions
+    try:
+        return json.dumps(positions, ensure_ascii=False)
+    except Exception:
+        # В случае ошибки сериализации сохраняем строковое представление
+        return str(positions)
+
+
+def add_payments(
+    group_id: str,
+    payments: list[tuple[int, float, list[dict] | str | None]],
+) -> None:
+    """
+    Добавляет несколько платежей одной транзакцией.
+
+    Используется, когда в одном сообщении перечислено сразу несколько
+    платежей: все записи вставляются одним executemany и фиксируются
+    вместе — либо сохраняются все, либо ни одного.
+
+    Args:
+        group_id: Идентификатор группы (чата).
+        payments: Список кортежей (tg_user_id, amount, positions): сумма в
+                  рублях, поле positions имеет тот же смысл, что и в add_payment().
+    """
+    rows = [
+        (str(tg_user_id), str(group_id), to_kopecks(amount), _payment_positions_value(positions))
+        for tg_user_id, amount, positions in payments
+    ]
+    if not rows:
+        return
+    with db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO payments (tg_user_id, group_id, amount, positions) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        conn.executemany(
+            "INSERT INTO group_balances (group_id, user_id, paid, payments) "
+            "VALUES (?, CAST(? AS INTEGER), COALESCE(?, 0), 1) "
+            "ON CONFLICT (group_id, user_id) DO UPDATE SET paid = paid + excluded.paid, "
+            "payments = payments + 1",
+            [(group, uid, amount) for uid, group, amount, _positions in rows],
+        )
+        _bump_version(conn.cursor(), group_id)
 
 
 def get_payments(group_id: str) -> dict[int, float]:
@@ -899,27 +2019,26 @@ def get_payments(group_id: str) -> dict[int, float]:
         group_id: Идентификатор группы (чата).
 
     Returns:
-        dict[int, float]: отображение user_id → суммарная сумма платежей.
+        dict[int, float]: отображение user_id → суммарная сумма платежей в рублях.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT tg_user_id, SUM(amount) AS total_amount FROM payments WHERE group_id = ? GROUP BY tg_user_id",
-        (str(group_id),),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT tg_user_id, SUM(amount) AS total_amount FROM payments WHERE group_id = ? GROUP BY tg_user_id",
+            (str(group_id),),
+        )
+        rows = cur.fetchall()
     result: dict[int, float] = {}
     for row in rows:
         uid_raw = row["tg_user_id"]
-        total = row["total_amount"] or 0.0
+        total = row["total_amount"] or 0
         try:
             uid = int(uid_raw) if uid_raw is not None else None
         except Exception:
             uid = None
         if uid is None:
             continue
-        result[uid] = float(total)
+        result[uid] = from_kopecks(total)
     return result
 
 
@@ -927,46 +2046,43 @@ def get_unassigned_positions(group_id: str) -> list[dict]:
     """
     Проверяет, все ли позиции из чека распределены участниками.
 
-    Для каждой исходной позиции из таблицы positions сравнивается исходное
-    количество (quantity) с суммарным количеством, выбранным участниками
-    (selected_positions). Если выбранное количество меньше исходного,
-    позиция считается неразделённой. Возвращает список таких позиций
-    с указанием оставшегося количества.
+    Для каждой исходной позиции из таблицы positions исходное количество
+    (quantity) сравнивается с суммой явно выбранных количеств по этой
+    позиции (selected_positions.position_id). Позиция, у которой есть хотя
+    бы одна отметка «поровну» (quantity < 0), распределена целиком: её
+    остаток делится между отметившими. Подсчёт выполняется одним
+    агрегирующим запросом.
 
     Args:
         group_id: Идентификатор группы.
 
     Returns:
         list[dict]: список словарей {"name": str, "quantity": float, "price": float}
-        для неразделённых позиций. Если все позиции распределены, список пуст.
-    """
-    # Загружаем исходные позиции из базы
-    original_positions = get_positions(group_id) or []
-    # Загружаем выбранные позиции пользователей
-    selections = get_selected_positions(group_id) or {}
-    # Суммируем выбранные количества для каждой позиции по ключу (name, price)
-    selected_qty: dict[tuple[str, float], float] = {}
-    for pos_list in selections.values():
-        for pos in pos_list:
-            key = (pos.get("name"), float(pos.get("price", 0)))
-            qty = float(pos.get("quantity", 0))
-            selected_qty[key] = selected_qty.get(key, 0.0) + qty
-    unassigned: list[dict] = []
-    for orig in original_positions:
-        key = (orig.get("name"), float(orig.get("price", 0)))
-        orig_qty = float(orig.get("quantity", 0))
-        # Сколько уже выбрали
-        chosen = selected_qty.get(key, 0.0)
-        remaining = orig_qty - chosen
-        # Считаем, что погрешности менее 0.01 можно игнорировать
-        if remaining > 0.01:
-            # Добавляем позицию с оставшимся количеством и той же ценой
-            unassigned.append({
-                "name": orig.get("name"),
-                "quantity": round(remaining, 2),
-                "price": float(orig.get("price", 0)),
-            })
-    return unassigned
+        для неразделённых позиций в порядке чека. Если все позиции
+        распределены, список пуст.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT p.name,
+                   p.price,
+                   COALESCE(p.quantity, 0) - TOTAL(CASE WHEN sp.quantity > 0 THEN sp.quantity END) AS remaining
+            FROM positions AS p
+            LEFT JOIN selected_positions AS sp ON sp.position_id = p.id AND sp.group_id = p.group_id
+            WHERE p.group_id = ?
+            GROUP BY p.id
+            HAVING NOT TOTAL(sp.quantity < 0) AND remaining > 0.01
+            ORDER BY p.id
+            """,
+            (str(group_id),),
+        )
+        rows = cur.fetchall()
+    # Погрешности менее 0.01 игнорируются (условие в HAVING)
+    return [
+        {"name": row["name"], "quantity": round(row["remaining"], 2), "price": from_kopecks(row["price"])}
+        for row in rows
+    ]
 
 # ---------------------------------------------------------------------------
 # Вспомогательные функции для архивации и очистки данных после клиринга
@@ -983,30 +2099,29 @@ def archive_group_data(group_id: str) -> None:
     Args:
         group_id: Идентификатор группы (чата).
     """
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        # Копируем позиции
-        cur.execute(
-            "INSERT INTO archived_positions (group_id, name, quantity, price) "
-            "SELECT group_id, name, quantity, price FROM positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        # Копируем выбранные позиции
-        cur.execute(
-            "INSERT INTO archived_selected_positions (group_id, user_tg_id, position_id, quantity, price) "
-            "SELECT group_id, user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        # Копируем платежи
-        cur.execute(
-            "INSERT INTO archived_payments (tg_user_id, group_id, amount, positions) "
-            "SELECT tg_user_id, group_id, amount, positions FROM payments WHERE group_id = ?",
-            (str(group_id),),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        _archive_group(conn.cursor(), group_id)
+
+
+def _archive_group(cur: sqlite3.Cursor, group_id: str) -> None:
+    # Копируем позиции
+    cur.execute(
+        "INSERT INTO archived_positions (group_id, name, quantity, price) "
+        "SELECT group_id, name, quantity, price FROM positions WHERE group_id = ?",
+        (str(group_id),),
+    )
+    # Копируем выбранные позиции
+    cur.execute(
+        "INSERT INTO archived_selected_positions (group_id, user_tg_id, position_id, quantity, price) "
+        "SELECT group_id, user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
+        (str(group_id),),
+    )
+    # Копируем платежи
+    cur.execute(
+        "INSERT INTO archived_payments (tg_user_id, group_id, amount, positions) "
+        "SELECT tg_user_id, group_id, amount, positions FROM payments WHERE group_id = ?",
+        (str(group_id),),
+    )
 
 
 def clear_group_data(group_id: str) -> None:
@@ -1019,186 +2134,368 @@ def clear_group_data(group_id: str) -> None:
     Args:
         group_id: Идентификатор группы (чата).
     """
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM positions WHERE group_id = ?", (str(group_id),))
-        cur.execute("DELETE FROM selected_positions WHERE group_id = ?", (str(group_id),))
-        cur.execute("DELETE FROM payments WHERE group_id = ?", (str(group_id),))
-        conn.commit()
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        _clear_group(conn.cursor(), group_id)
 
 
-def calculate_group_balance(group_id: str) -> list[tuple[int, int, float]]:
+def _clear_group(cur: sqlite3.Cursor, group_id: str) -> None:
+    cur.execute("DELETE FROM positions WHERE group_id = ?", (str(group_id),))
+    cur.execute("DELETE FROM selected_positions WHERE group_id = ?", (str(group_id),))
+    cur.execute("DELETE FROM payments WHERE group_id = ?", (str(group_id),))
+    cur.execute("DELETE FROM position_allocations WHERE group_id = ?", (str(group_id),))
+    cur.execute("DELETE FROM group_balances WHERE group_id = ?", (str(group_id),))
+    _bump_version(cur, group_id)
+
+
+def load_group_snapshot(group_id: str) -> tuple[list[sqlite3.Row], list[sqlite3.Row], list[sqlite3.Row]]:
     """
-    Рассчитывает оптимальные переводы между участниками, чтобы покрыть
-    расходы, исходя из выбранных позиций и внесённых платежей.
+    Загружает сырые строки, необходимые для расчёта по группе.
 
-    Алгоритм:
-      1. Подсчитать стоимость выбранных позиций для каждого пользователя.
-      2. Подсчитать, сколько каждый пользователь заплатил (payments).
-      3. Для каждого участника вычислить баланс: balance = paid - cost.
-         Положительный баланс означает, что пользователь должен получить
-         деньги; отрицательный — что он должен заплатить.
-      4. Построить список минимального количества переводов между
-         должниками и кредиторами. Каждый элемент списка имеет вид
-         (debtor_id, creditor_id, amount), что означает, что должник
-         debtor_id должен перевести amount рублей кредитору creditor_id.
+    Все запросы выполняются в одной читающей транзакции, поэтому позиции,
+    выборы и платежи согласованы между собой (в режиме WAL запись из
+    другого соединения между запросами не видна). Разбор строк и сам
+    расчёт выполняет модуль ``app.settlement``.
 
     Args:
-        group_id: Идентификатор группы.
+        group_id: Идентификатор группы (чата).
 
     Returns:
-        list[tuple[int, int, float]]: список переводов. Может быть пустым,
-        если нет долгов или все балансы нулевые.
-    """
-    # 1. Считаем стоимость выбранных позиций для каждого пользователя.
-    #    В этой версии учитываем как ручные выборы, так и отметки «поровну».
-    #    Отметка «поровну» передаётся как отрицательное количество в таблице
-    #    selected_positions. Для корректного расчёта нам необходимо
-    #    знать исходное количество позиции (positions.quantity), чтобы
-    #    определить, какая часть остаётся на равное деление.
-    cost_map: dict[int, float] = {}
-    # Загружаем исходные позиции для группы: id → (qty, price)
-    conn = get_db_connection()
-    cur = conn.cursor()
+        tuple: (строки positions с полями id, quantity, price;
+        строки selected_positions с полями user_tg_id, position_id, quantity, price;
+        строки payments с полями tg_user_id, total_amount). Цены и суммы —
+        в копейках.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN")
+        return _read_group_snapshot(conn.cursor(), group_id)
+
+
+def _read_group_snapshot(
+    cur: sqlite3.Cursor, group_id: str
+) -> tuple[list[sqlite3.Row], list[sqlite3.Row], list[sqlite3.Row]]:
     cur.execute(
         "SELECT id, quantity, price FROM positions WHERE group_id = ?",
         (str(group_id),),
     )
     pos_rows = cur.fetchall()
-    positions_map: dict[int, dict[str, float]] = {}
-    for row in pos_rows:
-        try:
-            pid = row["id"]
-            qty = float(row["quantity"] or 0)
-            price = float(row["price"] or 0)
-            positions_map[pid] = {"quantity": qty, "price": price}
-        except Exception:
-            pass
-    # Загружаем выбранные позиции
     cur.execute(
         "SELECT user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
         (str(group_id),),
     )
     sp_rows = cur.fetchall()
-    conn.close()
-    # Группируем выборы по позиции
-    selections_by_pos: dict[int | None, list[tuple[int, float, float]]] = {}
-    for row in sp_rows:
-        try:
-            uid_raw = row["user_tg_id"]
-            uid = int(uid_raw) if uid_raw is not None else None
-        except Exception:
-            uid = None
-        if uid is None:
-            continue
-        pos_id = row["position_id"]  # может быть None
-        qty_raw = row["quantity"]
-        try:
-            qty = float(qty_raw or 0)
-        except Exception:
-            qty = 0.0
-        price = None
-        try:
-            price = float(row["price"] or 0)
-        except Exception:
-            price = 0.0
-        selections_by_pos.setdefault(pos_id, []).append((uid, qty, price))
-    # Расчёт стоимости по каждому выбору
-    for pos_id, sel_list in selections_by_pos.items():
-        # Если позиция ссылается на запись в positions, используем её
-        if pos_id is not None and pos_id in positions_map:
-            orig = positions_map[pos_id]
-            total_qty = float(orig.get("quantity", 0))
-            price = float(orig.get("price", 0))
-            # Суммируем ручные количества и собираем пользователей, выбравших поровну
-            manual_sum = 0.0
-            equal_users: list[int] = []
-            for uid, qty, _price in sel_list:
-                if qty is None:
-                    continue
-                try:
-                    qval = float(qty)
-                except Exception:
-                    qval = 0.0
-                if qval >= 0:
-                    manual_sum += qval
-                else:
-                    equal_users.append(uid)
-            # Расходы по ручным выбором
-            for uid, qty, _price in sel_list:
-                if qty is None:
-                    continue
-                try:
-                    qval = float(qty)
-                except Exception:
-                    qval = 0.0
-                if qval > 0:
-                    cost_map[uid] = cost_map.get(uid, 0.0) + qval * price
-            # Расходы по отметкам «поровну»
-            leftover = max(total_qty - manual_sum, 0.0)
-            if equal_users:
-                share = leftover / len(equal_users)
-                for uid in equal_users:
-                    cost_map[uid] = cost_map.get(uid, 0.0) + share * price
-        else:
-            # Позиция не сопоставлена с исходными записями (position_id = NULL).
-            # Считаем стоимость как qty * price. Отрицательные количества
-            # игнорируем (неизвестный механизм «поровну» без исходного qty).
-            for uid, qty, price in sel_list:
-                try:
-                    qval = float(qty)
-                except Exception:
-                    qval = 0.0
-                try:
-                    pval = float(price)
-                except Exception:
-                    pval = 0.0
-                if qval > 0:
-                    cost_map[uid] = cost_map.get(uid, 0.0) + qval * pval
-    # 2. Считаем внесённые платежи
-    payments_map = get_payments(group_id) or {}
-    # 3. Список всех участников (те, кто что‑то выбрал или оплатил)
-    all_users: set[int] = set(cost_map.keys()) | set(payments_map.keys())
-    # 3. Вычисляем баланс для каждого участника
-    balances: dict[int, float] = {}
-    for uid in all_users:
-        paid = payments_map.get(uid, 0.0)
-        cost = cost_map.get(uid, 0.0)
-        balances[uid] = round(paid - cost, 2)
-    # 4. Формируем списки должников и кредиторов
-    debtors: list[list] = []  # [user_id, amount_owed]
-    creditors: list[list] = []  # [user_id, amount_to_receive]
-    for uid, bal in balances.items():
-        if bal < -0.01:  # должен
-            debtors.append([uid, round(-bal, 2)])
-        elif bal > 0.01:  # кредитор
-            creditors.append([uid, round(bal, 2)])
-    # Сортируем по сумме, чтобы оптимизировать количество переводов
-    debtors.sort(key=lambda x: x[1], reverse=True)
-    creditors.sort(key=lambda x: x[1], reverse=True)
-    transfers: list[tuple[int, int, float]] = []
-    i = 0
-    j = 0
-    # Используем два указателя для прохода по спискам
-    while i < len(debtors) and j < len(creditors):
-        d_uid, d_amount = debtors[i]
-        c_uid, c_amount = creditors[j]
-        # Определяем сумму перевода
-        transfer_amount = round(min(d_amount, c_amount), 2)
-        if transfer_amount <= 0:
-            # Если что‑то пошло не так, просто выходим
-            break
-        transfers.append((d_uid, c_uid, transfer_amount))
-        # Обновляем остатки
-        debtors[i][1] = round(d_amount - transfer_amount, 2)
-        creditors[j][1] = round(c_amount - transfer_amount, 2)
-        # Если должник погасил долг, переходим к следующему должнику
-        if debtors[i][1] <= 0.01:
-            i += 1
-        # Если кредитор получил всё, переходим к следующему кредитору
-        if creditors[j][1] <= 0.01:
-            j += 1
-    return transfers
\ No newline at end of file
+    cur.execute(
+        "SELECT tg_user_id, SUM(amount) AS total_amount FROM payments WHERE group_id = ? GROUP BY tg_user_id",
+        (str(group_id),),
+    )
+    pay_rows = cur.fetchall()
+    return pos_rows, sp_rows, pay_rows
+
+
+def load_group_balances(group_id: str) -> tuple[int, list[sqlite3.Row]]:
+    """
+    Возвращает стоимость выбранных позиций, платежи и баланс каждого
+    участника группы из проекции group_balances — без пересчёта выборов.
+
+    Args:
+        group_id: Идентификатор группы (чата).
+
+    Returns:
+        tuple: (число позиций чека в группе; строки с полями user_id, cost,
+        paid, balance, charged, payer, selector в порядке user_id). Суммы —
+        в копейках.
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN")
+        return _read_group_balances(conn.cursor(), group_id)
+
+
+def load_group_check(
+    group_id: str,
+) -> tuple[tuple[int, list[sqlite3.Row]], tuple[list[sqlite3.Row], list[sqlite3.Row], list[sqlite3.Row]]]:
+    """
+    Загружает проекцию group_balances и сырые строки группы в одной читающей
+    транзакции — для сверки (``settlement.check_group_balances``): запись
+    между двумя отдельными чтениями выглядела бы как расхождение.
+
+    Returns:
+        tuple: (результат load_group_balances, результат load_group_snapshot).
+    """
+    with db_connection() as conn:
+        conn.execute("BEGIN")
+        cur = conn.cursor()
+        return _read_group_balances(cur, group_id), _read_group_snapshot(cur, group_id)
+
+
+def _read_group_balances(cur: sqlite3.Cursor, group_id: str) -> tuple[int, list[sqlite3.Row]]:
+    cur.execute("SELECT COUNT(*) FROM positions WHERE group_id = ?", (str(group_id),))
+    position_count = cur.fetchone()[0]
+    cur.execute(
+        "SELECT user_id, cost, paid, paid - cost AS balance, charges > 0 AS charged, "
+        "payments > 0 AS payer, selections > 0 AS selector "
+        "FROM group_balances WHERE group_id = ? ORDER BY user_id",
+        (str(group_id),),
+    )
+    return position_count, cur.fetchall()
+
+
+def get_position_allocations(group_id: str) -> dict[int, dict[int, int]]:
+    """
+    Возвращает стоимость позиций для каждого участника группы.
+
+    Args:
+        group_id: Идентификатор группы (чата).
+
+    Returns:
+        dict[int, dict[int, int]]: user_id → {position_id → стоимость в
+        копейках}. position_id = 0 — выборы без позиции в чеке.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id, position_id, cost FROM position_allocations WHERE group_id = ?",
+            (str(group_id),),
+        )
+        rows = cur.fetchall()
+    result: dict[int, dict[int, int]] = {}
+    for row in rows:
+        result.setdefault(row["user_id"], {})[row["position_id"]] = row["cost"]
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Поддержка проекций position_allocations и group_balances
+# ---------------------------------------------------------------------------
+# Функции вызываются внутри транзакции функции записи, поэтому проекции
+# меняются вместе с исходными строками. Стоимость «поровну» зависит от
+# всех выборов позиции, поэтому пересчитывается распределение затронутых
+# позиций целиком, а в group_balances переносится только разница.
+
+def _rebuild_group(cur: sqlite3.Cursor, group_id: str) -> None:
+    """Строит проекции группы заново по текущим позициям, выборам и платежам."""
+    params = {"group_id": str(group_id)}
+    cur.execute("DELETE FROM position_allocations WHERE group_id = :group_id", params)
+    cur.execute("DELETE FROM group_balances WHERE group_id = :group_id", params)
+    cur.execute(_ALLOCATIONS_SQL.format(where="sp.group_id = :group_id"), params)
+    cur.execute(_BALANCES_SQL.format(where="group_id = :group_id"), params)
+
+
+def _allocation_totals(cur: sqlite3.Cursor, id_filter: str, params: dict) -> dict[int, tuple[int, int, int]]:
+    cur.execute(
+        "SELECT user_id, SUM(cost), SUM(charges), SUM(selections) FROM position_allocations "
+        f"WHERE group_id = :group_id AND position_id IN ({id_filter}) GROUP BY user_id",
+        params,
+    )
+    return {row[0]: (row[1], row[2], row[3]) for row in cur.fetchall()}
+
+
+def _refresh_positions(cur: sqlite3.Cursor, group_id: str, position_ids: Iterable[int | None]) -> None:
+    """
+    Пересчитывает распределение позиций position_ids (значения
+    selected_positions.position_id затронутых строк) и обновляет балансы
+    участников на разницу.
+
+    Если среди значений есть NULL или id, которого нет среди позиций группы,
+    такие выборы учитываются под position_id = 0 вместе со всеми прочими
+    выборами без позиции, и группа перестраивается целиком.
+    """
+    ids = sorted(set(position_ids), key=lambda value: (value is None, value))
+    if not ids:
+        return
+    if ids[-1] is None:
+        _rebuild_group(cur, group_id)
+        return
+    deltas: dict[int, list[int]] = {}
+    # Позиции распределяются независимо, поэтому длинный список
+    # пересчитывается порциями по _IN_CHUNK
+    for start in range(0, len(ids), _IN_CHUNK):
+        chunk = ids[start:start + _IN_CHUNK]
+        params: dict[str, Any] = {"group_id": str(group_id)}
+        params.update((f"p{i}", position_id) for i, position_id in enumerate(chunk))
+        id_filter = ", ".join(f":p{i}" for i in range(len(chunk)))
+        cur.execute(
+            f"SELECT COUNT(*) FROM positions WHERE group_id = :group_id AND id IN ({id_filter})",
+            params,
+        )
+        if cur.fetchone()[0] != len(chunk):
+            _rebuild_group(cur, group_id)
+            return
+        before = _allocation_totals(cur, id_filter, params)
+        cur.execute(
+            f"DELETE FROM position_allocations WHERE group_id = :group_id AND position_id IN ({id_filter})",
+            params,
+        )
+        # Унарный «+» не даёт планировщику выбрать индекс по group_id: строки
+        # нужных позиций быстрее найти по индексу position_id, чем перебирать
+        # все выборы группы.
+        cur.execute(
+            _ALLOCATIONS_SQL.format(where=f"sp.position_id IN ({id_filter}) AND +sp.group_id = :group_id"),
+            params,
+        )
+        after = _allocation_totals(cur, id_filter, params)
+        for uid in before.keys() | after.keys():
+            old = before.get(uid, (0, 0, 0))
+            new = after.get(uid, (0, 0, 0))
+            total = deltas.setdefault(uid, [0, 0, 0])
+            for k in range(3):
+                total[k] += new[k] - old[k]
+    rows = [(str(group_id), uid, *delta) for uid, delta in deltas.items() if any(delta)]
+    if not rows:
+        return
+    cur.executemany(
+        "INSERT INTO group_balances (group_id, user_id, cost, charges, selections) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (group_id, user_id) DO UPDATE SET cost = cost + excluded.cost, "
+        "charges = charges + excluded.charges, selections = selections + excluded.selections",
+        rows,
+    )
+    _drop_empty_balances(cur, group_id)
+
+
+def _drop_empty_balances(cur: sqlite3.Cursor, group_id: str) -> None:
+    # Участник, у которого не осталось ни выборов, ни платежей, не участвует в расчёте
+    cur.execute(
+        "DELETE FROM group_balances WHERE group_id = ? AND selections = 0 AND payments = 0",
+        (str(group_id),),
+    )
+
+
+def rebuild_group_balances(group_id: str | None = None) -> list[str]:
+    """
+    Перестраивает проекции position_allocations и group_balances из
+    позиций, выборов и платежей.
+
+    Args:
+        group_id: Идентификатор группы; None — все группы, у которых есть
+            выборы, платежи или строки проекций.
+
+    Returns:
+        list[str]: идентификаторы перестроенных групп.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        conn.execute("BEGIN IMMEDIATE")
+        group_ids = [str(group_id)] if group_id is not None else _projection_groups(cur)
+        for gid in group_ids:
+            _rebuild_group(cur, gid)
+    return group_ids
+
+
+def _projection_groups(cur: sqlite3.Cursor) -> list[str]:
+    cur.execute(
+        "SELECT group_id FROM selected_positions UNION SELECT group_id FROM payments "
+        "UNION SELECT group_id FROM group_balances"
+    )
+    return [row[0] for row in cur.fetchall() if row[0] is not None]
+
+
+def projection_groups() -> list[str]:
+    """Группы, для которых есть выборы, платежи или строки проекций."""
+    with db_connection() as conn:
+        return _projection_groups(conn.cursor())
+
+
+def calculate_group_balance(group_id: str) -> list[tuple[int, int, float]]:
+    """
+    Рассчитывает оптимальные переводы между участниками, чтобы покрыть
+    расходы, исходя из выбранных позиций и внесённых платежей.
+
+    Обёртка над ``app.settlement.settle_group``; если помимо переводов
+    нужны стоимости и балансы, используйте settle_group напрямую.
+
+    Args:
+        group_id: Идентификатор группы.
+
+    Returns:
+        list[tuple[int, int, float]]: список переводов (debtor_id,
+        creditor_id, amount в рублях). Может быть пустым, если нет долгов
+        или все балансы нулевые.
+    """
+    # Импорт внутри функции: модуль settlement сам импортирует database.
+    from app.settlement import settle_group
+
+    return [
+        (debtor_id, creditor_id, from_kopecks(amount))
+        for debtor_id, creditor_id, amount in settle_group(group_id).transfers
+    ]
+
+
+def finalize_group(group_id: str, receipt_id: str, request_key: str):
+    """
+    Завершает расчёт по группе одной транзакцией BEGIN IMMEDIATE.
+
+    В одной транзакции читаются балансы участников (проекция
+    group_balances), строятся переводы, записываются долги (debts), данные переносятся в
+    архив и удаляются из рабочих таблиц, а в журнал finalizations
+    заносится request_key. Выбор или платёж, сохранённый другим
+    соединением во время расчёта, либо попадёт в расчёт и архив целиком,
+    либо дождётся окончания транзакции и останется в рабочих таблицах
+    для следующего расчёта — удалённым без архива он оказаться не может.
+
+    Операция идемпотентна по request_key: если расчёт с таким ключом уже
+    выполнен, база не изменяется.
+
+    Args:
+        group_id: Идентификатор группы (чата).
+        receipt_id: Идентификатор расчёта, под которым сохраняются долги.
+        request_key: Ключ идемпотентности (например, "<chat_id>:<message_id>").
+
+    Returns:
+        app.settlement.FinalizeResult: статус ("done", "duplicate",
+        "no_positions", "no_participants") и результат расчёта.
+    """
+    # Импорт внутри функции: модуль settlement сам импортирует database.
+    from app.settlement import FinalizeResult, settle_rows
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT 1 FROM finalizations WHERE request_key = ?", (request_key,))
+        if cur.fetchone():
+            metrics.incr("finalize.duplicate")
+            return FinalizeResult("duplicate")
+        settlement = settle_rows(group_id, *_read_group_balances(cur, group_id))
+        if not settlement.position_count:
+            return FinalizeResult("no_positions", settlement)
+        if not settlement.participants:
+            return FinalizeResult("no_participants", settlement)
+        _write_debts(cur, receipt_id, settlement.debts)
+        _archive_group(cur, group_id)
+        _clear_group(cur, group_id)
+        cur.execute(
+            "INSERT INTO finalizations (request_key, group_id, receipt_id, transfers) VALUES (?, ?, ?, ?)",
+            (request_key, str(group_id), str(receipt_id), json.dumps(settlement.transfers)),
+        )
+        conn.commit()
+        metrics.observe("finalize.transaction_ms", (time.perf_counter() - started) * 1000)
+        metrics.incr("finalize.done")
+    return FinalizeResult("done", settlement)
+
+
+# ---------------------------------------------------------------------------
+# Просмотр содержимого таблиц (отладочные команды бота)
+# ---------------------------------------------------------------------------
+
+# Таблицы, доступные для просмотра, и выводимые столбцы.
+DEBUG_TABLES: dict[str, list[str]] = {
+    "accounts": ["id", "phone_number", "full_name", "telegram_login", "bank", "telegram_id"],
+    "positions": ["id", "group_id", "name", "quantity", "price"],
+    "selected_positions": ["id", "group_id", "user_tg_id", "position_id", "quantity", "price"],
+    "payments": ["id", "tg_user_id", "group_id", "amount", "positions"],
+    "debts": ["id", "receipt_id", "user_tg_id", "amount", "created_at"],
+}
+
+
+def fetch_table(table: str) -> tuple[list[str], list[sqlite3.Row]]:
+    """
+    Возвращает столбцы и все строки одной из таблиц DEBUG_TABLES.
+
+    Args:
+        table: имя таблицы (только из DEBUG_TABLES).
+
+    Returns:
+        tuple[list[str], list[sqlite3.Row]]: названия столбцов и строки в порядке id.
+    """
+    columns = DEBUG_TABLES[table]
+    with db_connection() as conn:
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id").fetchall()
+    return columns, rows
@@ -8,9 +8,7 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 
 from config import settings
-from app.database import save_user
-
-from app.database import get_all_users, get_user
+from app import async_database as db, metrics
 
 
 router = Router(name="auth")
@@ -62,10 +60,10 @@ async def process_bank(msg: Message, state: FSMContext):
     })
 
     # Проверка: если уже есть — не сохраняем дубликат
-    if get_user(user_id) is None:
+    if await db.get_user(user_id) is None:
         # Данные из FSM + последний выбор банка
         data.update({"bank": msg.text})
-        save_user(user_id, data)
+        await db.save_user(user_id, data)
 
     await msg.answer("✅ Регистрация завершена! Для того чтобы мной воспользоваться необходимо создать группу, добавить меня и сделать администратором. После этого можете отправлять мне чеки.", reply_markup=ReplyKeyboardRemove())
     await state.clear()
@@ -74,7 +72,7 @@ async def process_bank(msg: Message, state: FSMContext):
 
 @router.message(Command("show_users"))
 async def cmd_show_users(msg: Message):
-    users = list(get_all_users())
+    users = list(await db.get_all_users())
     if not users:
         await msg.answer("Нет зарегистрированных пользователей.")
         return
@@ -90,3 +88,47 @@ async def cmd_show_users(msg: Message):
         "---"
     )
     await msg.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("metrics"))
+async def cmd_metrics(msg: Message):
+    """Показывает внутренние метрики бота (только администратору)."""
+    if not settings.admin_id or msg.from_user.id != settings.admin_id:
+        return
+    snap = metrics.snapshot()
+    text = f"<b>Метрики</b> (аптайм {snap['uptime_seconds']} с)\n"
+    for section in ("counters", "gauges", "timings", "ratios"):
+        for name, value in sorted(snap[section].items()):
+            text += f"\n<code>{name}</code>: {value}"
+    await msg.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("check_balances"))
+async def cmd_check_balances(msg: Message):
+    """
+    Сверяет проекцию балансов с расчётом с нуля по всем группам (только
+    администратору). С аргументом ``fix`` перестраивает расходящиеся группы.
+    """
+    if not settings.admin_id or msg.from_user.id != settings.admin_id:
+        return
+    fix = (msg.text or "").split()[1:2] == ["fix"]
+    broken: dict[str, dict] = {}
+    groups = await db.projection_groups()
+    for group_id in groups:
+        diff = await db.check_group_balances(group_id)
+        if diff:
+            broken[group_id] = diff
+    metrics.incr("balances_check.runs")
+    metrics.incr("balances_check.mismatched_groups", len(broken))
+    if not broken:
+        await msg.answer(f"Проекция балансов согласована ({len(groups)} групп).")
+        return
+    lines = [f"Расхождения в {len(broken)} из {len(groups)} групп:"]
+    for group_id, diff in broken.items():
+        for uid, (actual, expected) in diff.items():
+            lines.append(f"{group_id} / {uid}: проекция {actual}, с нуля {expected}")
+    if fix:
+        for group_id in broken:
+            await db.rebuild_group_balances(group_id)
+        lines.append("\nПроекции этих групп перестроены.")
+    await msg.answer("\n".join(lines[:50]))
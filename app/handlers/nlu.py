@@ -26,43 +26,17 @@ from services.llm_api import (
 # Используем единый модуль базы данных из пакета ``app`` для работы с
 # таблицами. Это предотвращает возникновение нескольких экземпляров
 # ``database.py`` в разных местах проекта и гарантирует, что и бот, и
-# мини‑приложение используют одну и ту же БД.
+# мини‑приложение используют одну и ту же БД. Запросы выполняются через
+# асинхронную обёртку, чтобы не блокировать цикл событий.
+from app import async_database as db
 from app.database import (
-    get_positions,
     start_text_session,
     append_text_message,
     end_text_session,
     TEXT_SESSIONS,
-    get_user,
-    add_positions,
-    add_payment,
-    get_all_users
 )
-
-# --- helper ---
-def _resolve_username_to_user_id(username: str) -> int | None:
-    """
-    Возвращает telegram_id пользователя по его username (с @ или без).
-    Сравнение без учёта регистра. Берём из колонки accounts.telegram_login.
-    """
-    if not username:
-        return None
-    uname = username.strip()
-    if not uname:
-        return None
-    # нормализуем к виду "@name"
-    if not uname.startswith("@"):
-        uname = "@" + uname
-    uname_cf = uname.casefold()
-
-    for uid, data in get_all_users():
-        tl = (data or {}).get("telegram_login")
-        if not tl:
-            continue
-        tl_norm = tl if tl.startswith("@") else "@" + tl
-        if tl_norm.casefold() == uname_cf:
-            return int(uid)
-    return None
+from app.users import UserMap
+from middlewares.chat_lock import chat_locks
 
 from handlers.receipts import finalize_receipt
 
@@ -78,6 +52,10 @@ async def handle_nlu_message(msg: Message):
     добавляет сообщение в коллекцию или завершает сбор. В противном
     случае классифицирует запрос с помощью LLM и выполняет
     соответствующее действие.
+
+    Обработчик не помечен флагом ``chat_lock``: классификация через LLM
+    не должна задерживать другие апдейты чата. Блокировку чата берут
+    только изменяющие ветки (позиции, платежи, расчёт).
     """
     chat_id = str(msg.chat.id)
     text = msg.text or ""
@@ -89,7 +67,8 @@ async def handle_nlu_message(msg: Message):
         if any(word in lowered for word in ["закончен", "закончена", "завершил", "готово", "конец"]):
             messages = end_text_session(chat_id)
             await msg.answer("✅ Текстовый сбор сообщений завершён. Начинаю расчёт...")
-            await finalize_receipt(msg)
+            async with chat_locks.hold(msg.chat.id):
+                await finalize_receipt(msg)
         else:
             append_text_message(chat_id, text)
             await msg.answer("Сообщение учтено. Когда закончите, напишите 'расчёт закончен'.")
@@ -100,7 +79,7 @@ async def handle_nlu_message(msg: Message):
 
     # --- Реакции на намерения ---
     if intent == "greet":
-        user = get_user(msg.from_user.id)
+        user = await db.get_user(msg.from_user.id)
         if user is None:
             await msg.answer(
                 "Привет! Вы не зарегистрированы. Хотите пройти регистрацию? Напишите /start, чтобы начать.",
@@ -138,7 +117,8 @@ async def handle_nlu_message(msg: Message):
             except Exception:
                 new_positions.append(item)
         group_id = str(msg.chat.id)
-        add_positions(group_id, new_positions)
+        async with chat_locks.hold(msg.chat.id):
+            await db.add_positions(group_id, new_positions)
         lines = []
         for item in new_positions:
             name = item.get("name")
@@ -151,7 +131,7 @@ async def handle_nlu_message(msg: Message):
         return
 
     if intent == "list_positions":
-        positions = get_positions()
+        positions = await db.get_positions()
         if not positions:
             await msg.answer("Нет позиций! Сначала добавьте чек.")
             return
@@ -185,7 +165,8 @@ async def handle_nlu_message(msg: Message):
         return
 
     if intent == "finalize":
-        await finalize_receipt(msg)
+        async with chat_locks.hold(msg.chat.id):
+            await finalize_receipt(msg)
         return
 
     if intent == "pay":
@@ -197,19 +178,20 @@ async def handle_nlu_message(msg: Message):
         if payments:
             group_id = str(msg.chat.id)
 
-            # Получим карту username -> telegram_id из базы
-            # get_all_users() -> List[(telegram_id:int, data:dict{..., telegram_login:str})]
+            # username -> telegram_id только для упомянутых логинов (индексный поиск)
             login_to_id: dict[str, int] = {}
             try:
-                for uid, data in get_all_users():
-                    login = (data or {}).get("telegram_login")
-                    if login:
-                        login_to_id[login.lstrip("@").lower()] = int(uid)
+                login_to_id = await db.resolve_logins(
+                    [p.get("user_login") for p in payments if p.get("user_login")]
+                )
             except Exception:
                 # в худшем случае просто останется пустым
                 pass
 
             lines_msgs: list[str] = []
+            # Все распознанные платежи сохраняем одной транзакцией
+            to_save: list[tuple[int, float, str]] = []
+            saved_msgs: list[str] = []
             for p in payments:
                 amt = float(p.get("amount") or 0)
                 desc = p.get("description") or ""
@@ -217,19 +199,24 @@ async def handle_nlu_message(msg: Message):
 
                 # Определяем пользователя-плательщика: либо из user_login, либо автор сообщения
                 if target_login:
-                    payer_id = login_to_id.get(target_login.lower())
+                    payer_id = login_to_id.get(target_login)
                     if payer_id is None:
                         lines_msgs.append(f"⚠️ Не нашёл пользователя @{target_login} в базе — платёж {amt:.0f}₽ не сохранён.")
                         continue
                 else:
                     payer_id = msg.from_user.id
 
-                try:
-                    add_payment(group_id, payer_id, amt, desc)
-                    prefix = f"@{target_login}" if target_login else "Вы"
-                    lines_msgs.append(f"✅ {prefix}: платёж {amt:.0f}₽ зарегистрирован.")
-                except Exception as e:
-                    lines_msgs.append(f"Ошибка при сохранении платежа на {amt:.0f}₽: {e}")
+                to_save.append((payer_id, amt, desc))
+                prefix = f"@{target_login}" if target_login else "Вы"
+                saved_msgs.append(f"✅ {prefix}: платёж {amt:.0f}₽ зарегистрирован.")
+
+            try:
+                async with chat_locks.hold(msg.chat.id):
+                    await db.add_payments(group_id, to_save)
+                lines_msgs.extend(saved_msgs)
+            except Exception as e:
+                total = sum(amt for _, amt, _ in to_save)
+                lines_msgs.append(f"Ошибка при сохранении платежей на {total:.0f}₽: {e}")
 
             await msg.answer("\n".join(lines_msgs))
         else:
@@ -288,35 +275,48 @@ async def handle_nlu_message(msg: Message):
         if payments:
             group_id = str(msg.chat.id)
             confirmations: list[str] = []
+            # Все распознанные платежи сохраняем одной транзакцией
+            to_save: list[tuple[int, float, str | None]] = []
+            saved_msgs: list[str] = []
 
+            # Сначала определяем плательщиков, затем одним запросом — их имена
+            resolved = await db.resolve_logins(
+                [p.get("username") for p in payments if p.get("username") and not p.get("is_self")]
+            )
+            targets: list[tuple[int, float, str | None, str | None]] = []
             for p in payments:
                 amt = float(p.get("amount") or 0)
                 desc = p.get("description")
                 username = p.get("username")
                 is_self = bool(p.get("is_self"))
 
-                target_user_id: int | None = None
-                target_label: str = ""
-
                 if is_self or not username:
-                    target_user_id = msg.from_user.id
-                    me_info = get_user(target_user_id) or {}
-                    target_label = me_info.get("full_name") or me_info.get("phone") or "Вы"
+                    targets.append((msg.from_user.id, amt, desc, None))
+                    continue
+                target_user_id = resolved.get(username)
+                if target_user_id is None:
+                    confirmations.append(
+                        f"⚠️ Не нашёл пользователя {username} среди зарегистрированных. Пропустил платёж {amt}₽."
+                    )
+                    continue
+                targets.append((target_user_id, amt, desc, username))
+
+            users = await UserMap().load(uid for uid, *_rest in targets)
+            for target_user_id, amt, desc, username in targets:
+                info = users.get(target_user_id)
+                if username is None:
+                    target_label = info.get("full_name") or info.get("phone") or "Вы"
                 else:
-                    target_user_id = _resolve_username_to_user_id(username)
-                    if target_user_id is None:
-                        confirmations.append(
-                            f"⚠️ Не нашёл пользователя {username} среди зарегистрированных. Пропустил платёж {amt}₽."
-                        )
-                        continue
-                    user_info = get_user(target_user_id) or {}
-                    target_label = user_info.get("full_name") or username
-
-                try:
-                    add_payment(group_id, target_user_id, amt, desc)
-                    confirmations.append(f"✅ Зарегистрирован платёж {amt}₽ от {target_label}.")
-                except Exception as e:
-                    confirmations.append(f"Ошибка при сохранении платежа ({target_label}): {e}")
+                    target_label = info.get("full_name") or username
+                to_save.append((target_user_id, amt, desc))
+                saved_msgs.append(f"✅ Зарегистрирован платёж {amt}₽ от {target_label}.")
+
+            try:
+                async with chat_locks.hold(msg.chat.id):
+                    await db.add_payments(group_id, to_save)
+                confirmations.extend(saved_msgs)
+            except Exception as e:
+                confirmations.append(f"Ошибка при сохранении платежей: {e}")
 
             await msg.answer("\n".join(confirmations))
             return
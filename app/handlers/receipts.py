@@ -1,28 +1,29 @@
 import io
+import logging
 import sqlite3
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, WebAppInfo
 
-from services.llm_api import extract_items_from_image
+from services.llm_api import LLMOverloaded, check_receipt, extract_items_from_image
+from services import receipt_dedup
 # Используем общий модуль базы данных из пакета ``app``. Это исключает
 # дублирование кода и разделение данных между двумя разными файлами
 # database.py в корне проекта и в подпакете ``app``. Все функции
-# взаимодействия с базой данных импортируем из ``app.database``.
+# взаимодействия с базой данных импортируем из ``app.database``. Запросы к
+# базе выполняются через асинхронную обёртку ``app.async_database``, чтобы не
+# блокировать цикл событий.
+from app import async_database as db, metrics
 from app.database import (
-    add_positions,
-    get_positions,
-    set_positions,
+    StaleVersionError,
     init_assignments,
     set_assignment,
-    get_all_users,
-    save_debts,
-    save_selected_positions,
-    get_selected_positions,
     log_payment,
-    get_user
 )
+from app.money import format_rub, to_kopecks
+from app.settlement import DUST_KOPECKS
+from app.users import UserMap
 from keyboards import positions_keyboard
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
@@ -30,21 +31,17 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from config import settings
 
 from utils import parse_position
+from app.utils import parse_selection_changes
 
 
-# Импортируем новые функции для платежей и расчёта баланса
-from app.database import (
-    add_payment,
-    get_payments,
-    calculate_group_balance,
-    get_unassigned_positions,
-    init_assignments,
-    TEXT_SESSIONS,
-)
+from app.database import TEXT_SESSIONS
 from services.payments import mass_pay
+from services.messaging import dispatcher
+from middlewares.chat_lock import chat_locks
 from services.llm_api import calculate_debts_from_messages
 
 router = Router(name="receipts")
+logger = logging.getLogger(__name__)
 
 class EditStates(StatesGroup):
     editing = State()
@@ -59,7 +56,7 @@ class EditStates(StatesGroup):
 async def cmd_split(msg: Message):
     group_id = str(msg.chat.id)
     # Проверяем, есть ли позиции для текущей группы. Если нет, предупредим пользователя.
-    positions = get_positions(group_id)
+    positions = await db.get_positions(group_id)
     if not positions:
         await msg.answer(
             "❗️Нет позиций для распределения. Сначала отправьте фото чека или добавьте позиции вручную."
@@ -117,14 +114,16 @@ async def cmd_show_position(msg: Message):
 
     Формат строки:
       Название — qty × price₽ - total₽
-    Если quantity == -1 (или < 0) — позицию делят поровну:
-      Название — поровну - price₽
+    Если quantity == -1 (или < 0) — позицию делят поровну, выводится доля
+    участника (из таблицы position_allocations):
+      Название — поровну - share₽
     """
     group_id = str(msg.chat.id)
-    selections = get_selected_positions(group_id)
+    selections = await db.get_selected_positions(group_id)
     if not selections:
         await msg.answer("❗️Позиции ещё не распределены. Откройте мини-приложение через /split и отметьте свои покупки.")
         return
+    allocations = await db.get_position_allocations(group_id)
 
     def fmt_money(x: float | int | None) -> str:
         try:
@@ -148,9 +147,10 @@ async def cmd_show_position(msg: Message):
             return str(q)
 
     lines: list[str] = ["<b>Распределение позиций:</b>"]
+    users = await UserMap().load(selections)
     # Чтобы вывод был стабильным – сортируем пользователей по ФИО/логину
-    for user_id in sorted(selections.keys(), key=lambda uid: (get_user(uid) or {}).get("full_name", str(uid))):
-        u = get_user(user_id) or {}
+    for user_id in sorted(selections.keys(), key=lambda uid: users.get(uid).get("full_name", str(uid))):
+        u = users.get(user_id)
         full_name = u.get("full_name") or f"ID {user_id}"
         login = u.get("telegram_login")
         login_part = f" (@{login})" if login and not str(login).startswith("@") else (f" ({login})" if login else "")
@@ -172,7 +172,9 @@ async def cmd_show_position(msg: Message):
                 qv = 0.0
             # «поровну»
             if qv < 0 or qv == -1:
-                lines.append(f"{name} — поровну - {fmt_money(price)}")
+                share = allocations.get(user_id, {}).get(p.get("position_id"))
+                share_text = f"{format_rub(share)}₽" if share is not None else fmt_money(price)
+                lines.append(f"{name} — поровну - {share_text}")
             else:
                 total = (float(price or 0) * float(qv or 0))
                 lines.append(f"{name} — {fmt_qty(qv)} × {fmt_money(price)} - {fmt_money(total)}")
@@ -180,18 +182,22 @@ async def cmd_show_position(msg: Message):
     await msg.answer("\n".join(lines), parse_mode="HTML")
 
 
-@router.message(F.photo)
+@router.message(F.photo, flags={"chat_lock": True})
 async def handle_photo(msg: Message):
     """
     Обработчик фотографий чеков. Работает только для зарегистрированных пользователей.
 
-    1. Получает изображение из сообщения.
-    2. Передаёт его в LLM через сервис `extract_items_from_image`.
+    1. Получает изображение из сообщения. Если этот файл уже распознавался
+       (см. `services.receipt_dedup`), позиции берутся из сохранённого
+       результата без скачивания.
+    2. Ищет тот же чек по фискальному QR‑коду; если не нашёл,
+       передаёт изображение в LLM через сервис `extract_items_from_image`.
     3. Если LLM возвращает список позиций, добавляет их в базу и отображает пользователю.
        Если LLM возвращает строку (например, «Это не чек») или происходит ошибка,
-       уведомляет пользователя об этом.
+       уведомляет пользователя об этом. Чек, уже добавленный в группу, второй
+       раз не добавляется.
     """
-    user = get_user(msg.from_user.id)
+    user = await db.get_user(msg.from_user.id)
     # Проверяем, что пользователь зарегистрирован. В групповых чатах бот
     # использует middleware, но для надёжности проверяем здесь ещё раз.
     if user is None:
@@ -201,41 +207,63 @@ async def handle_photo(msg: Message):
         )
         return
 
-    # Загружаем изображение чека из Telegram
-    try:
-        # Получаем объект файла от Telegram
-        telegram_photo = msg.photo[-1]
-        file = await msg.bot.get_file(telegram_photo.file_id)
-        file_bytes = await msg.bot.download_file(file.file_path)
-        # Сохраняем данные в BytesIO для передачи в LLM
-        image_bin = io.BytesIO(file_bytes.read())
-    except Exception as e:
-        await msg.answer(f"Ошибка загрузки изображения: {e}")
-        return
+    telegram_photo = msg.photo[-1]
+    scan = await receipt_dedup.find_by_file(telegram_photo.file_unique_id)
+    fiscal_key = None
+    if scan is None:
+        # Загружаем изображение чека из Telegram
+        try:
+            # Получаем объект файла от Telegram
+            file = await msg.bot.get_file(telegram_photo.file_id)
+            file_bytes = await msg.bot.download_file(file.file_path)
+            # Сохраняем данные в BytesIO для передачи в LLM
+            image_bin = io.BytesIO(file_bytes.read())
+        except Exception as e:
+            await msg.answer(f"Ошибка загрузки изображения: {e}")
+            return
+        scan, fiscal_key = await receipt_dedup.find_by_qr(
+            image_bin.getvalue(), telegram_photo.file_unique_id
+        )
 
-    # Передаём изображение в LLM (OpenRouter) для распознавания чека
-    try:
-        items, _ = await extract_items_from_image(image_bin)
-    except Exception as e:
-        items = None
-
-    # Если LLM вернул не список, сообщаем о том, что это не чек
-    if not items or not isinstance(items, list):
-        # Если items — строка, выводим её, иначе стандартное сообщение
-        text = str(items) if items else "Это не чек"
-        print(f"LLM returned non-list response: {text}")
-        await msg.answer(text)
-        return
-    # Сохраняем позиции с исходным количеством и ценой. Количество
-    # понадобится при расчёте, если пользователь выберет меньше, чем
-    # указанное количество (частичный выбор реализуется в мини‑приложении).
-    positions_to_add = [
-        {"name": it.name, "quantity": it.quantity, "price": it.price}
-        for it in items
-    ]
+    if scan is not None:
+        # Чек уже распознавался — повторный запрос к LLM не нужен
+        scan_id, positions_to_add = scan
+    else:
+        # Передаём изображение в LLM (OpenRouter) для распознавания чека
+        try:
+            items, _ = await extract_items_from_image(image_bin)
+        except LLMOverloaded:
+            await msg.answer("⏳ Сейчас распознаётся слишком много чеков. Отправьте фото ещё раз через минуту.")
+            return
+        except Exception as e:
+            items = None
+
+        # Если LLM вернул не список, сообщаем о том, что это не чек
+        if not items or not isinstance(items, list):
+            # Если items — строка, выводим её, иначе стандартное сообщение
+            text = str(items) if items else "Это не чек"
+            logger.info("LLM не вернул список позиций: %s", text)
+            await msg.answer(text)
+            return
+        # Сохраняем позиции с исходным количеством и ценой. Количество
+        # понадобится при расчёте, если пользователь выберет меньше, чем
+        # указанное количество (частичный выбор реализуется в мини‑приложении).
+        positions_to_add = [
+            {"name": it.name, "quantity": it.quantity, "price": it.price}
+            for it in items
+        ]
+        # Для повторной отправки запоминаем только правдоподобный результат:
+        # иначе повтор не даст шанса распознать чек заново
+        scan_id = None
+        if check_receipt(items, None) is None:
+            scan_id = await receipt_dedup.remember(
+                positions_to_add, fiscal_key, telegram_photo.file_unique_id
+            )
     # Определяем идентификатор группы (чата) для привязки позиций
     group_id = str(msg.chat.id)
-    add_positions(group_id, positions_to_add)
+    if not await db.add_positions(group_id, positions_to_add, scan_id):
+        await msg.answer("ℹ️ Этот чек уже добавлен — позиции не продублированы.")
+        return
 
     # Инициализируем назначение позиций для данного чата
     chat_receipt_id = str(msg.chat.id)
@@ -244,7 +272,8 @@ async def handle_photo(msg: Message):
    
     # Формируем текст с перечислением позиций и их стоимостью
     positions_text = "\n".join(
-        f"{item['name']} — {item['quantity']} x {item['price']}₽" for item in positions_to_add
+        f"{item['name']} — {float(item['quantity']):g} x {format_rub(to_kopecks(item['price']))}₽"
+        for item in positions_to_add
         #f"{item.name} — {item.quantity} x {item.price}₽" for item in items
     )
     await msg.answer(
@@ -320,7 +349,7 @@ async def handle_web_app_data(msg: Message):
         # распарсим их, чтобы достать структуру выбранных позиций. В случае
         # невалидного JSON выведем ошибку пользователю.
         raw_data = msg.web_app_data.data
-        print(f"Received web_app_data: {raw_data}")
+        logger.debug("web_app_data: %s", raw_data)
         data = json.loads(raw_data)
         selected_data = data.get("selected", {})
         indices: list[int] = []
@@ -351,7 +380,7 @@ async def handle_web_app_data(msg: Message):
                     pass
         else:
             indices = []
-        print(f"Received indices from WebApp: {indices}")
+        logger.debug("Индексы из мини‑приложения: %s", indices)
     except Exception as e:
         await msg.answer(f"Ошибка обработки данных из мини‑приложения: {e}")
         return
@@ -361,12 +390,52 @@ async def handle_web_app_data(msg: Message):
     # for a "group_id" field in the received data. If absent, fall back
     # to using the current chat ID (suitable for private chat usage).
     group_id = str(data.get("group_id") or msg.chat.id)
+    try:
+        chat_id = int(group_id)
+    except ValueError:
+        await msg.answer("Ошибка обработки данных из мини‑приложения: неверный group_id")
+        return
+    # Данные приходят в личный чат, а записываются в группу из group_id:
+    # флаг chat_lock заблокировал бы личный чат, поэтому блокируется чат
+    # группы — запись не пересекается с /finalize, handle_photo и /pay в ней.
+    async with chat_locks.hold(chat_id):
+        await _save_web_app_selection(msg, data, group_id, selected_data, indices)
+
+
+async def _save_web_app_selection(
+    msg: Message, data: dict, group_id: str, selected_data, indices: list[int]
+) -> None:
+    """Сохраняет выбор из мини‑приложения; вызывается под блокировкой группы."""
     receipt_id = group_id
+    if "changes" in data:
+        # Мини‑приложение прислало только изменённые позиции (по id) и версию
+        # группы, которую видел пользователь: устаревший выбор не сохраняется
+        try:
+            expected_version = data.get("version")
+            if expected_version is not None:
+                expected_version = int(expected_version)
+            await db.apply_selection_changes(
+                group_id, msg.from_user.id, parse_selection_changes(data.get("changes")), expected_version
+            )
+        except StaleVersionError:
+            await msg.answer(
+                "⚠️ Чек изменился, пока вы выбирали позиции. Откройте мини‑приложение заново и отметьте выбор ещё раз."
+            )
+            return
+        except Exception as e:
+            metrics.incr("web_app_data.errors")
+            logger.error("Ошибка сохранения изменений выбора группы %s: %s", group_id, e, exc_info=True)
+            await msg.answer("❌ Не удалось сохранить выбор. Попробуйте ещё раз.")
+            return
+        await msg.answer(
+            "✅ Ваш выбор сохранён! Когда все участники отметят свои позиции, используйте /finalize для расчёта."
+        )
+        return
     # Сохраняем выбор пользователя в in‑memory assignments для совместимости
     set_assignment(receipt_id, msg.from_user.id, indices)
     try:
         # Получаем список всех позиций в текущей группе
-        all_positions = get_positions(str(group_id))
+        all_positions = await db.get_positions(str(group_id))
         selected_positions: list[dict] = []
         if isinstance(selected_data, dict):
             for idx_str, qty in selected_data.items():
@@ -392,9 +461,10 @@ async def handle_web_app_data(msg: Message):
                         "quantity": 1.0,
                         "price": orig.get("price"),
                     })
-        save_selected_positions(str(group_id), msg.from_user.id, selected_positions)
+        await db.save_selected_positions(str(group_id), msg.from_user.id, selected_positions)
     except Exception as e:
-        print(f"Ошибка при сохранении распределённых позиций: {e}")
+        metrics.incr("web_app_data.errors")
+        logger.error("Ошибка сохранения выбора группы %s: %s", group_id, e, exc_info=True)
     await msg.answer(
         "✅ Ваш выбор сохранён! Когда все участники отметят свои позиции, используйте /finalize для расчёта."
     )
@@ -412,18 +482,17 @@ async def show_positions(msg: Message):
     «Выбрали…» опускается.
     """
     group_id = str(msg.chat.id)
-    positions = get_positions(group_id) or []
+    positions = await db.get_positions(group_id) or []
     if not positions:
         await msg.answer("Нет позиций! Сначала добавьте чеки.")
         return
     # Загружаем выбранные позиции, чтобы показать, кто что выбрал
-    from app.database import get_selected_positions as _get_selected_positions
-    selections = _get_selected_positions(group_id) or {}
+    selections = await db.get_selected_positions(group_id) or {}
     # Сгруппируем выбранные позиции по ключу (name, price) → список (user_name, quantity)
     selection_map: dict[tuple[str, float], list[tuple[str, float]]] = {}
+    users = await UserMap().load(selections)
     for uid, pos_list in selections.items():
-        user_info = get_user(uid) or {}
-        user_name = user_info.get('full_name') or user_info.get('phone') or str(uid)
+        user_name = users.name(uid)
         for pos in pos_list:
             try:
                 key = (pos.get('name'), float(pos.get('price', 0)))
@@ -457,16 +526,16 @@ async def show_positions(msg: Message):
     kb = positions_keyboard(positions)
     await msg.answer("<b>Все позиции:</b>\n" + "\n".join(lines), parse_mode="HTML", reply_markup=kb)
 
-@router.callback_query(F.data.startswith("del_"))
+@router.callback_query(F.data.startswith("del_"), flags={"chat_lock": True})
 async def delete_position(call: CallbackQuery):
     idx = int(call.data.replace("del_", ""))
     group_id = str(call.message.chat.id)
-    positions = get_positions(group_id)
+    positions = await db.get_positions(group_id)
     if idx < 0 or idx >= len(positions):
         await call.answer("Ошибка удаления")
         return
     positions.pop(idx)
-    set_positions(group_id, positions)
+    await db.set_positions(group_id, positions)
     await call.answer("Позиция удалена")
     # Обновить сообщение:
     # Формируем текст со списком оставшихся позиций. Используем индексы
@@ -485,7 +554,7 @@ async def delete_position(call: CallbackQuery):
 async def edit_position(call: CallbackQuery, state: FSMContext):
     idx = int(call.data.replace("edit_", ""))
     group_id = str(call.message.chat.id)
-    positions = get_positions(group_id)
+    positions = await db.get_positions(group_id)
     if 0 <= idx < len(positions):
         await state.update_data(edit_idx=idx)
         await state.set_state(EditStates.editing)
@@ -498,16 +567,16 @@ async def edit_position(call: CallbackQuery, state: FSMContext):
 
 
 # Редактирование позиции — шаг 2 (сохраняем ввод)
-@router.message(EditStates.editing)
+@router.message(EditStates.editing, flags={"chat_lock": True})
 async def save_edited_position(msg: Message, state: FSMContext):
     data = await state.get_data()
     idx = data.get("edit_idx")
     try:
         position = parse_position(msg.text)
         group_id = str(msg.chat.id)
-        positions = get_positions(group_id)
+        positions = await db.get_positions(group_id)
         positions[idx] = position
-        set_positions(group_id, positions)
+        await db.set_positions(group_id, positions)
         await msg.answer("Позиция обновлена!")
         kb = positions_keyboard(positions)
         text = "\n".join(
@@ -530,14 +599,14 @@ async def add_new_position(call: CallbackQuery, state: FSMContext):
 
 
 # Добавление позиции — шаг 2 (сохраняем ввод)
-@router.message(EditStates.adding)
+@router.message(EditStates.adding, flags={"chat_lock": True})
 async def save_new_position(msg: Message, state: FSMContext):
     try:
         position = parse_position(msg.text)
         group_id = str(msg.chat.id)
-        positions = get_positions(group_id)
+        positions = await db.get_positions(group_id)
         positions.append(position)
-        set_positions(group_id, positions)
+        await db.set_positions(group_id, positions)
         await msg.answer("Позиция добавлена!")
         kb = positions_keyboard(positions)
         text = "\n".join(
@@ -555,7 +624,7 @@ async def save_new_position(msg: Message, state: FSMContext):
 # распределить расходы поровну между всеми зарегистрированными участниками.
 # В продакшене здесь должен быть более сложный расчёт с учётом выбранных позиций,
 # однако для примера реализовано равное распределение.
-@router.message(Command("finalize"))
+@router.message(Command("finalize"), flags={"chat_lock": True})
 async def finalize_receipt(msg: Message):
     """
     Выполняет финальный клиринг по текущему чеку.
@@ -565,34 +634,38 @@ async def finalize_receipt(msg: Message):
     (через LLM) не используются. Итогом работы является список
     оптимальных переводов между участниками, который отправляется
     каждому пользователю в личные сообщения. В группу отправляется
-    сводка переводов. Также сохраняется информация о долгах в таблицу
-    debts и журнал платежей. После завершения расчёта данные чеков,
-    выборов и платежей переносятся в архив и удаляются из рабочих
-    таблиц.
+    сводка переводов. Сохранение долгов в таблицу debts, перенос чеков,
+    выборов и платежей в архив и их удаление из рабочих таблиц выполняются
+    одной транзакцией (``database.finalize_group``) до рассылки сообщений.
     """
     group_id = str(msg.chat.id)
     receipt_id = group_id
+    # Расчёт, запись долгов, архивирование и очистка — одна транзакция в базе.
+    # Ключ идемпотентности — сообщение, запустившее расчёт: повторная доставка
+    # того же апдейта не создаст второй расчёт и не разошлёт сообщения снова.
+    try:
+        result = await db.finalize_group(group_id, receipt_id, f"{group_id}:{msg.message_id}")
+    except Exception as e:
+        metrics.incr("finalize.errors")
+        logger.error("Ошибка завершения расчёта группы %s: %s", group_id, e, exc_info=True)
+        await msg.answer("Не удалось завершить расчёт, данные не изменены. Попробуйте ещё раз.")
+        return
+    # Этот апдейт уже обработан (повторная доставка) — итоги уже разосланы
+    if result.status == "duplicate":
+        return
     # Проверяем, что есть позиции для расчёта
-    positions = get_positions(group_id) or []
-    if not positions:
+    if result.status == "no_positions":
         await msg.answer("Нет позиций для расчёта. Сначала отправьте чек.")
         return
-    # Загружаем распределённые позиции и платежи
-    from app.database import get_selected_positions as _get_selected_positions, get_payments, archive_group_data, clear_group_data
-    selections = _get_selected_positions(group_id) or {}
-    payments = get_payments(group_id) or {}
     # Если нет ни выбранных позиций, ни платежей, расчёт невозможен
-    if not selections and not payments:
+    if result.status == "no_participants":
         await msg.answer("Нет данных для расчёта. Сначала распределите позиции или укажите платежи командой /pay.")
         return
-    # Вычисляем оптимальные переводы на основе клиринга
-    transfers = calculate_group_balance(group_id) or []
-    # Подготовим отображение долгов для сохранения: должник → сумма
-    debt_mapping: dict[int, float] = {}
-    for debtor_id, creditor_id, amount in transfers:
-        debt_mapping[debtor_id] = round(debt_mapping.get(debtor_id, 0.0) + float(amount), 2)
-    # Сохраняем долги и логируем платёж (используем фиктивный ID транзакции)
-    save_debts(receipt_id, debt_mapping)
+    settlement = result.settlement
+    # Оптимальные переводы и долги: должник → сумма (долги уже сохранены)
+    transfers = settlement.transfers
+    debt_mapping = settlement.debts
+    # Логируем платёж (используем фиктивный ID транзакции)
     fake_tx_id = "manual_clear"
     log_payment(receipt_id, fake_tx_id, debt_mapping)
     # Ссылка на группу для удобства пользователей. Если у группы есть username,
@@ -616,322 +689,74 @@ async def finalize_receipt(msg: Message):
         group_link = ""
     # Строим персональные сообщения для каждого участника. Собираем входящие и исходящие
     # переводы, чтобы пользователь видел, кому он должен и кто должен ему.
-    user_transfers: dict[int, dict[str, list[tuple[int, float]]]] = {}
+    user_transfers: dict[int, dict[str, list[tuple[int, int]]]] = {}
     for debtor_id, creditor_id, amount in transfers:
         user_transfers.setdefault(debtor_id, {"out": [], "in": []})
         user_transfers.setdefault(creditor_id, {"out": [], "in": []})
-        user_transfers[debtor_id]["out"].append((creditor_id, float(amount)))
-        user_transfers[creditor_id]["in"].append((debtor_id, float(amount)))
-    
-    # Вычисляем баланс (платежи - стоимость) для каждого участника.
-    # Для корректного расчёта стоимости учтём ручные выборы и отметки «поровну».
-    balances_map: dict[int, float] = {}
-    from app.database import get_db_connection
-    try:
-        conn2 = get_db_connection()
-        cur2 = conn2.cursor()
-        # Загружаем исходные позиции
-        cur2.execute(
-            "SELECT id, quantity, price FROM positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        pos_rows2 = cur2.fetchall()
-        pos_map2: dict[int, dict[str, float]] = {}
-        for row in pos_rows2:
-            try:
-                pid = row["id"]
-                pos_map2[pid] = {
-                    "quantity": float(row["quantity"] or 0),
-                    "price": float(row["price"] or 0),
-                }
-            except Exception:
-                pass
-        # Загружаем выбранные позиции
-        cur2.execute(
-            "SELECT user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        sp_rows2 = cur2.fetchall()
-        selections_by_pos2: dict[int | None, list[tuple[int, float, float]]] = {}
-        for row in sp_rows2:
-            try:
-                uid_raw = row["user_tg_id"]
-                uid_int2 = int(uid_raw) if uid_raw is not None else None
-            except Exception:
-                uid_int2 = None
-            if uid_int2 is None:
-                continue
-            pos_id2 = row["position_id"]
-            qty_raw2 = row["quantity"]
-            try:
-                qv2 = float(qty_raw2 or 0)
-            except Exception:
-                qv2 = 0.0
-            pval2 = None
-            try:
-                pval2 = float(row["price"] or 0)
-            except Exception:
-                pval2 = 0.0
-            selections_by_pos2.setdefault(pos_id2, []).append((uid_int2, qv2, pval2))
-        cost_map2: dict[int, float] = {}
-        for pos_id2, sel_list2 in selections_by_pos2.items():
-            if pos_id2 is not None and pos_id2 in pos_map2:
-                orig2 = pos_map2[pos_id2]
-                total_qty2 = float(orig2.get("quantity", 0))
-                price2 = float(orig2.get("price", 0))
-                manual_sum2 = 0.0
-                equal_users2: list[int] = []
-                for uid_int2, qty_val2, _p2 in sel_list2:
-                    if qty_val2 is None:
-                        continue
-                    try:
-                        qvtmp = float(qty_val2)
-                    except Exception:
-                        qvtmp = 0.0
-                    if qvtmp >= 0:
-                        manual_sum2 += qvtmp
-                    else:
-                        equal_users2.append(uid_int2)
-                # Ручной расход
-                for uid_int2, qty_val2, _p2 in sel_list2:
-                    if qty_val2 is None:
-                        continue
-                    try:
-                        qvtmp = float(qty_val2)
-                    except Exception:
-                        qvtmp = 0.0
-                    if qvtmp > 0:
-                        cost_map2[uid_int2] = cost_map2.get(uid_int2, 0.0) + qvtmp * price2
-                leftover2 = max(total_qty2 - manual_sum2, 0.0)
-                if equal_users2:
-                    share2 = leftover2 / len(equal_users2) if len(equal_users2) > 0 else 0.0
-                    for uid_int2 in equal_users2:
-                        cost_map2[uid_int2] = cost_map2.get(uid_int2, 0.0) + share2 * price2
-            else:
-                for uid_int2, qty_val2, price_val2 in sel_list2:
-                    try:
-                        qvtmp = float(qty_val2)
-                    except Exception:
-                        qvtmp = 0.0
-                    try:
-                        pvt2 = float(price_val2)
-                    except Exception:
-                        pvt2 = 0.0
-                    if qvtmp > 0:
-                        cost_map2[uid_int2] = cost_map2.get(uid_int2, 0.0) + qvtmp * pvt2
-        # Теперь вычисляем балансы: оплачено - потрачено
-        all_bal_users2 = set(cost_map2.keys()) | set(payments.keys())
-        for uid in all_bal_users2:
-            paid_amt = payments.get(uid, 0.0)
-            spent_amt = cost_map2.get(uid, 0.0)
-            balances_map[uid] = round(paid_amt - spent_amt, 2)
-    except Exception:
-        # Fallback: если что-то сломалось, попробуем простой расчёт
-        balances_map = {}
-        try:
-            cost_map_simple: dict[int, float] = {}
-            for _uid, _plist in selections.items():
-                total_cost_simple = 0.0
-                for _pos in _plist:
-                    try:
-                        qtmp = float(_pos.get('quantity', 0))
-                        ptmp = float(_pos.get('price', 0))
-                        total_cost_simple += qtmp * ptmp
-                    except Exception:
-                        pass
-                cost_map_simple[int(_uid)] = round(total_cost_simple, 2)
-            all_users_simple = set(cost_map_simple.keys()) | set(payments.keys())
-            for _uid in all_users_simple:
-                paid = payments.get(_uid, 0.0)
-                spent = cost_map_simple.get(_uid, 0.0)
-                balances_map[_uid] = round(paid - spent, 2)
-        except Exception:
-            balances_map = {}
-    finally:
-        try:
-            conn2.close()
-        except Exception:
-            pass
-    # Определяем полный список участников: те, кто выбрал позиции или внёс платежи.
-    all_user_ids: set[int] = set(selections.keys()) | set(payments.keys())
-    # Отправляем каждому пользователю личное сообщение. Если пользователь не участвовал
+        user_transfers[debtor_id]["out"].append((creditor_id, amount))
+        user_transfers[creditor_id]["in"].append((debtor_id, amount))
+
+    balances_map = settlement.balances
+    # Полный список участников: те, кто выбрал позиции или внёс платежи.
+    all_user_ids = settlement.participants
+    # Имена всех участников и сторон переводов загружаем одним запросом
+    users = await UserMap().load(all_user_ids)
+    await users.load(uid for transfer in transfers for uid in transfer[:2])
+    # Готовим каждому пользователю личное сообщение. Если пользователь не участвовал
     # в переводах (у него нулевой баланс), всё равно уведомим его об отсутствии
     # обязательств.
+    outgoing: list[tuple[int, str]] = []
     for uid in all_user_ids:
         flows = user_transfers.get(uid, {"out": [], "in": []})
         messages: list[str] = []
         # Исходящие переводы (должен)
         for creditor_id, amount in flows.get("out", []):
-            creditor_info = get_user(creditor_id) or {}
-            creditor_name = creditor_info.get('full_name') or creditor_info.get('phone') or str(creditor_id)
-            messages.append(f"Вы должны {amount}₽ пользователю {creditor_name}.")
+            messages.append(f"Вы должны {format_rub(amount)}₽ пользователю {users.name(creditor_id)}.")
         # Входящие переводы (вам должны)
         for debtor_id, amount in flows.get("in", []):
-            debtor_info = get_user(debtor_id) or {}
-            debtor_name = debtor_info.get('full_name') or debtor_info.get('phone') or str(debtor_id)
-            messages.append(f"{debtor_name} должен вам {amount}₽.")
+            messages.append(f"{users.name(debtor_id)} должен вам {format_rub(amount)}₽.")
         if not messages:
-            bal = balances_map.get(uid, 0.0)
-            if abs(bal) > 0.01:
+            bal = balances_map.get(uid, 0)
+            if abs(bal) > DUST_KOPECKS:
                 sign = '+' if bal > 0 else ''
-                messages.append(f'Ваш баланс {sign}{bal}₽. Нет обязательств.')
+                messages.append(f'Ваш баланс {sign}{format_rub(bal)}₽. Нет обязательств.')
             else:
                 messages.append('Ваш баланс нулевой. Нет обязательств.')
         if group_link:
             messages.append(f"Группа: {group_link}")
-        try:
-            await msg.bot.send_message(uid, "\n".join(messages))
-        except Exception:
-            # Игнорируем ошибку отправки (например, если пользователь запретил ЛС)
-            pass
+        outgoing.append((uid, "\n".join(messages)))
+    # Рассылаем параллельно с учётом лимитов Telegram. Недоставленные сообщения
+    # (например, пользователь не начинал диалог с ботом) не прерывают клиринг.
+    report = await dispatcher.send_many(msg.bot, outgoing)
+    if report.failed:
+        logger.warning("Не доставлены личные сообщения группы %s: %s", group_id, report.failed)
     # Формируем сводку для группового чата
     summary_lines: list[str] = ["💰 Клиринг завершён!"]
     if transfers:
         summary_lines.append("\n<b>Оптимальные переводы:</b>")
         for debtor_id, creditor_id, amount in transfers:
-            debtor_info = get_user(debtor_id) or {}
-            creditor_info = get_user(creditor_id) or {}
-            debtor_name = debtor_info.get('full_name') or debtor_info.get('phone') or str(debtor_id)
-            creditor_name = creditor_info.get('full_name') or creditor_info.get('phone') or str(creditor_id)
-            summary_lines.append(f"{debtor_name} → {creditor_name}: {amount}₽")
+            summary_lines.append(f"{users.name(debtor_id)} → {users.name(creditor_id)}: {format_rub(amount)}₽")
         summary_lines.append("\nПодробности отправлены каждому участнику в личные сообщения.")
     else:
         summary_lines.append("\nВсе расчёты закрыты. Нет обязательств между участниками.")
-        # Добавляем информацию о балансе каждого участника. Для расчёта
-        # используем ту же логику стоимости, что и в calculate_group_balance.
-        try:
-            from app.database import get_db_connection
-            conn_rep = get_db_connection()
-            cur_rep = conn_rep.cursor()
-            # Сформируем карту исходных позиций
-            cur_rep.execute(
-                "SELECT id, quantity, price FROM positions WHERE group_id = ?",
-                (str(group_id),),
+        # Добавляем информацию о балансе каждого участника.
+        if settlement.balances:
+            summary_lines.append("\n<b>Баланс группы:</b>")
+        for _u in settlement.balances:
+            spent = settlement.costs.get(_u, 0)
+            paid = settlement.payments.get(_u, 0)
+            diff = settlement.balances[_u]
+            sign = '+' if diff >= 0 else ''
+            summary_lines.append(
+                f"{users.name(_u)} ({_u}): потратил {format_rub(spent)}₽, оплатил {format_rub(paid)}₽ → баланс {sign}{format_rub(diff)}₽"
             )
-            pos_rows_rep = cur_rep.fetchall()
-            positions_map_rep: dict[int, dict[str, float]] = {}
-            for row in pos_rows_rep:
-                try:
-                    positions_map_rep[row["id"]] = {
-                        "quantity": float(row["quantity"] or 0),
-                        "price": float(row["price"] or 0),
-                    }
-                except Exception:
-                    pass
-            # Выборки
-            cur_rep.execute(
-                "SELECT user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
-                (str(group_id),),
-            )
-            sel_rows_rep = cur_rep.fetchall()
-            selections_by_pos_rep: dict[int | None, list[tuple[int, float, float]]] = {}
-            for row in sel_rows_rep:
-                try:
-                    uid_raw = row["user_tg_id"]
-                    uid_int_rep = int(uid_raw) if uid_raw is not None else None
-                except Exception:
-                    uid_int_rep = None
-                if uid_int_rep is None:
-                    continue
-                pid_rep = row["position_id"]
-                qty_rep = 0.0
-                try:
-                    qty_rep = float(row["quantity"] or 0)
-                except Exception:
-                    qty_rep = 0.0
-                price_rep = 0.0
-                try:
-                    price_rep = float(row["price"] or 0)
-                except Exception:
-                    price_rep = 0.0
-                selections_by_pos_rep.setdefault(pid_rep, []).append((uid_int_rep, qty_rep, price_rep))
-            report_cost_map: dict[int, float] = {}
-            for pid_rep, sel_list_rep in selections_by_pos_rep.items():
-                if pid_rep is not None and pid_rep in positions_map_rep:
-                    orig_rep = positions_map_rep[pid_rep]
-                    total_qty_rep = float(orig_rep.get("quantity", 0))
-                    price_val_rep = float(orig_rep.get("price", 0))
-                    manual_sum_rep = 0.0
-                    equal_users_rep: list[int] = []
-                    for uid_int_rep, qty_val_rep, _pr in sel_list_rep:
-                        if qty_val_rep is None:
-                            continue
-                        try:
-                            q_tmp_rep = float(qty_val_rep)
-                        except Exception:
-                            q_tmp_rep = 0.0
-                        if q_tmp_rep >= 0:
-                            manual_sum_rep += q_tmp_rep
-                        else:
-                            equal_users_rep.append(uid_int_rep)
-                    # manual
-                    for uid_int_rep, qty_val_rep, _pr in sel_list_rep:
-                        if qty_val_rep is None:
-                            continue
-                        try:
-                            q_tmp_rep = float(qty_val_rep)
-                        except Exception:
-                            q_tmp_rep = 0.0
-                        if q_tmp_rep > 0:
-                            report_cost_map[uid_int_rep] = report_cost_map.get(uid_int_rep, 0.0) + q_tmp_rep * price_val_rep
-                    # поровну
-                    leftover_rep = max(total_qty_rep - manual_sum_rep, 0.0)
-                    if equal_users_rep:
-                        share_rep = leftover_rep / len(equal_users_rep) if len(equal_users_rep) > 0 else 0.0
-                        for uid_int_rep in equal_users_rep:
-                            report_cost_map[uid_int_rep] = report_cost_map.get(uid_int_rep, 0.0) + share_rep * price_val_rep
-                else:
-                    for uid_int_rep, qty_val_rep, price_val_rep2 in sel_list_rep:
-                        try:
-                            q_tmp_rep = float(qty_val_rep)
-                        except Exception:
-                            q_tmp_rep = 0.0
-                        try:
-                            price_val_rep3 = float(price_val_rep2)
-                        except Exception:
-                            price_val_rep3 = 0.0
-                        if q_tmp_rep > 0:
-                            report_cost_map[uid_int_rep] = report_cost_map.get(uid_int_rep, 0.0) + q_tmp_rep * price_val_rep3
-            # Все участники, участвовавшие в выборе или оплате
-            all_rep_users = set(report_cost_map.keys()) | set(payments.keys())
-            if all_rep_users:
-                summary_lines.append("\n<b>Баланс группы:</b>")
-            for _u in all_rep_users:
-                spent = round(report_cost_map.get(_u, 0.0), 2)
-                paid = round(payments.get(_u, 0.0), 2)
-                diff = round(paid - spent, 2)
-                u_info = get_user(_u) or {}
-                u_name = u_info.get('full_name') or u_info.get('phone') or str(_u)
-                sign = '+' if diff >= 0 else ''
-                summary_lines.append(f"{u_name} ({_u}): потратил {spent}₽, оплатил {paid}₽ → баланс {sign}{diff}₽")
-            try:
-                conn_rep.close()
-            except Exception:
-                pass
-        except Exception:
-            pass
+    if report.failed:
+        undelivered = ", ".join(users.name(uid) for uid in report.failed)
+        summary_lines.append(
+            f"\nНе удалось написать в личные сообщения: {undelivered}. "
+            "Напишите боту /start в личке, чтобы получать уведомления."
+        )
     await msg.answer("\n".join(summary_lines), parse_mode="HTML")
-    # Архивируем данные и очищаем рабочие таблицы для группы.
-    # Даже если архивирование или очистка завершатся с ошибкой,
-    # мы продолжим выполнение. Для надёжности выполняем операции
-    # последовательно и не оборачиваем их в общий try. Если
-    # возникнет исключение, оно будет выведено в логи, но не
-    # прервёт оставшийся код.
-    try:
-        archive_group_data(group_id)
-    except Exception as arch_err:
-        try:
-            print(f"Ошибка архивации данных для группы {group_id}: {arch_err}")
-        except Exception:
-            pass
-    try:
-        clear_group_data(group_id)
-    except Exception as clear_err:
-        try:
-            print(f"Ошибка очистки данных для группы {group_id}: {clear_err}")
-        except Exception:
-            pass
-
     # Также сбрасываем временные структуры для данного чата: ASSIGNMENTS и TEXT_SESSIONS.
     try:
         init_assignments(group_id)
@@ -945,7 +770,7 @@ async def finalize_receipt(msg: Message):
 # Дополнительные команды для учёта платежей и расчёта баланса
 # ---------------------------------------------------------------------------
 
-@router.message(Command("pay"))
+@router.message(Command("pay"), flags={"chat_lock": True})
 async def cmd_pay(msg: Message):
     """
     Записывает факт оплаты от пользователя.
@@ -961,7 +786,7 @@ async def cmd_pay(msg: Message):
     group_id = str(msg.chat.id)
     user_id = msg.from_user.id
     # Проверяем, что пользователь зарегистрирован
-    if get_user(user_id) is None:
+    if await db.get_user(user_id) is None:
         await msg.answer(
             "❗️Вы ещё не зарегистрированы. Напишите /start в личку боту, чтобы пройти регистрацию."
         )
@@ -983,7 +808,7 @@ async def cmd_pay(msg: Message):
         return
     description = parts[2] if len(parts) >= 3 else None
     try:
-        add_payment(group_id, user_id, amount, description)
+        await db.add_payment(group_id, user_id, amount, description)
         await msg.answer(f"✅ Платёж на сумму {amount}₽ зарегистрирован.")
     except Exception as e:
         await msg.answer(f"Ошибка при сохранении платежа: {e}")
@@ -998,7 +823,7 @@ async def cmd_unassigned(msg: Message):
     необходимо распределить, иначе баланс может быть рассчитан некорректно.
     """
     group_id = str(msg.chat.id)
-    unassigned = get_unassigned_positions(group_id) or []
+    unassigned = await db.get_unassigned_positions(group_id) or []
     if not unassigned:
         await msg.answer("Все позиции распределены.")
         return
@@ -1026,154 +851,30 @@ async def cmd_balance(msg: Message):
     должен перевести, чтобы закрыть долги.
     """
     group_id = str(msg.chat.id)
-    # Загружаем данные
-    selections = get_selected_positions(group_id) or {}
-    payments_map = get_payments(group_id) or {}
+    # Загружаем данные группы один раз и выполняем весь расчёт
+    settlement = await db.settle_group(group_id)
     # Если нет данных ни о позициях, ни о платежах
-    if not selections and not payments_map:
+    if not settlement.participants:
         await msg.answer("Нет данных для расчёта баланса. Сначала распределите позиции или внесите платежи.")
         return
-    # -------------------------------------------------------------------
-    # Формируем cost_map: пользователь → сумма по выбранным позициям.
-    # Учитываем как ручные выборы, так и отметки «поровну». Для
-    # корректного расчёта нам нужно знать исходное количество и цену
-    # каждой позиции, поэтому делаем прямой запрос к таблицам positions
-    # и selected_positions, аналогичный логике calculate_group_balance.
-    from app.database import get_db_connection
-    cost_map: dict[int, float] = {}
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # Загружаем исходные позиции
-        cur.execute(
-            "SELECT id, quantity, price FROM positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        pos_rows = cur.fetchall()
-        positions_map: dict[int, dict[str, float]] = {}
-        for row in pos_rows:
-            try:
-                pid = row["id"]
-                qval = float(row["quantity"] or 0)
-                pval = float(row["price"] or 0)
-                positions_map[pid] = {"quantity": qval, "price": pval}
-            except Exception:
-                pass
-        # Загружаем выбранные позиции
-        cur.execute(
-            "SELECT user_tg_id, position_id, quantity, price FROM selected_positions WHERE group_id = ?",
-            (str(group_id),),
-        )
-        sp_rows = cur.fetchall()
-        selections_by_pos: dict[int | None, list[tuple[int, float, float]]] = {}
-        for row in sp_rows:
-            try:
-                uid_raw = row["user_tg_id"]
-                uid_int = int(uid_raw) if uid_raw is not None else None
-            except Exception:
-                uid_int = None
-            if uid_int is None:
-                continue
-            pos_id = row["position_id"]
-            qty_raw = row["quantity"]
-            try:
-                qty_val = float(qty_raw or 0)
-            except Exception:
-                qty_val = 0.0
-            price_val = None
-            try:
-                price_val = float(row["price"] or 0)
-            except Exception:
-                price_val = 0.0
-            selections_by_pos.setdefault(pos_id, []).append((uid_int, qty_val, price_val))
-        # Расчёт стоимости по каждому выбору
-        for pos_id, sel_list in selections_by_pos.items():
-            if pos_id is not None and pos_id in positions_map:
-                orig = positions_map[pos_id]
-                total_qty = float(orig.get("quantity", 0))
-                price = float(orig.get("price", 0))
-                manual_sum = 0.0
-                equal_users: list[int] = []
-                for uid_int, qty_val, _p in sel_list:
-                    if qty_val is None:
-                        continue
-                    try:
-                        qv = float(qty_val)
-                    except Exception:
-                        qv = 0.0
-                    if qv >= 0:
-                        manual_sum += qv
-                    else:
-                        equal_users.append(uid_int)
-                # Стоимость по ручным количествам
-                for uid_int, qty_val, _p in sel_list:
-                    if qty_val is None:
-                        continue
-                    try:
-                        qv = float(qty_val)
-                    except Exception:
-                        qv = 0.0
-                    if qv > 0:
-                        cost_map[uid_int] = cost_map.get(uid_int, 0.0) + qv * price
-                # Стоимость по поровну
-                leftover = max(total_qty - manual_sum, 0.0)
-                if equal_users:
-                    share = leftover / len(equal_users) if len(equal_users) > 0 else 0.0
-                    for uid_int in equal_users:
-                        cost_map[uid_int] = cost_map.get(uid_int, 0.0) + share * price
-            else:
-                # Позиция не сопоставлена с исходной записью
-                for uid_int, qty_val, price_val in sel_list:
-                    try:
-                        qv = float(qty_val)
-                    except Exception:
-                        qv = 0.0
-                    try:
-                        pv = float(price_val)
-                    except Exception:
-                        pv = 0.0
-                    if qv > 0:
-                        cost_map[uid_int] = cost_map.get(uid_int, 0.0) + qv * pv
-    except Exception:
-        # Если что‑то пошло не так, fallback: суммируем qty*price из selections
-        cost_map = {}
-        for uid, pos_list in selections.items():
-            total = 0.0
-            for pos in pos_list:
-                try:
-                    qty = float(pos.get("quantity", 0))
-                    price = float(pos.get("price", 0))
-                    total += qty * price
-                except Exception:
-                    pass
-            cost_map[uid] = round(total, 2)
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
-    # Список всех участников
-    users = set(cost_map.keys()) | set(payments_map.keys())
     # Строим строки с балансом по каждому
     lines: list[str] = ["<b>Баланс группы:</b>"]
-    for uid in users:
-        spent_val = round(cost_map.get(uid, 0.0), 2)
-        paid_val = round(payments_map.get(uid, 0.0), 2)
-        diff = round(paid_val - spent_val, 2)
-        user_info = get_user(uid) or {}
-        name = user_info.get('full_name') or user_info.get('phone') or str(uid)
+    users = await UserMap().load(settlement.participants)
+    for uid in settlement.balances:
+        spent_val = settlement.costs.get(uid, 0)
+        paid_val = settlement.payments.get(uid, 0)
+        diff = settlement.balances[uid]
         sign = "+" if diff >= 0 else ""
-        lines.append(f"{name} ({uid}): потратил {spent_val}₽, оплатил {paid_val}₽ → баланс {sign}{diff}₽")
-    # Получаем оптимальные переводы
-    transfers = calculate_group_balance(group_id)
+        lines.append(
+            f"{users.name(uid)} ({uid}): потратил {format_rub(spent_val)}₽, оплатил {format_rub(paid_val)}₽ → баланс {sign}{format_rub(diff)}₽"
+        )
+    # Оптимальные переводы
+    transfers = settlement.transfers
     if transfers:
         lines.append("\n<b>Оптимальные переводы:</b>")
+        await users.load(uid for transfer in transfers for uid in transfer[:2])
         for debtor_id, creditor_id, amount in transfers:
-            debtor_info = get_user(debtor_id) or {}
-            creditor_info = get_user(creditor_id) or {}
-            debtor_name = debtor_info.get('full_name') or debtor_info.get('phone') or str(debtor_id)
-            creditor_name = creditor_info.get('full_name') or creditor_info.get('phone') or str(creditor_id)
-            lines.append(f"{debtor_name} → {creditor_name}: {amount}₽")
+            lines.append(f"{users.name(debtor_id)} → {users.name(creditor_id)}: {format_rub(amount)}₽")
     else:
         lines.append("\nВсе расчёты закрыты. Нет обязательств между участниками.")
     await msg.answer("\n".join(lines), parse_mode="HTML")
@@ -1207,13 +908,7 @@ def _format_rows(columns: list[str], rows: list[sqlite3.Row]) -> str:
 @router.message(Command("accounts"))
 async def cmd_show_accounts(msg: Message):
     """Показывает список записей в таблице accounts."""
-    from app.database import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, phone_number, full_name, telegram_login, bank, telegram_id FROM accounts")
-    rows = cur.fetchall()
-    conn.close()
-    columns = ["id", "phone_number", "full_name", "telegram_login", "bank", "telegram_id"]
+    columns, rows = await db.fetch_table("accounts")
     text = _format_rows(columns, rows)
     await msg.answer(f"<b>Таблица accounts:</b>\n{text}", parse_mode="HTML")
 
@@ -1221,13 +916,7 @@ async def cmd_show_accounts(msg: Message):
 @router.message(Command("positions_db"))
 async def cmd_show_positions_db(msg: Message):
     """Показывает содержимое таблицы positions."""
-    from app.database import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, group_id, name, quantity, price FROM positions ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    columns = ["id", "group_id", "name", "quantity", "price"]
+    columns, rows = await db.fetch_table("positions")
     text = _format_rows(columns, rows)
     await msg.answer(f"<b>Таблица positions:</b>\n{text}", parse_mode="HTML")
 
@@ -1235,13 +924,7 @@ async def cmd_show_positions_db(msg: Message):
 @router.message(Command("selected_positions_db"))
 async def cmd_show_selected_positions_db(msg: Message):
     """Показывает содержимое таблицы selected_positions."""
-    from app.database import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, group_id, user_tg_id, position_id, quantity, price FROM selected_positions ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    columns = ["id", "group_id", "user_tg_id", "position_id", "quantity", "price"]
+    columns, rows = await db.fetch_table("selected_positions")
     text = _format_rows(columns, rows)
     await msg.answer(f"<b>Таблица selected_positions:</b>\n{text}", parse_mode="HTML")
 
@@ -1249,13 +932,7 @@ async def cmd_show_selected_positions_db(msg: Message):
 @router.message(Command("payments_db"))
 async def cmd_show_payments_db(msg: Message):
     """Показывает содержимое таблицы payments."""
-    from app.database import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, tg_user_id, group_id, amount, positions FROM payments ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    columns = ["id", "tg_user_id", "group_id", "amount", "positions"]
+    columns, rows = await db.fetch_table("payments")
     text = _format_rows(columns, rows)
     await msg.answer(f"<b>Таблица payments:</b>\n{text}", parse_mode="HTML")
 
@@ -1263,12 +940,6 @@ async def cmd_show_payments_db(msg: Message):
 @router.message(Command("debts_db"))
 async def cmd_show_debts_db(msg: Message):
     """Показывает содержимое таблицы debts."""
-    from app.database import get_db_connection
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, receipt_id, user_tg_id, amount, created_at FROM debts ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    columns = ["id", "receipt_id", "user_tg_id", "amount", "created_at"]
+    columns, rows = await db.fetch_table("debts")
     text = _format_rows(columns, rows)
     await msg.answer(f"<b>Таблица debts:</b>\n{text}", parse_mode="HTML")
@@ -0,0 +1,96 @@
+"""
+Простые внутрипроцессные метрики.
+
+Счётчики, датчики (gauge) и сводки длительностей хранятся в памяти
+процесса и сбрасываются при перезапуске. Этого достаточно, чтобы видеть,
+как работают кэши и очереди бота, без внешней системы мониторинга:
+
+    from app import metrics
+
+    metrics.incr("auth_cache.hit")
+    metrics.set_gauge("auth_cache.size", 42)
+    metrics.observe("chat_lock.hold_ms", 12.5)
+    metrics.snapshot()   # {"counters": {...}, "gauges": {...}, "timings": {...}, "ratios": {...}}
+
+Для счётчиков вида ``<префикс>.hit`` / ``<префикс>.miss`` snapshot
+дополнительно считает долю попаданий ``<префикс>.hit_rate``. Функции
+потокобезопасны: их можно вызывать и из пула потоков базы данных.
+"""
+
+import threading
+import time
+
+_lock = threading.Lock()
+_counters: dict[str, int] = {}
+_gauges: dict[str, float] = {}
+# name → [count, sum, max]
+_timings: dict[str, list[float]] = {}
+_started_at = time.time()
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Увеличивает счётчик name на value."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Устанавливает текущее значение датчика name."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """Добавляет наблюдение value (например, длительность в мс) в сводку name."""
+    with _lock:
+        summary = _timings.get(name)
+        if summary is None:
+            _timings[name] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+def _hit_rates(counters: dict[str, int]) -> dict[str, float]:
+    # Попаданиями считаются все счётчики "<префикс>.*hit", промахом — "<префикс>.miss"
+    rates: dict[str, float] = {}
+    for name, misses in counters.items():
+        if not name.endswith(".miss"):
+            continue
+        prefix = name[: -len(".miss")]
+        hits = sum(
+            v for k, v in counters.items()
+            if k.startswith(prefix + ".") and k.endswith("hit")
+        )
+        total = hits + misses
+        if total:
+            rates[f"{prefix}.hit_rate"] = round(hits / total, 4)
+    return rates
+
+
+def snapshot() -> dict:
+    """Возвращает копию всех метрик и вычисленные доли попаданий."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timings = {
+            name: {"count": int(count), "avg": round(total / count, 3), "max": round(peak, 3)}
+            for name, (count, total, peak) in _timings.items()
+        }
+    return {
+        "uptime_seconds": int(time.time() - _started_at),
+        "counters": counters,
+        "gauges": gauges,
+        "timings": timings,
+        "ratios": _hit_rates(counters),
+    }
+
+
+def reset() -> None:
+    """Обнуляет все метрики."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
@@ -1,12 +1,17 @@
 """
 Middleware: проверяем, зарегистрирован ли пользователь.
+
+Результат проверки кэшируется (см. ``app.cache``), поэтому в активных
+группах база не запрашивается на каждое сообщение.
 """
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 
 # Используем общую базу данных из пакета ``app``, чтобы
 # middleware проверяло регистрацию в едином хранилище пользователей.
-from app.database import get_user
+from app import async_database as db
+from app.cache import get_registration, remember_registration
+from services.messaging import dispatcher
 
 class AuthRequiredMiddleware(BaseMiddleware):
     async def __call__(self, handler, event, data):
@@ -16,22 +21,23 @@ class AuthRequiredMiddleware(BaseMiddleware):
             # Разрешаем всё в личных чатах
             if event.chat.type == "private":
                 return await handler(event, data)
-            # Проверяем регистрацию для группы
-            user = get_user(user_id)
-            if user is None:
+            # Проверяем регистрацию для группы: сначала кэш, затем база
+            registered = get_registration(user_id)
+            if registered is None:
+                registered = await db.get_user(user_id) is not None
+                remember_registration(user_id, registered)
+            if not registered:
                 # В личку отправляем только если нет регистрации!
-                try:
-                    await event.bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            "👋 Вы пытаетесь воспользоваться ботом в группе, "
-                            "но ещё не зарегистрированы.\n"
-                            "Напишите /start, "
-                            "чтобы пройти регистрацию."
-                        )
-                    )
-                except Exception:
-                    pass  # возможно, пользователь не писал боту в личку (Telegram API restriction)
+                # Через общий диспетчер, чтобы не упираться в лимиты Telegram;
+                # ошибка (пользователь не писал боту в личку) не прерывает обработку
+                await dispatcher.send(
+                    event.bot,
+                    user_id,
+                    "👋 Вы пытаетесь воспользоваться ботом в группе, "
+                    "но ещё не зарегистрированы.\n"
+                    "Напишите /start, "
+                    "чтобы пройти регистрацию.",
+                )
                 # В группе отвечаем коротко, чтобы не спамить
                 await event.reply("ℹ️ Для использования бота зарегистрируйтесь в личных сообщениях. Инструкция отправлена вам в личку.", reply=False)
                 return  # Больше ничего не делаем
@@ -0,0 +1,78 @@
+"""
+Middleware: последовательное выполнение изменяющих обработчиков в одном чате.
+
+Апдейты aiogram обрабатываются конкурентно, поэтому без блокировки два
+обработчика одной группы могут работать одновременно: например,
+handle_photo добавляет позиции, пока finalize_receipt архивирует и
+очищает данные, или два /finalize дублируют долги и личные сообщения.
+
+Обработчик, помеченный флагом ``chat_lock``, выполняется под блокировкой
+своего чата:
+
+    @router.message(Command("finalize"), flags={"chat_lock": True})
+
+Блокировки разных чатов независимы, так что группы обрабатываются
+параллельно; обработчики без флага (просмотр, справка) не ждут вовсе.
+asyncio.Lock пропускает ожидающих в порядке очереди, поэтому изменяющие
+апдейты одного чата выполняются в порядке поступления. Внутри
+обработчика без флага ту же блокировку можно взять явно:
+
+    async with chat_locks.hold(chat_id):
+        ...
+
+Метрики: chat_lock.wait_ms (ожидание блокировки), chat_lock.hold_ms
+(время под блокировкой), датчик chat_lock.active_chats.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+
+from app import metrics
+
+
+class ChatLocks:
+    """Реестр блокировок по chat_id; блокировка удаляется, когда её никто не ждёт."""
+
+    def __init__(self) -> None:
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiters: dict[int, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int) -> AsyncIterator[None]:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+            metrics.set_gauge("chat_lock.active_chats", len(self._locks))
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+        requested = time.monotonic()
+        try:
+            async with lock:
+                acquired = time.monotonic()
+                metrics.observe("chat_lock.wait_ms", (acquired - requested) * 1000)
+                try:
+                    yield
+                finally:
+                    metrics.observe("chat_lock.hold_ms", (time.monotonic() - acquired) * 1000)
+        finally:
+            self._waiters[chat_id] -= 1
+            if not self._waiters[chat_id]:
+                del self._waiters[chat_id]
+                del self._locks[chat_id]
+                metrics.set_gauge("chat_lock.active_chats", len(self._locks))
+
+
+# Общий реестр процесса: и middleware, и явные блокировки в обработчиках
+chat_locks = ChatLocks()
+
+
+class ChatLockMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None or not get_flag(data, "chat_lock"):
+            return await handler(event, data)
+        async with chat_locks.hold(chat.id):
+            return await handler(event, data)
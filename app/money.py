@@ -0,0 +1,50 @@
+"""
+Денежные суммы в целых копейках.
+
+В таблицах базы цены и суммы хранятся целым числом копеек, и весь расчёт
+(``app.settlement``) ведётся в копейках без округлений на каждом шаге.
+В рубли значения переводятся только на границе: при разборе ввода
+(to_kopecks) и при выводе пользователю (format_rub, from_kopecks).
+"""
+
+import math
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Any
+
+KOPECKS_PER_RUBLE: int = 100
+
+
+def to_kopecks(value: Any) -> int:
+    """
+    Переводит сумму в рублях (число или строку, допускается запятая) в
+    копейки с округлением половины вверх. Пустое или некорректное значение
+    считается нулём.
+    """
+    if value is None or value == "":
+        return 0
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * KOPECKS_PER_RUBLE
+    try:
+        rubles = Decimal(str(value).replace(",", ".").strip())
+        return int((rubles * KOPECKS_PER_RUBLE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return 0
+
+
+def from_kopecks(kopecks: int | None) -> float:
+    """Переводит копейки в рубли (для API, где суммы исторически float)."""
+    return (kopecks or 0) / KOPECKS_PER_RUBLE
+
+
+def multiply(quantity: float, price: int) -> int:
+    """Стоимость quantity единиц по цене price копеек, округлённая до копейки (половина вверх)."""
+    return math.floor(quantity * price + 0.5)
+
+
+def format_rub(kopecks: int) -> str:
+    """Форматирует сумму для сообщений: 1950 ₽ → "1950", 683,33 ₽ → "683.33"."""
+    sign = "-" if kopecks < 0 else ""
+    rubles, rest = divmod(abs(int(kopecks)), KOPECKS_PER_RUBLE)
+    if rest:
+        return f"{sign}{rubles}.{rest:02d}"
+    return f"{sign}{rubles}"
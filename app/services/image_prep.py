@@ -0,0 +1,419 @@
+"""
+Подготовка фотографии чека перед распознаванием.
+
+Qwen‑VL берёт за изображение по токену на каждый квадрат 28×28 пикселей,
+поэтому стоимость и время распознавания чека определяются в основном
+размером картинки, а не текстом запроса. Фотография из Telegram — это
+чек вместе с рукой, столом и фоном, часто снятый с запасом по
+разрешению. ``prepare_receipt_image`` перед отправкой в LLM:
+
+1. обрезает изображение по бумаге чека (светлая и ненасыщенная область);
+2. выравнивает наклон строк (до ±IMAGE_MAX_SKEW градусов) по профилю
+   проекции текста;
+3. переводит в оттенки серого и растягивает контраст;
+4. уменьшает так, чтобы высота строки текста была не больше
+   IMAGE_LINE_HEIGHT пикселей — мельче модель начинает ошибаться в
+   цифрах, крупнее — лишние токены. Размер выравнивается вниз до кратного
+   28 (сетка токенов Qwen‑VL), общее число токенов — не больше
+   IMAGE_MAX_TOKENS. Изображение никогда не увеличивается. Для
+   первой, дешёвой попытки распознавания используется меньшая высота
+   строки — IMAGE_LOW_LINE_HEIGHT (см. ``llm_api.extract_items_from_image``);
+5. кодирует в JPEG с качеством IMAGE_JPEG_QUALITY.
+
+Если какой‑то шаг не уверен в результате (бумага не найдена, строки не
+выделяются), он пропускается, а при любой ошибке в LLM уходит исходное
+изображение — подготовка только экономит токены и не должна мешать
+распознаванию.
+
+Обработка занимает 50–200 мс процессорного времени на чек, поэтому
+выполняется в пуле процессов (IMAGE_PREP_WORKERS), а не в цикле событий.
+Пул создаётся форком; ``start()`` в начале работы бота запускает его до
+появления других потоков:
+
+    from services.image_prep import prepare_receipt_image
+
+    image_bytes, info = await prepare_receipt_image(raw_bytes)
+
+Там же ``receipt_fiscal_key`` читает фискальный QR‑код чека (нужен
+zxing-cpp) — по нему узнаются повторно присланные чеки.
+"""
+
+import asyncio
+import io
+import logging
+import math
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+from urllib.parse import parse_qs
+
+from app import metrics
+
+try:
+    from PIL import Image, ImageChops, ImageFilter, ImageOps
+except ImportError:  # Pillow не установлен — изображение отправляется как есть
+    Image = None
+try:
+    import zxingcpp
+except ImportError:  # без zxing-cpp QR‑код чека не читается, повтор узнаётся только по file_unique_id
+    zxingcpp = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREP_ENABLED: bool = os.getenv("IMAGE_PREP_ENABLED", "1") != "0"
+IMAGE_PREP_WORKERS: int = int(os.getenv("IMAGE_PREP_WORKERS", "2"))
+IMAGE_LINE_HEIGHT: float = float(os.getenv("IMAGE_LINE_HEIGHT", "14"))
+IMAGE_LOW_LINE_HEIGHT: float = float(os.getenv("IMAGE_LOW_LINE_HEIGHT", "9"))
+IMAGE_MAX_TOKENS: int = int(os.getenv("IMAGE_MAX_TOKENS", "2048"))
+IMAGE_MAX_SKEW: float = float(os.getenv("IMAGE_MAX_SKEW", "6"))
+IMAGE_JPEG_QUALITY: int = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+
+# Сторона квадрата, который Qwen‑VL кодирует одним токеном
+_PATCH = 28
+# Размер уменьшенной копии для поиска бумаги
+_CROP_SIDE = 256
+# Размер копии для поиска наклона
+_SKEW_SIDE = 800
+# Обрезка, отрезающая меньше этой доли площади, не стоит потери полей
+_MIN_CROP_GAIN = 0.1
+# Найденная «бумага» меньше этой доли кадра — скорее ошибка, чем чек
+_MIN_PAPER_AREA = 0.15
+# Насколько пиксель текста темнее окрестности (из 255)
+_TEXT_CONTRAST = 20
+# Во сколько раз поворот должен улучшить профиль строк, чтобы его делать
+_MIN_SKEW_GAIN = 1.05
+# На сколько вертикальных полос делится чек при измерении высоты строк
+_LINE_STRIPS = 8
+# Меньше строк — на изображении нет текста, масштаб не выбрать
+_MIN_LINES = 40
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def image_tokens(width: int, height: int) -> int:
+    """Оценка числа токенов изображения в Qwen‑VL (как в cost.ipynb)."""
+    tokens = (round(width / _PATCH) * _PATCH) * (round(height / _PATCH) * _PATCH) // (_PATCH * _PATCH)
+    return min(max(tokens, 4), 16384) + 2
+
+
+def _otsu(histogram: list[int]) -> int:
+    """Порог Оцу по гистограмме 8‑битного канала."""
+    total = sum(histogram)
+    weighted_total = sum(i * count for i, count in enumerate(histogram))
+    below = weighted_below = 0
+    best, threshold = -1.0, 127
+    for t, count in enumerate(histogram):
+        below += count
+        if below == 0:
+            continue
+        above = total - below
+        if above == 0:
+            break
+        weighted_below += t * count
+        diff = weighted_below / below - (weighted_total - weighted_below) / above
+        variance = below * above * diff * diff
+        if variance > best:
+            best, threshold = variance, t
+    return threshold
+
+
+def _profile(image: "Image.Image", axis: int) -> list[int]:
+    """Средние значения по строкам (axis=0) или по столбцам (axis=1)."""
+    size = (1, image.height) if axis == 0 else (image.width, 1)
+    return list(image.resize(size, Image.BOX).tobytes())
+
+
+def _run(values: list[float], level: float) -> tuple[int, int] | None:
+    """Самый длинный непрерывный отрезок, где values >= level: [start, end)."""
+    best = None
+    start = None
+    for i, value in enumerate(values + [-1.0]):
+        if value >= level:
+            if start is None:
+                start = i
+        elif start is not None:
+            if best is None or i - start > best[1] - best[0]:
+                best = (start, i)
+            start = None
+    return best
+
+
+def _paper_box(image: "Image.Image") -> tuple[int, int, int, int] | None:
+    """
+    Прямоугольник бумаги чека в координатах image или None.
+
+    Бумага — самая светлая и наименее насыщенная область кадра: порог Оцу
+    по «яркость минус насыщенность» отделяет её от руки, стола и фона.
+    Границы по горизонтали — самый длинный отрезок столбцов, где маска
+    занимает не меньше 60 % от максимума (рука или светлая одежда рядом с
+    чеком дают меньше); по вертикали в этих столбцах достаточно 30 %:
+    край чека бывает прикрыт пальцами.
+    """
+    small = image.copy()
+    small.thumbnail((_CROP_SIDE, _CROP_SIDE))
+    _hue, saturation, value = small.convert("HSV").split()
+    score = ImageChops.subtract(value, saturation)
+    # Закрытие: текст на бумаге не должен дырявить маску
+    score = score.filter(ImageFilter.MaxFilter(5)).filter(ImageFilter.MinFilter(5))
+    threshold = _otsu(score.histogram())
+    mask = score.point(lambda p: 255 if p > threshold else 0)
+
+    columns = _profile(mask, axis=1)
+    x_run = _run(columns, 0.6 * max(columns))
+    if x_run is None or max(columns) == 0:
+        return None
+    rows = _profile(mask.crop((x_run[0], 0, x_run[1], mask.height)), axis=0)
+    y_run = _run(rows, 0.3 * max(rows))
+    if y_run is None:
+        return None
+
+    # Поля в 2 % кадра, чтобы не срезать край текста
+    fx, fy = image.width / small.width, image.height / small.height
+    margin_x, margin_y = 0.02 * image.width, 0.02 * image.height
+    box = (
+        max(0, int(x_run[0] * fx - margin_x)),
+        max(0, int(y_run[0] * fy - margin_y)),
+        min(image.width, int(x_run[1] * fx + margin_x)),
+        min(image.height, int(y_run[1] * fy + margin_y)),
+    )
+    area = (box[2] - box[0]) * (box[3] - box[1]) / (image.width * image.height)
+    if area < _MIN_PAPER_AREA or area > 1 - _MIN_CROP_GAIN:
+        return None
+    return box
+
+
+def _text_mask(gray: "Image.Image") -> "Image.Image":
+    """
+    Маска текста (255) — пиксели заметно темнее своей окрестности.
+
+    Локальный порог, а не общий: на фотографии чека освещение неровное
+    (тень от руки, блик), и общий порог принимает затенённую бумагу за
+    текст.
+    """
+    radius = max(8, gray.width // 40)
+    background = gray.filter(ImageFilter.BoxBlur(radius))
+    return ImageChops.subtract(background, gray).point(lambda p: 255 if p > _TEXT_CONTRAST else 0)
+
+
+def _skew_angle(mask: "Image.Image", max_skew: float) -> float:
+    """
+    Угол (в градусах, против часовой), на который нужно повернуть чек,
+    чтобы строки стали горизонтальными.
+
+    Перебирает углы и выбирает тот, при котором профиль проекции маски
+    текста на вертикальную ось самый «контрастный» (максимальная дисперсия
+    сумм по строкам): у горизонтальных строк чередуются плотные и пустые
+    ряды. Если лучший угол меньше 0,3° или даёт выигрыш меньше 5 %,
+    возвращает 0.
+    """
+    small = mask.copy()
+    small.thumbnail((_SKEW_SIDE, _SKEW_SIDE))
+
+    def sharpness(angle: float) -> float:
+        rows = _profile(small.rotate(angle, resample=Image.NEAREST), axis=0)
+        mean = sum(rows) / len(rows)
+        return sum((r - mean) ** 2 for r in rows)
+
+    coarse = [float(i) for i in range(-int(max_skew), int(max_skew) + 1)]
+    best = max(coarse, key=sharpness)
+    fine = [best + i * 0.1 for i in range(-5, 6)]
+    best = max(fine, key=sharpness)
+    # Поворот добавляет поля (и токены) и размывает текст: он нужен, только
+    # если строки заметно выравниваются. У изогнутого чека единого угла нет
+    if abs(best) < 0.3 or sharpness(best) <= _MIN_SKEW_GAIN * sharpness(0.0):
+        return 0.0
+    return best
+
+
+def _line_height(mask: "Image.Image") -> int | None:
+    """
+    Высота строки текста в пикселях или None, если строк почти нет.
+
+    Маска делится на узкие вертикальные полосы (в узкой полосе наклон и
+    изгиб чека почти не размывают строки); в каждой полосе ряды с текстом
+    образуют отрезки — строки. Берётся медиана их высот.
+    """
+    heights: list[int] = []
+    for i in range(_LINE_STRIPS):
+        strip = mask.crop((mask.width * i // _LINE_STRIPS, 0, mask.width * (i + 1) // _LINE_STRIPS, mask.height))
+        rows = strip.resize((1, mask.height), Image.BOX).point(lambda p: 255 if p > 10 else 0)
+        # Отрезки ищутся регулярным выражением по байтам, без цикла по пикселям
+        heights.extend(m.end() - m.start() for m in re.finditer(rb"\xff+", rows.tobytes()))
+    heights = sorted(h for h in heights if h >= 3)
+    if len(heights) < _MIN_LINES:
+        return None
+    return heights[len(heights) // 2]
+
+
+def _target_size(width: int, height: int, scale: float, max_tokens: int) -> tuple[int, int]:
+    """Размер после уменьшения: не больше max_tokens токенов, кратно 28."""
+    budget = max_tokens * _PATCH * _PATCH
+    if width * height * scale * scale > budget:
+        scale = math.sqrt(budget / (width * height))
+    scale = min(scale, 1.0)
+    return (
+        max(_PATCH, int(width * scale) // _PATCH * _PATCH),
+        max(_PATCH, int(height * scale) // _PATCH * _PATCH),
+    )
+
+
+def preprocess_receipt(
+    data: bytes,
+    line_height: float = IMAGE_LINE_HEIGHT,
+    max_tokens: int = IMAGE_MAX_TOKENS,
+    max_skew: float = IMAGE_MAX_SKEW,
+    quality: int = IMAGE_JPEG_QUALITY,
+) -> tuple[bytes, dict[str, Any]]:
+    """
+    Синхронная подготовка изображения (выполняется в процессе пула).
+
+    Возвращает JPEG и сведения о шагах: размеры, токены до и после, рамку
+    обрезки, угол поворота, высоту строки.
+    """
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB")
+    info: dict[str, Any] = {
+        "original_size": image.size,
+        "original_tokens": image_tokens(*image.size),
+        "original_bytes": len(data),
+    }
+
+    box = _paper_box(image)
+    if box is not None:
+        image = image.crop(box)
+    info["crop"] = box
+
+    gray = image.convert("L")
+    mask = _text_mask(gray)
+    height = _line_height(mask)
+    info["line_height"] = height
+    # Без строк текста не выбрать ни угол, ни масштаб
+    angle = _skew_angle(mask, max_skew) if height and max_skew > 0 else 0.0
+    if angle:
+        gray = gray.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    info["angle"] = round(angle, 1)
+    gray = ImageOps.autocontrast(gray, cutoff=0.5)
+
+    scale = line_height / height if height else 1.0
+    size = _target_size(gray.width, gray.height, scale, max_tokens)
+    if size != gray.size:
+        gray = gray.resize(size, Image.LANCZOS)
+
+    out = io.BytesIO()
+    gray.save(out, format="JPEG", quality=quality, optimize=True)
+    info.update(size=gray.size, tokens=image_tokens(*gray.size), bytes=out.tell())
+    if info["tokens"] >= info["original_tokens"] and info["bytes"] >= len(data):
+        # Подготовка ничего не сэкономила — отправляем исходное изображение
+        info.update(size=info["original_size"], tokens=info["original_tokens"], bytes=len(data))
+        return data, info
+    return out.getvalue(), info
+
+
+def _fiscal_key(gray: "Image.Image") -> str | None:
+    """Ключ чека «ФН:ФД:ФП» из QR‑кода (t=...&s=...&fn=...&i=...&fp=...)."""
+    if zxingcpp is None:
+        return None
+    for barcode in zxingcpp.read_barcodes(gray, formats=zxingcpp.BarcodeFormat.QRCode):
+        fields = parse_qs(barcode.text)
+        parts = [fields.get(name, [""])[0].strip() for name in ("fn", "i", "fp")]
+        if all(parts):
+            return ":".join(parts)
+    return None
+
+
+def read_fiscal_key(data: bytes) -> str | None:
+    """
+    Синхронное чтение ключа чека из QR‑кода (выполняется в процессе пула).
+
+    Ключ одинаков на любом снимке одного чека и разный у разных чеков даже
+    одного магазина и одинаковой вёрстки. None — QR‑код не найден или не
+    прочитан (размытое фото).
+    """
+    return _fiscal_key(ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("L"))
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            # Форк не импортирует заново модули бота в каждом процессе пула
+            context = multiprocessing.get_context("fork")
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_PREP_WORKERS, mp_context=context)
+    return _executor
+
+
+async def start() -> None:
+    """Запускает процессы пула заранее (вызывается при старте бота)."""
+    if Image is not None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_get_executor(), image_tokens, 0, 0)
+
+
+def shutdown() -> None:
+    """Останавливает пул процессов."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def prepare_receipt_image(
+    data: bytes, line_height: float = IMAGE_LINE_HEIGHT
+) -> tuple[bytes, dict[str, Any]]:
+    """
+    Подготавливает фотографию чека к распознаванию в пуле процессов.
+
+    Возвращает изображение и сведения о подготовке (см.
+    ``preprocess_receipt``). При выключенной подготовке, без Pillow или при
+    ошибке возвращает data без изменений и пустые сведения.
+    """
+    global _executor
+    if not IMAGE_PREP_ENABLED or Image is None:
+        return data, {}
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        result, info = await loop.run_in_executor(_get_executor(), preprocess_receipt, data, line_height)
+    except BrokenProcessPool as e:
+        # Процесс пула погиб: следующий вызов создаст пул заново
+        _executor = None
+        metrics.incr("image_prep.errors")
+        logger.warning("Ошибка подготовки изображения: %s", e, exc_info=True)
+        return data, {}
+    except Exception as e:
+        metrics.incr("image_prep.errors")
+        logger.warning("Ошибка подготовки изображения: %s", e, exc_info=True)
+        return data, {}
+    metrics.observe("image_prep.ms", (time.perf_counter() - started) * 1000)
+    return result, info
+
+
+async def receipt_fiscal_key(data: bytes) -> str | None:
+    """
+    Ключ чека из QR‑кода в пуле процессов (см. ``read_fiscal_key``).
+
+    Без Pillow или zxing-cpp и при ошибке возвращает None — чек распознаётся
+    как новый.
+    """
+    global _executor
+    if Image is None or zxingcpp is None:
+        return None
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(_get_executor(), read_fiscal_key, data)
+    except BrokenProcessPool as e:
+        _executor = None
+        metrics.incr("image_prep.errors")
+        logger.warning("Ошибка чтения QR‑кода чека: %s", e, exc_info=True)
+        return None
+    except Exception as e:
+        metrics.incr("image_prep.errors")
+        logger.warning("Ошибка чтения QR‑кода чека: %s", e, exc_info=True)
+        return None
+    metrics.observe("image_prep.qr_ms", (time.perf_counter() - started) * 1000)
+    return result
@@ -0,0 +1,292 @@
+"""
+Обновления мини‑приложения в реальном времени (Server-Sent Events).
+
+Участники, у которых открыт ``receipt.html``, подписываются на
+``/webapp/api/live?group_id=...`` и получают изменения выбора других
+участников без перезагрузки страницы:
+
+* ``snapshot`` — полное состояние: позиции и выборы всех участников.
+  Отправляется при подключении и когда изменился сам список позиций;
+* ``delta`` — изменившиеся выборы: ``{"position": индекс, "user_id": ...,
+  "quantity": ..., "equal": ...}``; quantity = 0 и equal = false — выбор
+  снят.
+
+Выбор сохраняют и бот, и мини‑приложение — это разные процессы, поэтому
+изменения обнаруживаются по версии группы в базе (``group_versions``).
+``LiveHub`` держит одну задачу на процесс, которая раз в
+LIVE_POLL_INTERVAL секунд одним запросом читает версии всех
+просматриваемых групп; состояние изменившейся группы читается один раз и
+сравнивается с предыдущим, а событие сериализуется один раз и
+раскладывается в очереди всех подписчиков группы. Стоимость опроса не
+зависит от числа зрителей. Запись из этого же процесса будит задачу сразу
+(``hub.notify``).
+
+Медленный клиент не задерживает остальных: очередь подписчика ограничена
+LIVE_QUEUE_SIZE событиями, при переполнении накопленные события
+отбрасываются и клиент получает одно актуальное ``snapshot``. Если событий
+нет, раз в LIVE_HEARTBEAT_INTERVAL секунд отправляется комментарий‑пинг,
+чтобы прокси не закрыл соединение (proxy_read_timeout в nginx.conf —
+300 секунд). Одновременно обслуживается не больше LIVE_MAX_SUBSCRIBERS
+подписчиков.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+from app import async_database as db, metrics
+from app.money import from_kopecks
+
+logger = logging.getLogger(__name__)
+
+LIVE_POLL_INTERVAL: float = float(os.getenv("LIVE_POLL_INTERVAL", "1.0"))
+LIVE_HEARTBEAT_INTERVAL: float = float(os.getenv("LIVE_HEARTBEAT_INTERVAL", "15"))
+LIVE_QUEUE_SIZE: int = int(os.getenv("LIVE_QUEUE_SIZE", "16"))
+LIVE_MAX_SUBSCRIBERS: int = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "5000"))
+
+# Через сколько миллисекунд браузер переподключается после обрыва
+_RETRY_MS = 3000
+# Метка в очереди подписчика: вместо пропущенных событий нужен snapshot
+_RESYNC = object()
+
+
+def _sse(event: str, version: int, data: str) -> str:
+    return f"id: {version}\nevent: {event}\ndata: {data}\n\n"
+
+
+@dataclass
+class GroupState:
+    """Состояние группы, которое видит мини‑приложение."""
+
+    version: int
+    # Позиции в порядке id: (id, name, quantity, price в рублях)
+    positions: list[tuple[int, str, float, float]]
+    # (position_id, user_id) → (количество, поровну)
+    claims: dict[tuple[int, int], tuple[float, bool]] = field(default_factory=dict)
+    # Сериализованный snapshot: одно состояние отправляется многим подписчикам
+    _snapshot: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_rows(cls, version: int, positions: list, claims: list) -> "GroupState":
+        return cls(
+            version,
+            [(row["id"], row["name"], row["quantity"], from_kopecks(row["price"])) for row in positions],
+            {
+                (row["position_id"], row["user_id"]): (row["quantity"] or 0, bool(row["equal"]))
+                for row in claims
+            },
+        )
+
+    def _indices(self) -> dict[int, int]:
+        return {position_id: idx for idx, (position_id, *_rest) in enumerate(self.positions)}
+
+    def _claim_items(self, keys, indices: dict[int, int]) -> list[dict[str, Any]]:
+        items = []
+        for position_id, user_id in keys:
+            idx = indices.get(position_id)
+            if idx is None:
+                continue
+            quantity, equal = self.claims.get((position_id, user_id), (0, False))
+            items.append({"position": idx, "user_id": user_id, "quantity": quantity, "equal": equal})
+        return items
+
+    def snapshot(self) -> str:
+        """Событие snapshot (данные в JSON)."""
+        if self._snapshot is None:
+            self._snapshot = json.dumps(
+                {
+                    "version": self.version,
+                    "positions": [
+                        {"name": name, "quantity": quantity, "price": price}
+                        for _id, name, quantity, price in self.positions
+                    ],
+                    "claims": self._claim_items(sorted(self.claims), self._indices()),
+                },
+                ensure_ascii=False,
+            )
+        return self._snapshot
+
+    def diff(self, old: "GroupState") -> tuple[str, str]:
+        """
+        Событие (тип, данные в JSON), переводящее клиента из old в это состояние.
+
+        Если изменилась только версия (например, добавлен платёж), delta
+        приходит с пустым списком изменений: клиент узнаёт новую версию и
+        не получит 409 при отправке выбора.
+        """
+        if self.positions != old.positions:
+            return "snapshot", self.snapshot()
+        changed = sorted(
+            key for key in self.claims.keys() | old.claims.keys()
+            if self.claims.get(key) != old.claims.get(key)
+        )
+        data = {"version": self.version, "changes": self._claim_items(changed, self._indices())}
+        return "delta", json.dumps(data, ensure_ascii=False)
+
+
+class Subscriber:
+    """Очередь событий одного подключения."""
+
+    def __init__(self, maxsize: int = LIVE_QUEUE_SIZE) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    def offer(self, event: Any) -> None:
+        """Кладёт событие в очередь; при переполнении заменяет очередь меткой resync."""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            first = self.queue.get_nowait()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_RESYNC)
+            if first is not _RESYNC:
+                metrics.incr("live.resync")
+
+
+class GroupChannel:
+    """Подписчики одной группы и последнее отправленное им состояние."""
+
+    def __init__(self, group_id: str) -> None:
+        self.group_id = group_id
+        self.subscribers: set[Subscriber] = set()
+        self.state: GroupState | None = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> None:
+        """Перечитывает состояние группы и рассылает подписчикам изменения."""
+        async with self._lock:
+            new = GroupState.from_rows(*await db.load_group_claims(self.group_id))
+            old, self.state = self.state, new
+            if old is None or old.version == new.version:
+                return
+            kind, data = new.diff(old)
+            # Сериализуется один раз на группу, а не на каждого подписчика
+            message = (new.version, _sse(kind, new.version, data))
+            for subscriber in list(self.subscribers):
+                subscriber.offer(message)
+            metrics.incr(f"live.{kind}")
+
+
+class TooManySubscribers(Exception):
+    """Достигнут предел LIVE_MAX_SUBSCRIBERS."""
+
+
+class LiveHub:
+    """Подписки процесса и общая задача опроса версий групп."""
+
+    def __init__(
+        self,
+        poll_interval: float = LIVE_POLL_INTERVAL,
+        heartbeat_interval: float = LIVE_HEARTBEAT_INTERVAL,
+        max_subscribers: int = LIVE_MAX_SUBSCRIBERS,
+    ) -> None:
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_subscribers = max_subscribers
+        self._channels: dict[str, GroupChannel] = {}
+        self._subscribers = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def full(self) -> bool:
+        return self._subscribers >= self.max_subscribers
+
+    def notify(self, group_id: str) -> None:
+        """Сообщает, что группа изменилась в этом процессе: опрос выполнится сразу."""
+        if str(group_id) in self._channels:
+            self._wakeup.set()
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("live.subscribers", self._subscribers)
+        metrics.set_gauge("live.groups", len(self._channels))
+
+    async def _subscribe(self, group_id: str) -> tuple[GroupChannel, Subscriber]:
+        if self.full:
+            raise TooManySubscribers(group_id)
+        channel = self._channels.get(group_id)
+        if channel is None:
+            channel = self._channels[group_id] = GroupChannel(group_id)
+        subscriber = Subscriber()
+        channel.subscribers.add(subscriber)
+        self._subscribers += 1
+        self._update_gauges()
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+        try:
+            if channel.state is None:
+                await channel.refresh()
+        except BaseException:
+            self._unsubscribe(channel, subscriber)
+            raise
+        return channel, subscriber
+
+    def _unsubscribe(self, channel: GroupChannel, subscriber: Subscriber) -> None:
+        if subscriber in channel.subscribers:
+            channel.subscribers.discard(subscriber)
+            self._subscribers -= 1
+        if not channel.subscribers and self._channels.get(channel.group_id) is channel:
+            del self._channels[channel.group_id]
+        self._update_gauges()
+
+    async def _watch(self) -> None:
+        # Работает, пока есть подписчики; следующая подписка запустит заново
+        try:
+            while self._channels:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    versions = await db.get_group_versions(list(self._channels))
+                    for group_id, channel in list(self._channels.items()):
+                        if channel.state is not None and versions.get(group_id, 0) != channel.state.version:
+                            await channel.refresh()
+                    metrics.incr("live.polls")
+                except Exception as e:
+                    metrics.incr("live.poll_errors")
+                    logger.warning("Ошибка опроса версий групп: %s", e, exc_info=True)
+        finally:
+            self._task = None
+
+    async def stream(self, group_id: str, last_event_id: int | None = None) -> AsyncIterator[str]:
+        """
+        Поток событий SSE для одного подключения.
+
+        last_event_id — версия из заголовка Last-Event-ID при переподключении:
+        если она совпадает с текущей, snapshot не отправляется повторно.
+        """
+        channel, subscriber = await self._subscribe(str(group_id))
+        try:
+            yield f"retry: {_RETRY_MS}\n\n"
+            state = channel.state
+            sent = state.version
+            if last_event_id != state.version:
+                yield _sse("snapshot", state.version, state.snapshot())
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscriber.queue.get(), self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if item is _RESYNC:
+                    state = channel.state
+                    sent = state.version
+                    yield _sse("snapshot", state.version, state.snapshot())
+                    continue
+                version, message = item
+                # Событие уже учтено в отправленном snapshot
+                if version <= sent:
+                    continue
+                sent = version
+                yield message
+        finally:
+            self._unsubscribe(channel, subscriber)
+
+
+# Общий хаб процесса мини‑приложения
+hub = LiveHub()
@@ -23,12 +23,25 @@ import os
 import io
 import base64
 import asyncio
-from typing import List, Optional
+import heapq
+import logging
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
 from pydantic import BaseModel, Field, RootModel
 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
 
+from app import metrics
+from app.cache import MISSING
+from app.money import to_kopecks
+from services.llm_cache import normalize_phrase, normalize_text, response_cache
+from services.image_prep import IMAGE_LINE_HEIGHT, IMAGE_LOW_LINE_HEIGHT, prepare_receipt_image
+
+logger = logging.getLogger(__name__)
+
 # 1) Модель структурированного ответа
 class Item(BaseModel):
     name: str = Field(description="Название позиции")
@@ -38,6 +51,13 @@ class Item(BaseModel):
 class ReceiptItems(RootModel[List[Item]]):
     pass
 
+class ReceiptScan(BaseModel):
+    """Распознанный чек: позиции и напечатанный итог (для проверки)."""
+    items: List[Item] = Field(description="Позиции чека")
+    total: Optional[float] = Field(
+        default=None, description="Итоговая сумма, напечатанная на чеке (ИТОГ), или null"
+    )
+
 # 2) Инициализация LLM через OpenRouter (OpenAI-совместимый API)
 #    Храните ключ в переменной окружения OPENROUTER_API_KEY
 llm = ChatOpenAI(
@@ -55,12 +75,138 @@ structured_llm = llm.with_structured_output(
     include_raw=True
 )
 
+structured_receipt_llm = llm.with_structured_output(
+    ReceiptScan,
+    include_raw=True
+)
+
+
+# 4) Планировщик запросов к LLM. Все вызовы модели проходят через
+#    scheduler.slot(): одновременно к одной модели идёт не больше
+#    LLM_MAX_CONCURRENCY запросов (бесплатная квота OpenRouter общая на
+#    ключ), остальные ждут в очереди по приоритету — классификация
+#    сообщения раньше разбора текста, разбор текста раньше распознавания
+#    чеков. Если впереди в очереди уже LLM_QUEUE_LIMIT_<КЛАСС> запросов,
+#    запрос отбрасывается (LLMOverloaded) и вызывающий код отвечает
+#    эвристикой: classify_message_heuristic, _extract_items_from_text_regex
+#    или регулярками платежей. 0 — очередь класса не ограничена (чеки ждут,
+#    запасного способа их прочитать нет).
+#    Метрики: llm.in_flight, llm.queue.<класс> (глубина очереди),
+#    llm.wait_ms.<класс>, llm.shed.<класс>.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_TEXT = 1
+PRIORITY_BULK = 2
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_TEXT: "text", PRIORITY_BULK: "bulk"}
+
+LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_QUEUE_LIMITS: dict[int, int] = {
+    PRIORITY_INTERACTIVE: int(os.getenv("LLM_QUEUE_LIMIT_INTERACTIVE", "8")),
+    PRIORITY_TEXT: int(os.getenv("LLM_QUEUE_LIMIT_TEXT", "16")),
+    PRIORITY_BULK: int(os.getenv("LLM_QUEUE_LIMIT_BULK", "0")),
+}
+
+
+class LLMOverloaded(Exception):
+    """Очередь запросов к модели слишком длинная — запрос отброшен."""
+
+
+class _ModelQueue:
+    """Занятые слоты и очередь ожидающих запросов одной модели."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        # (приоритет, порядковый номер, future) — куча по приоритету, FIFO внутри
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+
+
+class LLMScheduler:
+    """Ограничение одновременных запросов к моделям с приоритетной очередью."""
+
+    def __init__(self, concurrency: int = LLM_MAX_CONCURRENCY, queue_limits: dict[int, int] | None = None) -> None:
+        self.concurrency = concurrency
+        self.queue_limits = LLM_QUEUE_LIMITS if queue_limits is None else queue_limits
+        self._models: dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+
+    def depth(self, priority: int | None = None) -> int:
+        """Число ожидающих запросов (всех или одного класса) по всем моделям."""
+        return sum(
+            1 for state in self._models.values() for p, _, _ in state.waiters
+            if priority is None or p == priority
+        )
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("llm.in_flight", sum(state.in_flight for state in self._models.values()))
+        for priority, name in _PRIORITY_NAMES.items():
+            metrics.set_gauge(f"llm.queue.{name}", self.depth(priority))
+
+    async def _acquire(self, model: str, priority: int) -> None:
+        state = self._models.setdefault(model, _ModelQueue())
+        if state.in_flight < self.concurrency and not state.waiters:
+            state.in_flight += 1
+            self._update_gauges()
+            return
+        name = _PRIORITY_NAMES.get(priority, str(priority))
+        limit = self.queue_limits.get(priority, 0)
+        ahead = sum(1 for p, _, _ in state.waiters if p <= priority)
+        if limit and ahead >= limit:
+            metrics.incr(f"llm.shed.{name}")
+            raise LLMOverloaded(f"{model}: в очереди {ahead} запросов")
+        entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(state.waiters, entry)
+        self._update_gauges()
+        started = time.perf_counter()
+        try:
+            await entry[2]
+        except BaseException:
+            if entry[2].done() and not entry[2].cancelled():
+                # Слот уже передан, но задачу отменили — возвращаем его
+                self._release(model)
+            elif entry in state.waiters:
+                state.waiters.remove(entry)
+                heapq.heapify(state.waiters)
+                self._update_gauges()
+            raise
+        metrics.observe(f"llm.wait_ms.{name}", (time.perf_counter() - started) * 1000)
+
+    def _release(self, model: str) -> None:
+        state = self._models[model]
+        while state.waiters:
+            _priority, _seq, future = heapq.heappop(state.waiters)
+            if not future.done():
+                # Слот переходит следующему в очереди, in_flight не меняется
+                future.set_result(None)
+                break
+        else:
+            state.in_flight -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int) -> AsyncIterator[None]:
+        """Ждёт свободного слота модели; LLMOverloaded — очередь переполнена."""
+        await self._acquire(model, priority)
+        try:
+            yield
+        finally:
+            self._release(model)
+
+
+# Общий планировщик процесса
+scheduler = LLMScheduler()
+
 
 PROMPT = (
-    "Распознай этот чек и верни строго JSON массив объектов с полями "
-    "`name` (строка), `quantity` (число), `price` (число). Только JSON-массив, без комментариев."
+    "Распознай этот чек и верни строго JSON-объект с полями `items` — массив объектов с полями "
+    "`name` (строка), `quantity` (число), `price` (число за единицу) — и `total` — итоговая сумма "
+    "чека (число) или null, если её не видно. Только JSON, без комментариев."
 )
 
+# Границы правдоподобных значений позиции чека
+RECEIPT_MAX_QUANTITY: float = float(os.getenv("RECEIPT_MAX_QUANTITY", "1000"))
+RECEIPT_MAX_PRICE: float = float(os.getenv("RECEIPT_MAX_PRICE", "1000000"))
+# Допустимое расхождение суммы позиций с итогом чека (доля итога, но не меньше 1 ₽)
+RECEIPT_TOTAL_TOLERANCE: float = float(os.getenv("RECEIPT_TOTAL_TOLERANCE", "0.02"))
+
 # Prompt template for extracting positions from a free‑form Russian text.
 TEXT_POSITIONS_PROMPT = (
     "Ты — ассистент по разбору списка покупок в свободном тексте. "
@@ -76,14 +222,32 @@ TEXT_POSITIONS_PROMPT = (
 )
 
 
-async def extract_items_from_image(image_bin: io.BytesIO):
+def check_receipt(items: list[Item], total: float | None) -> str | None:
     """
-    Отправляет изображение чека и возвращает:
-      - список Item (Pydantic-модели)
-      - usage-метаданные (токены)
+    Проверяет правдоподобие распознанного чека.
+
+    Возвращает причину отказа (``empty``, ``values``, ``total``) или None,
+    если чек выглядит прочитанным верно: позиции есть, количества и цены
+    положительные и в разумных пределах, а сумма позиций сходится с
+    напечатанным итогом, если модель его нашла.
     """
-    image_bin.seek(0)
-    b64_img = base64.b64encode(image_bin.read()).decode()
+    if not items:
+        return "empty"
+    for it in items:
+        if not it.name.strip() or not 0 < it.quantity <= RECEIPT_MAX_QUANTITY or not 0 < it.price <= RECEIPT_MAX_PRICE:
+            return "values"
+    if total:
+        # Суммируем построчно в копейках, как будет записано в базу
+        lines = sum(to_kopecks(it.quantity * it.price) for it in items)
+        expected = to_kopecks(total)
+        if abs(lines - expected) > max(100, RECEIPT_TOTAL_TOLERANCE * expected):
+            return "total"
+    return None
+
+
+async def _scan_receipt(image: bytes) -> tuple[ReceiptScan, dict]:
+    """Один запрос к LLM: изображение JPEG → позиции, итог и usage."""
+    b64_img = base64.b64encode(image).decode()
 
     # Формируем мультимодальное сообщение:
     # текст + блок с картинкой в формате OpenAI Chat Completions
@@ -98,12 +262,77 @@ async def extract_items_from_image(image_bin: io.BytesIO):
     )
 
     # Асинхронный вызов
-    ai_response = await structured_llm.ainvoke([msg])
+    async with scheduler.slot(llm.model_name, PRIORITY_BULK):
+        ai_response = await structured_receipt_llm.ainvoke([msg])
 
-    items = ai_response["parsed"].root
+    scan = ai_response["parsed"]
+    if scan is None:
+        raise ValueError(f"Ответ LLM не разобран: {ai_response.get('parsing_error')}")
     usage = (ai_response["raw"].usage_metadata or {})  # input_tokens/output_tokens/total_tokens
+    return scan, usage
+
 
-    return items, usage
+async def extract_items_from_image(image_bin: io.BytesIO):
+    """
+    Отправляет изображение чека и возвращает:
+      - список Item (Pydantic-модели)
+      - usage-метаданные (токены, суммарно по всем запросам)
+
+    Перед отправкой изображение обрезается по чеку и уменьшается
+    (см. ``services.image_prep``): токены изображения — основная часть
+    стоимости распознавания. Сначала чек распознаётся в низком разрешении
+    (высота строки IMAGE_LOW_LINE_HEIGHT); большинство чистых чеков
+    читаются и так. Если результат не проходит ``check_receipt`` или
+    запрос не удался, чек распознаётся повторно в разрешении
+    IMAGE_LINE_HEIGHT, и возвращается этот результат.
+
+    Метрики: ``receipt_ocr.low_res.hit`` / ``.miss`` — чеки, распознанные
+    одним запросом / повторно (доля повторов — 1 − hit_rate),
+    ``receipt_ocr.rejected.<причина>`` — непрошедшие проверки,
+    ``receipt_ocr.low_res.errors`` — ошибки запроса в низком разрешении,
+    ``receipt_ocr.input_tokens`` и ``receipt_ocr.image_tokens`` — сводки
+    токенов на один чек.
+    """
+    image_bin.seek(0)
+    raw = image_bin.read()
+    usage_total: dict[str, int] = {}
+    image_tokens = 0
+
+    def account(usage: dict, info: dict) -> None:
+        nonlocal image_tokens
+        for key in ("input_tokens", "output_tokens", "total_tokens"):
+            usage_total[key] = usage_total.get(key, 0) + (usage.get(key) or 0)
+        image_tokens += info.get("tokens", 0)
+
+    low, low_info = await prepare_receipt_image(raw, IMAGE_LOW_LINE_HEIGHT)
+    # В высоком разрешении картинка была бы другой, только если низкое
+    # уменьшило её по высоте строки; иначе повтор прислал бы то же самое
+    can_escalate = (low_info.get("line_height") or 0) > IMAGE_LOW_LINE_HEIGHT
+    try:
+        scan, usage = await _scan_receipt(low)
+        account(usage, low_info)
+        reason = check_receipt(scan.items, scan.total)
+    except Exception as e:
+        if not can_escalate:
+            raise
+        metrics.incr("receipt_ocr.low_res.errors")
+        logger.warning("Ошибка распознавания чека в низком разрешении: %s", e, exc_info=True)
+        account({}, low_info)
+        reason = "error"
+
+    if reason is not None:
+        metrics.incr(f"receipt_ocr.rejected.{reason}")
+    if reason is None or not can_escalate:
+        metrics.incr("receipt_ocr.low_res.hit")
+    else:
+        metrics.incr("receipt_ocr.low_res.miss")
+        high, high_info = await prepare_receipt_image(raw, IMAGE_LINE_HEIGHT)
+        scan, usage = await _scan_receipt(high)
+        account(usage, high_info)
+
+    metrics.observe("receipt_ocr.input_tokens", usage_total.get("input_tokens", 0))
+    metrics.observe("receipt_ocr.image_tokens", image_tokens)
+    return scan.items, usage_total
 
 
 
@@ -127,7 +356,7 @@ async def calculate_debts_from_messages(items: dict[str, float], messages: list[
         "messages": [{"role": "user", "content": prompt}],
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with scheduler.slot(json_payload["model"], PRIORITY_BULK), aiohttp.ClientSession() as session:
         async with session.post("https://openrouter.ai/api/v1/chat/completions",
                                 json=json_payload, headers=headers) as resp:
             resp.raise_for_status()
@@ -193,9 +422,17 @@ async def classify_intent_llm(text: str) -> str:
         SystemMessage(content=system_prompt),
         HumanMessage(content=text),
     ]
+    # Одинаковые короткие фразы повторяются во многих чатах
+    cache_key = response_cache.key("intent", _text_llm.model_name, system_prompt, normalize_phrase(text))
+    cached = await response_cache.get(cache_key)
+    if cached is not MISSING:
+        return cached
     try:
         # Асинхронный вызов модели
-        response = await _text_llm.ainvoke(messages)
+        async with scheduler.slot(_text_llm.model_name, PRIORITY_INTERACTIVE):
+            started = time.perf_counter()
+            response = await _text_llm.ainvoke(messages)
+            latency_ms = (time.perf_counter() - started) * 1000
         content = (response.content or "").strip().lower()
         # Иногда модель может вернуть текст вроде "гreet" или со знаками
         # пунктуации. Приведём к стандартному виду и проверим, входит ли
@@ -214,7 +451,9 @@ async def classify_intent_llm(text: str) -> str:
         }# Удаляем все символы, кроме латинских букв, цифр и подчёркивания
         import re
         cleaned = re.sub(r"[^a-zA-Z0-9_]+", "", content)
-        return cleaned if cleaned in valid else "unknown"
+        intent = cleaned if cleaned in valid else "unknown"
+        await response_cache.put(cache_key, intent, latency_ms)
+        return intent
     except Exception:
         # В случае любой ошибки (тайм‑аут, отсутствие API‑ключа и т.п.)
         # используем эвристическую классификацию
@@ -291,14 +530,28 @@ async def extract_items_from_text(text: str) -> list[Item]:
     Raises:
         любое исключение, возникающее при вызове structured_llm
     """
+    cache_key = response_cache.key("items", llm.model_name, TEXT_POSITIONS_PROMPT, normalize_text(text))
+    cached = await response_cache.get(cache_key)
+    if cached is not MISSING:
+        return [Item(**item) for item in cached]
     # Подставляем пользовательский текст в шаблон промпта
     prompt = TEXT_POSITIONS_PROMPT.format(text=text)
     from langchain_core.messages import HumanMessage
     msg = HumanMessage(content=prompt)
     # Асинхронный вызов модели
-    ai_response = await structured_llm.ainvoke([msg])
-    # parsed.root содержит список Item
-    items: list[Item] = ai_response["parsed"].root
+    try:
+        async with scheduler.slot(llm.model_name, PRIORITY_TEXT):
+            started = time.perf_counter()
+            ai_response = await structured_llm.ainvoke([msg])
+            latency_ms = (time.perf_counter() - started) * 1000
+    except LLMOverloaded:
+        # Модель перегружена — позиции разберёт простой парсер ниже
+        items: list[Item] = []
+    else:
+        # parsed.root содержит список Item
+        items = ai_response["parsed"].root
+        if items:
+            await response_cache.put(cache_key, [item.model_dump() for item in items], latency_ms)
     # Если модель вернула пустой список, попробуем fallback с простым парсером
     print("LLM response items:", items)
     if not items:
@@ -455,10 +708,17 @@ async def extract_payment_from_text(text: str) -> list[dict]:
     from langchain_core.messages import HumanMessage
 
     # 1) Пытаемся через LLM
+    cache_key = response_cache.key("payments", llm.model_name, TEXT_PAYMENTS_PROMPT, normalize_text(text))
+    cached = await response_cache.get(cache_key)
+    if cached is not MISSING:
+        return [dict(payment) for payment in cached]
     try:
         prompt = TEXT_PAYMENTS_PROMPT.format(text=text)
         msg = HumanMessage(content=prompt)
-        ai_response = await structured_llm_payments.ainvoke([msg])
+        async with scheduler.slot(llm.model_name, PRIORITY_TEXT):
+            started = time.perf_counter()
+            ai_response = await structured_llm_payments.ainvoke([msg])
+            latency_ms = (time.perf_counter() - started) * 1000
         payments_model: list[Payment] = ai_response["parsed"].root if ai_response else []
         parsed: list[dict] = []
         for p in payments_model:
@@ -471,7 +731,8 @@ async def extract_payment_from_text(text: str) -> list[dict]:
             except Exception:
                 continue
         if parsed:
-            return parsed
+            await response_cache.put(cache_key, parsed, latency_ms)
+            return [dict(payment) for payment in parsed]
     except Exception:
         # Игнорируем ошибку LLM — ниже fallback
         pass
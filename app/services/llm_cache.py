@@ -0,0 +1,130 @@
+"""
+Кэш ответов текстовых запросов к LLM.
+
+Классификация намерения, разбор позиций и платежей из текста отправляли в
+OpenRouter каждое сообщение, хотя короткие фразы вроде «покажи позиции»
+или «расчёт закончен» повторяются из чата в чат. Ответы кэшируются по
+содержимому запроса: ключ — хеш вида запроса, модели, версии промпта
+(хеш его шаблона — изменённый промпт не получит старых ответов) и
+нормализованного текста.
+
+Два уровня:
+
+* в памяти процесса — LRU ``TTLCache`` на LLM_CACHE_MEMORY_SIZE записей;
+* в SQLite (таблица ``llm_cache``) — общий для перезапусков и процессов.
+  Записи живут LLM_CACHE_TTL секунд; раз в LLM_CACHE_PRUNE_EVERY записей
+  устаревшие удаляются, а таблица урезается до LLM_CACHE_MAX_ROWS.
+
+Кэшируются только ответы модели, а не запасные эвристики после ошибки.
+Метрики: ``llm_cache.memory_hit``, ``llm_cache.db_hit``, ``llm_cache.miss``
+(и доля попаданий ``llm_cache.hit_rate``), ``llm_cache.saved_ms`` —
+сколько миллисекунд заняли бы запросы, на которые ответил кэш,
+``llm_cache.errors`` — ошибки чтения и записи кэша в базе:
+
+    key = response_cache.key("intent", model, prompt, normalize_text(text))
+    value = await response_cache.get(key)
+    if value is MISSING:
+        value = ...  # запрос к LLM
+        await response_cache.put(key, value, latency_ms)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Any
+
+from app import async_database as db, metrics
+from app.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED: bool = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_TTL: float = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_SIZE: int = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "2000"))
+LLM_CACHE_MAX_ROWS: int = int(os.getenv("LLM_CACHE_MAX_ROWS", "50000"))
+LLM_CACHE_PRUNE_EVERY: int = int(os.getenv("LLM_CACHE_PRUNE_EVERY", "200"))
+
+_SPACES = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s@]+")
+
+
+def normalize_text(text: str) -> str:
+    """Схлопывает пробелы: так нормализуется текст, из которого извлекаются данные."""
+    return _SPACES.sub(" ", text).strip()
+
+
+def normalize_phrase(text: str) -> str:
+    """
+    Нормализация для классификации: регистр, «ё», пунктуация и пробелы не
+    меняют намерения («Покажи позиции!» и «покажи позиции»).
+    """
+    text = text.casefold().replace("ё", "е")
+    return normalize_text(_PUNCTUATION.sub(" ", text))
+
+
+class ResponseCache:
+    """Двухуровневый кэш: память процесса и таблица llm_cache."""
+
+    def __init__(
+        self,
+        memory_size: int = LLM_CACHE_MEMORY_SIZE,
+        ttl: float = LLM_CACHE_TTL,
+        max_rows: int = LLM_CACHE_MAX_ROWS,
+        prune_every: int = LLM_CACHE_PRUNE_EVERY,
+    ) -> None:
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self._memory = TTLCache(memory_size, ttl)
+        self._writes = 0
+
+    @staticmethod
+    def key(kind: str, model: str, prompt: str, text: str) -> str:
+        version = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        payload = json.dumps([kind, model, version, text], ensure_ascii=False)
+        return f"{kind}:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Any:
+        """Возвращает закэшированный ответ или MISSING."""
+        if not LLM_CACHE_ENABLED:
+            return MISSING
+        item = self._memory.get(key)
+        if item is not MISSING:
+            metrics.incr("llm_cache.memory_hit")
+        else:
+            try:
+                row = await db.get_llm_response(key)
+            except Exception as e:
+                metrics.incr("llm_cache.errors")
+                logger.warning("Ошибка чтения кэша LLM: %s", e, exc_info=True)
+                row = None
+            if row is None:
+                metrics.incr("llm_cache.miss")
+                return MISSING
+            item = (json.loads(row[0]), row[1])
+            self._memory.set(key, item)
+            metrics.incr("llm_cache.db_hit")
+        value, latency_ms = item
+        metrics.incr("llm_cache.saved_ms", int(latency_ms))
+        return value
+
+    async def put(self, key: str, value: Any, latency_ms: float) -> None:
+        """Запоминает ответ модели; latency_ms — длительность запроса."""
+        if not LLM_CACHE_ENABLED:
+            return
+        self._memory.set(key, (value, latency_ms))
+        metrics.set_gauge("llm_cache.memory_size", len(self._memory))
+        try:
+            await db.put_llm_response(key, json.dumps(value, ensure_ascii=False), latency_ms, self.ttl)
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                metrics.incr("llm_cache.pruned", await db.prune_llm_responses(self.max_rows))
+        except Exception as e:
+            metrics.incr("llm_cache.errors")
+            logger.warning("Ошибка записи кэша LLM: %s", e, exc_info=True)
+
+
+# Общий кэш процесса
+response_cache = ResponseCache()
@@ -0,0 +1,200 @@
+"""
+Исходящие сообщения с учётом ограничений Telegram.
+
+Рассылка по одному ``await bot.send_message(...)`` в цикле медленная
+(каждое сообщение ждёт предыдущее), а при большом числе получателей
+упирается во flood‑control Telegram. ``MessageDispatcher`` отправляет
+пачку сообщений параллельно и при этом:
+
+* ограничивает число одновременных запросов (MESSAGING_CONCURRENCY) —
+  слот занимается только на общий маркер и сам запрос, лимит чата
+  выжидается до этого;
+* выдерживает общий лимит бота (MESSAGING_GLOBAL_RATE сообщений в
+  секунду) и лимит на один чат: 1 сообщение в секунду в личный чат и
+  MESSAGING_GROUP_RATE_PER_MINUTE в минуту в группу — маркерными
+  корзинами (token bucket);
+* на ``TelegramRetryAfter`` приостанавливает все отправки на указанное
+  Telegram время и повторяет сообщение; сетевые и серверные ошибки
+  повторяются с нарастающей паузой, не больше MESSAGING_MAX_RETRIES раз;
+* не повторяет ошибки, которые повтор не исправит (бот заблокирован,
+  чат не найден и т. п.).
+
+Результат пачки — ``DeliveryReport``: кому доставлено, кому нет и почему:
+
+    from services.messaging import dispatcher
+
+    report = await dispatcher.send_many(bot, [(uid, text), ...])
+    if report.failed: ...
+
+Лимиты Telegram действуют на токен бота, поэтому в процессе используется
+один общий ``dispatcher``.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from app import metrics
+
+MESSAGING_CONCURRENCY: int = int(os.getenv("MESSAGING_CONCURRENCY", "8"))
+MESSAGING_GLOBAL_RATE: float = float(os.getenv("MESSAGING_GLOBAL_RATE", "25"))
+MESSAGING_GROUP_RATE_PER_MINUTE: float = float(os.getenv("MESSAGING_GROUP_RATE_PER_MINUTE", "20"))
+MESSAGING_MAX_RETRIES: int = int(os.getenv("MESSAGING_MAX_RETRIES", "3"))
+
+# Сколько корзин отдельных чатов держать в памяти (самые давние вытесняются)
+_MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    Маркерная корзина: не больше rate операций в секунду в среднем и не
+    больше capacity подряд. Ожидающие обслуживаются по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает выдачу маркеров на seconds секунд (flood wait от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+@dataclass
+class DeliveryReport:
+    """Итог отправки пачки сообщений."""
+
+    total: int = 0
+    delivered: list[int] = field(default_factory=list)
+    # chat_id → текст последней ошибки
+    failed: dict[int, str] = field(default_factory=dict)
+    retries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+class MessageDispatcher:
+    """Параллельная отправка сообщений с ограничением скорости и повторами."""
+
+    def __init__(
+        self,
+        concurrency: int = MESSAGING_CONCURRENCY,
+        global_rate: float = MESSAGING_GLOBAL_RATE,
+        group_rate_per_minute: float = MESSAGING_GROUP_RATE_PER_MINUTE,
+        max_retries: int = MESSAGING_MAX_RETRIES,
+    ) -> None:
+        self.max_retries = max_retries
+        self.group_rate_per_minute = group_rate_per_minute
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Ёмкость 1: сообщения идут равномерно, и в любом окне длиной в
+        # секунду (минуту для групп) их не больше лимита — без всплесков,
+        # которые Telegram считает флудом
+        self._global = TokenBucket(global_rate, 1)
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы, положительные — личные чаты
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate_per_minute / 60, 1)
+            else:
+                bucket = TokenBucket(1.0, 1.0)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > _MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _deliver(
+        self, bot: Bot, chat_id: int, text: str, kwargs: dict[str, Any], report: DeliveryReport
+    ) -> None:
+        attempt = 0
+        while True:
+            # Маркер чата ждём до семафора: иначе несколько сообщений в одну
+            # группу (маркер раз в 3 с) заняли бы все слоты ожиданием, и
+            # сообщения в другие чаты стояли бы в очереди
+            await self._chat_bucket(chat_id).acquire()
+            async with self._semaphore:
+                await self._global.acquire()
+                try:
+                    await bot.send_message(chat_id, text, **kwargs)
+                    report.delivered.append(chat_id)
+                    metrics.incr("messaging.sent")
+                    return
+                except TelegramRetryAfter as e:
+                    # Flood control касается всего бота: останавливаем все отправки
+                    wait = float(e.retry_after)
+                    self._global.pause(wait)
+                    metrics.incr("messaging.retry_after")
+                    error = str(e)
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    wait = 2.0 ** attempt
+                    error = str(e)
+                except Exception as e:
+                    # Бот заблокирован, чат не найден и т. п. — повтор не поможет
+                    report.failed[chat_id] = str(e)
+                    metrics.incr("messaging.failed")
+                    return
+            attempt += 1
+            if attempt > self.max_retries:
+                report.failed[chat_id] = error
+                metrics.incr("messaging.failed")
+                return
+            report.retries += 1
+            await asyncio.sleep(wait)
+
+    async def send_many(
+        self, bot: Bot, messages: Iterable[tuple[int, str]], **kwargs: Any
+    ) -> DeliveryReport:
+        """
+        Отправляет сообщения (chat_id, text) параллельно с учётом лимитов.
+        Дополнительные именованные аргументы передаются в send_message.
+        Исключений не выбрасывает: ошибки попадают в DeliveryReport.failed.
+        """
+        started = time.monotonic()
+        batch = list(messages)
+        report = DeliveryReport(total=len(batch))
+        await asyncio.gather(
+            *(self._deliver(bot, chat_id, text, kwargs, report) for chat_id, text in batch)
+        )
+        report.elapsed = time.monotonic() - started
+        metrics.incr("messaging.batches")
+        return report
+
+    async def send(self, bot: Bot, chat_id: int, text: str, **kwargs: Any) -> bool:
+        """Отправляет одно сообщение с учётом лимитов; возвращает True при успехе."""
+        report = await self.send_many(bot, [(chat_id, text)], **kwargs)
+        return report.ok
+
+
+# Общий диспетчер процесса: лимиты Telegram считаются на токен бота
+dispatcher = MessageDispatcher()
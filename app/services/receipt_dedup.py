@@ -0,0 +1,96 @@
+"""
+Поиск повторно присланных чеков.
+
+Один и тот же чек часто пересылают в группу или отправляют ещё раз, и
+каждый раз бот скачивал фотографию и платил за распознавание. Распознанные
+чеки сохраняются в базе (``receipt_scans``), и повторный чек узнаётся в два
+этапа:
+
+1. ``find_by_file`` — по ``file_unique_id`` фотографии в Telegram, до
+   скачивания файла. Пересланное сообщение и повторная отправка того же
+   файла сохраняют file_unique_id;
+2. ``find_by_qr`` — после скачивания, до запроса к LLM: по ключу
+   фискального QR‑кода (ФН, номер документа, фискальный признак). Он
+   одинаков на любом снимке чека и различается у разных чеков.
+
+Оба ключа однозначно определяют чек, поэтому совпадение используется без
+подтверждения. Похожесть изображений не используется: разные чеки одной
+вёрстки выглядят почти одинаково, и чужие позиции попали бы в группу.
+
+При попадании позиции берутся из сохранённого результата распознавания.
+Чек, уже добавленный в группу, не добавляется повторно (см.
+``add_positions``). Метрики: ``receipt_dedup.file.hit``,
+``receipt_dedup.fiscal.hit``, ``receipt_dedup.miss`` — чеки, ушедшие на
+распознавание, и ``receipt_dedup.errors`` — ошибки базы (чек тогда
+распознаётся как новый).
+
+    scan = await receipt_dedup.find_by_file(photo.file_unique_id)
+    if scan is None:
+        scan, fiscal_key = await receipt_dedup.find_by_qr(data, photo.file_unique_id)
+"""
+
+import logging
+import os
+
+from app import async_database as db, metrics
+from services.image_prep import receipt_fiscal_key
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_DEDUP_ENABLED: bool = os.getenv("RECEIPT_DEDUP_ENABLED", "1") != "0"
+
+
+async def find_by_file(file_unique_id: str) -> tuple[int, list[dict]] | None:
+    """Чек (id, позиции), уже распознанный по этой фотографии, или None."""
+    if not RECEIPT_DEDUP_ENABLED:
+        return None
+    try:
+        scan = await db.get_receipt_scan_by_file(file_unique_id)
+    except Exception as e:
+        metrics.incr("receipt_dedup.errors")
+        logger.warning("Ошибка поиска чека по файлу: %s", e, exc_info=True)
+        return None
+    if scan is not None:
+        metrics.incr("receipt_dedup.file.hit")
+    return scan
+
+
+async def find_by_qr(
+    data: bytes, file_unique_id: str | None = None
+) -> tuple[tuple[int, list[dict]] | None, str | None]:
+    """
+    Ищет чек по QR‑коду на фотографии.
+
+    Возвращает (чек или None, ключ QR‑кода или None). Ключ передаётся в
+    ``remember`` после распознавания. Найденный чек запоминается и под
+    file_unique_id этой фотографии.
+    """
+    if not RECEIPT_DEDUP_ENABLED:
+        return None, None
+    fiscal_key = await receipt_fiscal_key(data)
+    found = None
+    if fiscal_key is not None:
+        try:
+            found = await db.find_receipt_scan(fiscal_key)
+            if found is not None and file_unique_id:
+                await db.link_receipt_file(file_unique_id, found[0])
+        except Exception as e:
+            metrics.incr("receipt_dedup.errors")
+            logger.warning("Ошибка поиска чека по QR‑коду: %s", e, exc_info=True)
+            found = None
+    metrics.incr("receipt_dedup.fiscal.hit" if found is not None else "receipt_dedup.miss")
+    return found, fiscal_key
+
+
+async def remember(
+    positions: list[dict], fiscal_key: str | None = None, file_unique_id: str | None = None
+) -> int | None:
+    """Сохраняет распознанный чек, возвращает его id (None — не сохранён)."""
+    if not RECEIPT_DEDUP_ENABLED or not (fiscal_key or file_unique_id):
+        return None
+    try:
+        return await db.save_receipt_scan(positions, fiscal_key, file_unique_id)
+    except Exception as e:
+        metrics.incr("receipt_dedup.errors")
+        logger.warning("Ошибка сохранения распознанного чека: %s", e, exc_info=True)
+        return None
@@ -0,0 +1,445 @@
+"""
+Расчёт по группе (клиринг).
+
+Единственное место, где считается, сколько каждый участник потратил по
+выбранным позициям, сколько внёс платежей, каков его баланс и какие
+переводы закрывают долги. Стоимости, платежи и балансы хранятся в
+проекции group_balances, которую функции записи ``app.database``
+обновляют вместе с исходными строками; чтение баланса стоит
+O(участников), в Python строятся только переводы. ``compute_costs`` — те
+же правила в памяти по сырым строкам (``database.load_group_snapshot``);
+по ним ``check_group_balances`` сверяет проекцию:
+
+    from app.settlement import settle_group
+
+    result = settle_group(group_id)
+    result.costs        # user_id → стоимость выбранных позиций
+    result.payments     # user_id → сумма платежей
+    result.balances     # user_id → оплачено − потрачено
+    result.transfers    # [(должник, кредитор, сумма), ...]
+
+Все суммы — целые копейки (см. ``app.money``); для вывода используйте
+money.format_rub.
+
+Правила расчёта стоимости:
+
+* выбор с положительным количеством стоит ``quantity * price`` позиции,
+  округлённые до копейки;
+* отрицательное количество — отметка «поровну»: стоимость остатка позиции
+  (исходное количество минус сумма ручных выборов) делится между всеми,
+  кто поставил такую отметку, методом наибольшего остатка — доли в сумме
+  дают ровно стоимость остатка;
+* если выбор не сопоставлен с позицией чека (position_id = NULL или
+  позиция удалена), берутся количество и цена из самой строки выбора,
+  а отметки «поровну» игнорируются.
+
+Переводы строятся в одном из режимов (переменная окружения
+SETTLEMENT_MODE):
+
+* ``optimal`` (по умолчанию) — минимальное число переводов. Участники
+  разбиваются на максимальное число подгрупп с нулевой суммой балансов;
+  внутри подгруппы из k человек достаточно k − 1 перевода, поэтому
+  итог равен n − (число подгрупп). Разбиение ищется точно, динамикой по
+  подмножествам за O(2^n · n), с ограничением по времени
+  (SETTLEMENT_TIME_BUDGET_MS) и по числу участников
+  (SETTLEMENT_EXACT_MAX_PARTICIPANTS). Если ограничение превышено,
+  используется жадный алгоритм;
+* ``greedy`` — жадное сопоставление крупнейших должников и кредиторов.
+"""
+
+import os
+import time
+from math import floor
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+from app import database
+from app.money import multiply
+
+# Балансы по модулю не больше этого числа копеек считаются нулевыми
+# (погрешность округления дробных количеств).
+DUST_KOPECKS: int = 1
+
+SETTLEMENT_MODE: str = os.getenv("SETTLEMENT_MODE", "optimal")
+# Сколько времени точный поиск может потратить, прежде чем уступить жадному алгоритму.
+SETTLEMENT_TIME_BUDGET_MS: float = float(os.getenv("SETTLEMENT_TIME_BUDGET_MS", "200"))
+# Выше этого числа ненулевых балансов точный поиск не запускается вовсе.
+SETTLEMENT_EXACT_MAX_PARTICIPANTS: int = int(os.getenv("SETTLEMENT_EXACT_MAX_PARTICIPANTS", "16"))
+
+
+@dataclass
+class GroupSnapshot:
+    """Компактное представление данных группы, необходимых для расчёта."""
+
+    # position_id → (исходное количество, цена в копейках)
+    positions: dict[int, tuple[float, int]] = field(default_factory=dict)
+    # (user_id, position_id или None, количество, цена в копейках)
+    selections: list[tuple[int, int | None, float, int]] = field(default_factory=list)
+    # user_id → сумма платежей в копейках
+    payments: dict[int, int] = field(default_factory=dict)
+
+
+@dataclass
+class Settlement:
+    """Результат расчёта по группе. Все суммы — в копейках."""
+
+    group_id: str
+    # Количество позиций чека в группе
+    position_count: int
+    # Участники, выбравшие хотя бы одну позицию
+    selectors: set[int]
+    costs: dict[int, int]
+    payments: dict[int, int]
+    balances: dict[int, int]
+    transfers: list[tuple[int, int, int]]
+
+    @property
+    def participants(self) -> set[int]:
+        """Все участники расчёта: выбравшие позиции или внёсшие платежи."""
+        return self.selectors | set(self.payments)
+
+    @property
+    def debts(self) -> dict[int, int]:
+        """Суммарный долг каждого должника по итоговым переводам."""
+        mapping: dict[int, int] = {}
+        for debtor_id, _creditor_id, amount in self.transfers:
+            mapping[debtor_id] = mapping.get(debtor_id, 0) + amount
+        return mapping
+
+
+@dataclass
+class FinalizeResult:
+    """
+    Итог завершения расчёта (``database.finalize_group``).
+
+    status: "done" — расчёт выполнен и данные перенесены в архив;
+    "duplicate" — расчёт с этим ключом уже выполнялся, ничего не изменено;
+    "no_positions" / "no_participants" — рассчитывать нечего.
+    """
+
+    status: str
+    settlement: Settlement | None = None
+
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _to_kopecks(value: Any) -> int:
+    # Значения в базе уже целые — их возвращаем как есть; int() лишь
+    # страхует от NULL и строк.
+    if type(value) is int:
+        return value
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _to_user_id(value: Any) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def build_snapshot(
+    pos_rows: Iterable[Any],
+    sp_rows: Iterable[Any],
+    pay_rows: Iterable[Any],
+) -> GroupSnapshot:
+    """Разбирает сырые строки базы в GroupSnapshot, отбрасывая некорректные значения."""
+    snapshot = GroupSnapshot()
+    for row in pos_rows:
+        snapshot.positions[row["id"]] = (_to_float(row["quantity"]), _to_kopecks(row["price"]))
+    for row in sp_rows:
+        uid = _to_user_id(row["user_tg_id"])
+        if uid is None:
+            continue
+        snapshot.selections.append(
+            (uid, row["position_id"], _to_float(row["quantity"]), _to_kopecks(row["price"]))
+        )
+    for row in pay_rows:
+        uid = _to_user_id(row["tg_user_id"])
+        if uid is None:
+            continue
+        snapshot.payments[uid] = snapshot.payments.get(uid, 0) + _to_kopecks(row["total_amount"])
+    return snapshot
+
+
+def compute_costs(snapshot: GroupSnapshot) -> dict[int, int]:
+    """
+    Считает стоимость выбранных позиций для каждого участника (в копейках).
+
+    Явно выбранное количество оплачивается сразу за один проход по выборам;
+    отметившие «поровну» (quantity < 0) откладываются по позициям и делят
+    остаток позиции уже после прохода, когда известна сумма явных выборов.
+    """
+    positions = snapshot.positions
+    costs: dict[int, int] = {}
+    manual_qty: dict[int, float] = {}
+    equal_by_position: dict[int, list[int]] = {}
+    for uid, pos_id, qty, price in snapshot.selections:
+        position = positions.get(pos_id)
+        if position is not None:
+            if qty < 0:
+                equal_by_position.setdefault(pos_id, []).append(uid)
+                continue
+            manual_qty[pos_id] = manual_qty.get(pos_id, 0.0) + qty
+            price = position[1]
+        # Выбор без позиции в чеке оплачивается по цене, сохранённой в самом выборе.
+        # Округление money.multiply встроено: это самый горячий цикл расчёта.
+        if qty > 0:
+            costs[uid] = costs.get(uid, 0) + floor(qty * price + 0.5)
+
+    # Остаток делится поровну методом наибольшего остатка: каждому целая
+    # часть доли, а лишние копейки по одной — первым по id, чтобы сумма долей
+    # была ровно равна остатку и не зависела от порядка строк в базе
+    for pos_id, equal_users in equal_by_position.items():
+        total_qty, price = positions[pos_id]
+        leftover = multiply(max(total_qty - manual_qty.get(pos_id, 0.0), 0.0), price)
+        share, rest = divmod(leftover, len(equal_users))
+        if rest:
+            equal_users.sort()
+        for k, uid in enumerate(equal_users):
+            costs[uid] = costs.get(uid, 0) + share + (k < rest)
+    return costs
+
+
+def compute_balances(costs: dict[int, int], payments: dict[int, int]) -> dict[int, int]:
+    """Баланс каждого участника: оплачено − потрачено (положительный — ему должны)."""
+    balances: dict[int, int] = {}
+    for uid in list(costs) + [u for u in payments if u not in costs]:
+        balances[uid] = payments.get(uid, 0) - costs.get(uid, 0)
+    return balances
+
+
+def greedy_transfers(balances: dict[int, int]) -> list[tuple[int, int, int]]:
+    """
+    Строит переводы, закрывающие балансы, жадным проходом двумя указателями:
+    крупнейший должник платит крупнейшему кредитору, пока один из них не
+    обнулится.
+    """
+    debtors = sorted(
+        ([uid, -bal] for uid, bal in balances.items() if bal < -DUST_KOPECKS),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    creditors = sorted(
+        ([uid, bal] for uid, bal in balances.items() if bal > DUST_KOPECKS),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    transfers: list[tuple[int, int, int]] = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        d_uid, d_amount = debtors[i]
+        c_uid, c_amount = creditors[j]
+        amount = min(d_amount, c_amount)
+        if amount <= 0:
+            break
+        transfers.append((d_uid, c_uid, amount))
+        debtors[i][1] = d_amount - amount
+        creditors[j][1] = c_amount - amount
+        if debtors[i][1] <= DUST_KOPECKS:
+            i += 1
+        if creditors[j][1] <= DUST_KOPECKS:
+            j += 1
+    return transfers
+
+
+def _zero_sum_groups(amounts: list[int], deadline: float) -> list[list[int]] | None:
+    """
+    Разбивает индексы ``amounts`` (балансы в копейках, сумма равна нулю) на
+    максимальное число подгрупп с нулевой суммой.
+
+    dp[mask] — наибольшее число нулевых подгрупп, на которые можно разрезать
+    «цепочку» добавления элементов mask; sums[mask] — сумма элементов mask.
+    Возвращает None, если не уложились в deadline (time.perf_counter()).
+    """
+    n = len(amounts)
+    size = 1 << n
+    sums = [0] * size
+    dp = bytearray(size)
+    for mask in range(1, size):
+        if not mask & 0xFFF and time.perf_counter() > deadline:
+            return None
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + amounts[low.bit_length() - 1]
+        best = 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            value = dp[mask ^ bit]
+            if value > best:
+                best = value
+            rest ^= bit
+        dp[mask] = best + (sums[mask] == 0)
+    # Восстанавливаем разбиение: идём от полного множества к пустому,
+    # каждый раз убирая элемент, на котором достигается dp. Множества с
+    # нулевой суммой на этом пути отделяют соседние подгруппы.
+    groups: list[list[int]] = []
+    current: list[int] = []
+    mask = size - 1
+    while mask:
+        target = dp[mask] - (sums[mask] == 0)
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if dp[mask ^ bit] == target:
+                break
+            rest ^= bit
+        current.append(bit.bit_length() - 1)
+        mask ^= bit
+        if sums[mask] == 0:
+            groups.append(current)
+            current = []
+    return groups
+
+
+def optimal_transfers(
+    balances: dict[int, int],
+    time_budget_ms: float | None = None,
+    max_participants: int | None = None,
+) -> list[tuple[int, int, int]]:
+    """
+    Строит минимальное число переводов, закрывающих балансы.
+
+    Если суммы балансов не сходятся в ноль (например, часть позиций не
+    распределена), недостающая сумма приписывается служебному участнику,
+    переводы с которым в результат не попадают — так же, как жадный
+    алгоритм оставляет непокрытый остаток. Если точный поиск не укладывается
+    в ограничения, возвращается результат greedy_transfers().
+    """
+    budget = SETTLEMENT_TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms
+    limit = SETTLEMENT_EXACT_MAX_PARTICIPANTS if max_participants is None else max_participants
+    uids = [uid for uid, bal in balances.items() if abs(bal) > DUST_KOPECKS]
+    cents = [balances[uid] for uid in uids]
+    residual = -sum(cents)
+    if residual:
+        uids.append(None)
+        cents.append(residual)
+
+    # Пара участников с противоположными балансами — готовая подгруппа из
+    # двух человек, и всегда есть оптимальное решение, где она выделена
+    # отдельно. Снимаем такие пары до перебора, чтобы уменьшить n.
+    groups: list[list[int]] = []
+    unmatched: dict[int, list[int]] = {}
+    rest: list[int] = []
+    for i, amount in enumerate(cents):
+        partners = unmatched.get(-amount)
+        if partners:
+            groups.append([partners.pop(), i])
+        else:
+            unmatched.setdefault(amount, []).append(i)
+    for indices in unmatched.values():
+        rest.extend(indices)
+
+    if rest:
+        if len(rest) > limit:
+            return greedy_transfers(balances)
+        found = _zero_sum_groups([cents[i] for i in rest], time.perf_counter() + budget / 1000)
+        if found is None:
+            return greedy_transfers(balances)
+        groups.extend([rest[i] for i in group] for group in found)
+    transfers: list[tuple[int, int, int]] = []
+    for group in groups:
+        sub = {uids[i]: cents[i] for i in group}
+        transfers.extend(
+            (debtor, creditor, amount)
+            for debtor, creditor, amount in greedy_transfers(sub)
+            if debtor is not None and creditor is not None
+        )
+    return transfers
+
+
+def build_transfers(balances: dict[int, int]) -> list[tuple[int, int, int]]:
+    """Строит переводы в режиме SETTLEMENT_MODE."""
+    if SETTLEMENT_MODE == "greedy":
+        return greedy_transfers(balances)
+    return optimal_transfers(balances)
+
+
+def settle_snapshot(group_id: str, snapshot: GroupSnapshot) -> Settlement:
+    """Выполняет полный расчёт по уже загруженным данным группы."""
+    costs = compute_costs(snapshot)
+    balances = compute_balances(costs, snapshot.payments)
+    return Settlement(
+        group_id=str(group_id),
+        position_count=len(snapshot.positions),
+        selectors={uid for uid, *_rest in snapshot.selections},
+        costs=costs,
+        payments=dict(snapshot.payments),
+        balances=balances,
+        transfers=build_transfers(balances),
+    )
+
+
+def settle_rows(group_id: str, position_count: int, rows: Iterable[Any]) -> Settlement:
+    """
+    Выполняет расчёт по стоимостям и балансам из проекции group_balances
+    (``database.load_group_balances``); в Python остаётся только поиск переводов.
+    """
+    costs: dict[int, int] = {}
+    payments: dict[int, int] = {}
+    balances: dict[int, int] = {}
+    selectors: set[int] = set()
+    for row in rows:
+        uid = row["user_id"]
+        if row["charged"]:
+            costs[uid] = row["cost"]
+        if row["payer"]:
+            payments[uid] = row["paid"]
+        if row["charged"] or row["payer"]:
+            balances[uid] = row["balance"]
+        if row["selector"]:
+            selectors.add(uid)
+    return Settlement(
+        group_id=str(group_id),
+        position_count=position_count,
+        selectors=selectors,
+        costs=costs,
+        payments=payments,
+        balances=balances,
+        transfers=build_transfers(balances),
+    )
+
+
+def settle_group(group_id: str) -> Settlement:
+    """Читает балансы группы из проекции group_balances и строит переводы."""
+    return settle_rows(group_id, *database.load_group_balances(group_id))
+
+
+def check_group_balances(group_id: str) -> dict[int, tuple[tuple, tuple]]:
+    """
+    Сверяет проекцию group_balances с расчётом с нуля.
+
+    Стоимости заново считаются в памяти (compute_costs) по сырым строкам
+    позиций, выборов и платежей — независимо от SQL, которым поддерживается
+    проекция, поэтому расхождение выявит ошибку и в правилах, и в
+    инкрементальном обновлении.
+
+    Returns:
+        dict: user_id → ((стоимость, платежи, выбирал ли позиции) по
+        проекции, то же по расчёту с нуля) для участников, у которых они
+        различаются; None — у участника нет стоимости или платежей. Пустой
+        словарь — проекция согласована.
+    """
+    # Проекция и сырые строки читаются одной транзакцией: запись между
+    # чтениями дала бы ложное расхождение
+    balances, snapshot = database.load_group_check(group_id)
+    maintained = settle_rows(group_id, *balances)
+    rebuilt = settle_snapshot(group_id, build_snapshot(*snapshot))
+
+    def state(result: Settlement, uid: int) -> tuple[int | None, int | None, bool]:
+        return result.costs.get(uid), result.payments.get(uid), uid in result.selectors
+
+    diff = {}
+    for uid in maintained.participants | rebuilt.participants | set(maintained.costs) | set(rebuilt.costs):
+        actual, expected = state(maintained, uid), state(rebuilt, uid)
+        if actual != expected:
+            diff[uid] = (actual, expected)
+    return diff
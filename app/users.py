@@ -0,0 +1,46 @@
+"""
+Профили пользователей в рамках одного запроса.
+
+Обработчики, которые выводят имена многих участников (итоги клиринга,
+баланс, списки позиций), раньше вызывали ``get_user`` для каждого имени
+отдельно. ``UserMap`` — identity map на время обработки одного
+сообщения: нужные профили загружаются одним запросом ``get_users``,
+после чего имена берутся из памяти:
+
+    users = await UserMap().load(settlement.participants)
+    users.name(uid)      # ФИО, телефон или id
+    users.get(uid)       # словарь профиля ({} для незарегистрированных)
+
+Повторный ``load`` запрашивает из базы только ещё не загруженные id.
+Карту не следует хранить дольше одного запроса: профили в ней не
+обновляются.
+"""
+
+from typing import Any, Iterable
+
+from app import async_database as db
+
+
+class UserMap:
+    """Identity map профилей: user_id → профиль, загруженный одним запросом."""
+
+    def __init__(self) -> None:
+        self._profiles: dict[int, dict[str, Any]] = {}
+
+    async def load(self, user_ids: Iterable[int | None]) -> "UserMap":
+        """Догружает профили переданных пользователей и возвращает саму карту."""
+        missing = {int(uid) for uid in user_ids if uid is not None} - self._profiles.keys()
+        if missing:
+            found = await db.get_users(missing)
+            for uid in missing:
+                self._profiles[uid] = found.get(uid, {})
+        return self
+
+    def get(self, user_id: int) -> dict[str, Any]:
+        """Профиль пользователя; пустой словарь, если он не зарегистрирован."""
+        return self._profiles.get(int(user_id), {})
+
+    def name(self, user_id: int) -> str:
+        """Отображаемое имя: ФИО, иначе телефон, иначе id."""
+        info = self.get(user_id)
+        return info.get('full_name') or info.get('phone') or str(user_id)
@@ -10,4 +10,23 @@ def parse_position(text: str):
     name = m.group(1).strip()
     quantity = float(m.group(2).replace(',', '.'))
     price = float(m.group(3).replace(',', '.'))
-    return {"name": name, "quantity": quantity, "price": price}
\ No newline at end of file
+    return {"name": name, "quantity": quantity, "price": price}
+
+def parse_selection_changes(changes) -> dict[int, float | None]:
+    # Изменения выбора из мини‑приложения: {position_id: количество | "equal" | 0}.
+    # Возвращает position_id → количество (-1 — «поровну») или None — снять выбор.
+    # Некорректные записи пропускаются.
+    result: dict[int, float | None] = {}
+    if not isinstance(changes, dict):
+        return result
+    for key, value in changes.items():
+        try:
+            position_id = int(key)
+            if value == "equal":
+                result[position_id] = -1.0
+                continue
+            quantity = float(value or 0)
+        except (TypeError, ValueError):
+            continue
+        result[position_id] = quantity if 0 < quantity < float("inf") else None
+    return result
@@ -14,19 +14,18 @@ injected via a simple templating mechanism here using Python string
 formatting.
 """
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from jinja2 import Template
 import logging
 
-from app.database import load_positions
-from app.database import (
-    get_positions,
-    set_assignment,
-    save_selected_positions,
-)
+from app import async_database as db, metrics
+from app.database import StaleVersionError, set_assignment
+from app.services.live import hub as live_hub
 from aiogram.utils.web_app import safe_parse_webapp_init_data
 from config import settings
+from app.utils import parse_selection_changes
 
+import hmac
 import os, time  # ⬅ добавили
 app = FastAPI()
 
@@ -38,14 +37,58 @@ logging.basicConfig(
 )
 logger = logging.getLogger("webapp")
 
-def render_receipt_page(positions: list[dict]) -> str:
+# --- ETag по версии группы ----------------------------------------------------
+# Версия группы (database.get_group_version) растёт при каждом изменении её
+# данных, поэтому годится как ETag: клиент присылает его в If-None-Match, и,
+# если версия не изменилась, сервер отвечает 304 без чтения позиций.
+# Ответы помечены Cache-Control: no-cache — браузер хранит их, но перед
+# использованием всегда сверяет версию с сервером.
+
+def _etag(version: int, suffix: str = "") -> str:
+    return f'W/"v{version}{suffix}"'
+
+
+def _known_version(request: Request, suffix: str = "") -> int | None:
+    """Версия группы из заголовка If-None-Match, если клиент прислал наш ETag."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    for tag in header.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if not tag.startswith("v") or not tag.endswith(suffix):
+            continue
+        digits = tag[1:len(tag) - len(suffix)]
+        if digits.isdigit():
+            return int(digits)
+    return None
+
+
+def _version_headers(version: int, suffix: str = "") -> dict[str, str]:
+    return {
+        "ETag": _etag(version, suffix),
+        "Cache-Control": "no-cache",
+        "X-Group-Version": str(version),
+    }
+
+
+def _template_tag() -> str:
+    """Часть ETag страницы, которая меняется вместе с файлом шаблона."""
+    template_path = __file__.replace("webapp.py", "templates/receipt.html")
+    try:
+        return f"-t{os.stat(template_path).st_mtime_ns:x}"
+    except OSError:
+        return ""
+
+
+def render_receipt_page(positions: list[dict], version: int | None = None) -> str:
     """
     Формирует HTML‑страницу для мини‑приложения и внедряет список позиций.
 
     Функция умеет работать как с обычными словарями, так и с моделями
     Pydantic (Item). Для объектов Pydantic используется доступ через
     атрибуты .name, .quantity и .price. Если эти атрибуты отсутствуют,
-    вставляется None.
+    вставляется None. Версия группы (если передана) внедряется как
+    window.GROUP_VERSION и отправляется клиентом вместе с выбором.
     """
     import json
     normalized = []
@@ -60,7 +103,11 @@ def render_receipt_page(positions: list[dict]) -> str:
             name = getattr(p, "name", None)
             quantity = getattr(p, "quantity", None)
             price = getattr(p, "price", None)
-        normalized.append({"name": name, "quantity": quantity, "price": price})
+        item = {"name": name, "quantity": quantity, "price": price}
+        # id позиции нужен клиенту для отправки изменений выбора
+        if isinstance(p, dict) and p.get("id") is not None:
+            item["id"] = p["id"]
+        normalized.append(item)
     positions_json = json.dumps(normalized, ensure_ascii=False)
     template_path = __file__.replace("webapp.py", "templates/receipt.html")
     with open(template_path, "r", encoding="utf-8") as f:
@@ -84,6 +131,8 @@ def render_receipt_page(positions: list[dict]) -> str:
     if backend_url:
         backend_injection = f"<script>const BACKEND_URL = '{backend_url}';</script>"
         html = html.replace("</head>", f"{backend_injection}\n</head>")
+    if version is not None:
+        html = html.replace("</head>", f"<script>window.GROUP_VERSION = {int(version)};</script>\n</head>")
     return html
 
 
@@ -93,18 +142,28 @@ async def get_receipt_page(request: Request):
     Возвращает страницу мини‑приложения для выбора позиций. Если передан параметр
     group_id, загружает только позиции для этой группы. В противном случае
     возвращает пустой список позиций.
+
+    Для группы ответ содержит ETag из версии группы и времени изменения
+    шаблона; если клиент прислал тот же ETag в If-None-Match, возвращается
+    304 Not Modified без чтения позиций и рендера.
     """
-    # Загружаем все позиции из файла (dict[group_id -> list])
-    all_positions = load_positions() or {}
     group_id = request.query_params.get('group_id')
-    if group_id:
-        positions = all_positions.get(str(group_id), [])
-    else:
+    if not group_id:
         # Если нет group_id, не выдаём никакие позиции
-        positions = []
+        return HTMLResponse(content=render_receipt_page([]), status_code=200)
+    suffix = _template_tag()
+    # Читаем только позиции нужной группы (индекс по group_id)
+    version, positions = await db.get_positions_if_changed(
+        str(group_id), _known_version(request, suffix)
+    )
+    headers = _version_headers(version, suffix)
+    if positions is None:
+        metrics.incr("etag.hit")
+        return Response(status_code=304, headers=headers)
+    metrics.incr("etag.miss")
     logger.debug("Найдено %d позиций для group_id=%s", len(positions), group_id)
-    html = render_receipt_page(positions)
-    return HTMLResponse(content=html, status_code=200)
+    html = render_receipt_page(positions, version)
+    return HTMLResponse(content=html, status_code=200, headers=headers)
 
 # New API endpoint to fetch positions for a given group.
 #
@@ -121,17 +180,81 @@ async def api_positions(request: Request):
     missing or there are no positions stored for that group, an empty
     list will be returned. The response is a JSON array of objects
     containing ``name``, ``quantity`` and ``price`` keys.
+
+    The group version is returned in the ``ETag`` and ``X-Group-Version``
+    headers. A request whose ``If-None-Match`` carries the current ETag is
+    answered with ``304 Not Modified`` without reading the positions.
     """
     group_id = request.query_params.get('group_id')
-    # Load all positions from storage and filter by the provided group ID.
-    all_positions = load_positions() or {}
-    if group_id:
-        positions = all_positions.get(str(group_id), [])
-    else:
-        positions = []
+    if not group_id:
+        return JSONResponse(content=[], status_code=200)
+    # Read only the requested group's positions (indexed by group_id).
+    version, positions = await db.get_positions_if_changed(str(group_id), _known_version(request))
+    headers = _version_headers(version)
+    if positions is None:
+        metrics.incr("etag.hit")
+        return Response(status_code=304, headers=headers)
+    metrics.incr("etag.miss")
     logger.debug("Отдаём %d позиций для group_id=%s", len(positions), group_id)
 
-    return JSONResponse(content=positions, status_code=200)
+    return JSONResponse(content=positions, status_code=200, headers=headers)
+
+
+def _can_watch_group(init_data: str | None, group_id: str) -> bool:
+    """
+    Проверяет подпись и возраст initData (не старше
+    ``settings.init_data_max_age``) и что мини‑приложение открыто для этой
+    группы.
+    """
+    if not init_data:
+        return False
+    try:
+        parsed = safe_parse_webapp_init_data(settings.bot_token, init_data)
+    except ValueError:
+        return False
+    # Подпись не истекает: без проверки возраста перехваченная ссылка
+    # давала бы доступ к потоку группы навсегда
+    if time.time() - parsed.auth_date.timestamp() > settings.init_data_max_age:
+        return False
+    if parsed.user is not None and str(parsed.user.id) == group_id:
+        return True
+    return parsed.start_param == f"group_{group_id}"
+
+
+@app.get("/webapp/api/live")
+async def live_updates(request: Request):
+    """
+    Поток Server-Sent Events с изменениями выбора в группе (см.
+    ``services.live``): snapshot при подключении, затем delta при каждом
+    изменении. Браузер переподключается сам и присылает Last-Event-ID —
+    версию группы, которую он уже видел.
+
+    В событиях — Telegram‑id участников и их выбор, поэтому поток отдаётся
+    только по подписанному initData (параметр ``auth``: EventSource не
+    умеет передавать заголовки), и только для группы, из которой открыто
+    мини‑приложение (подписанный start_param ``group_<id>``), или для
+    личного чата самого пользователя.
+    """
+    group_id = request.query_params.get('group_id')
+    if not group_id:
+        return JSONResponse({"error": "Missing group_id"}, status_code=400)
+    if not _can_watch_group(request.query_params.get('auth'), str(group_id)):
+        metrics.incr("live.forbidden")
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    if live_hub.full:
+        return JSONResponse(
+            {"error": "Too many subscribers"}, status_code=503, headers={"Retry-After": "30"}
+        )
+    try:
+        last_event_id = int(request.headers.get("last-event-id", ""))
+    except ValueError:
+        last_event_id = None
+    return StreamingResponse(
+        live_hub.stream(str(group_id), last_event_id),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx отдаёт события сразу, а не копит в буфере
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 # ---------------------------------------------------------------------------
 # Endpoint to accept selection data from Mini App opened via deep‑link.
@@ -150,9 +273,19 @@ async def submit_selection(request: Request):
         - `_auth`: the initData string from Telegram WebApp (required for validation)
         - `group_id`: the chat ID that corresponds to the receipt (string or int)
         - `selected`: mapping of index → quantity or list of indices
+        - `version` (optional): the group version the client rendered (from
+          ``X-Group-Version`` / ``window.GROUP_VERSION``)
 
-    Upon successful validation and saving, the function returns `{"status": "ok"}`.
-    If validation fails or required fields are missing, an error JSON is returned.
+    Instead of `selected`/`equal` the client may send only what changed:
+    `changes`: mapping of position id → quantity, `"equal"` or `0` (remove).
+    These are applied as per-position upserts (``apply_selection_changes``);
+    the rest of the user's selection is left untouched.
+
+    Upon successful validation and saving, the function returns
+    `{"status": "ok", "version": <new group version>}`. If `version` is given
+    and the group has changed since, nothing is saved and `409` is returned
+    with the current version. If validation fails or required fields are
+    missing, an error JSON is returned.
     """
     try:
         body = await request.json()
@@ -211,8 +344,27 @@ async def submit_selection(request: Request):
     equal_data = body.get("equal", [])
     if not group_id:
         return JSONResponse({"error": "Missing group_id"}, status_code=400)
+    expected_version = body.get("version")
+    if expected_version is not None:
+        try:
+            expected_version = int(expected_version)
+        except (TypeError, ValueError):
+            return JSONResponse({"error": "Invalid version"}, status_code=400)
     group_id_str = str(group_id)
     user_id_int = user.id
+    if "changes" in body:
+        try:
+            version = await db.apply_selection_changes(
+                group_id_str, user_id_int, parse_selection_changes(body.get("changes")), expected_version
+            )
+            live_hub.notify(group_id_str)
+        except StaleVersionError as e:
+            logger.info("Отклонены устаревшие изменения выбора: %s", e)
+            return JSONResponse({"error": "stale_version", "version": e.current}, status_code=409)
+        except Exception as e:
+            logger.error("Ошибка сохранения изменений выбора: %s", e, exc_info=True)
+            return JSONResponse({"error": str(e)}, status_code=500)
+        return JSONResponse({"status": "ok", "version": version}, status_code=200)
     # Build list of indices for legacy assignments (используются только для
     # fallback-расчётов). Используем только ручные (selected) позиции.
     indices: list[int] = []
@@ -236,7 +388,7 @@ async def submit_selection(request: Request):
     try:
         logger.debug("Сохраняем assignment: %s", indices)
         set_assignment(group_id_str, user_id_int, indices)
-        all_positions = get_positions(group_id_str)
+        all_positions = await db.get_positions(group_id_str)
         selected_positions: list[dict] = []
         # Обрабатываем ручные выборы (selected_data)
         if isinstance(selected_data, dict):
@@ -287,25 +439,33 @@ async def submit_selection(request: Request):
                     "price": orig.get("price"),
                 })
         logger.debug("Сохраняем выбранные позиции: %s", selected_positions)
-        save_selected_positions(group_id_str, user_id_int, selected_positions)
+        version = await db.save_selected_positions(
+            group_id_str, user_id_int, selected_positions, expected_version
+        )
+        live_hub.notify(group_id_str)
+    except StaleVersionError as e:
+        # Индексы выбора относятся к устаревшему состоянию группы
+        logger.info("Отклонён устаревший выбор: %s", e)
+        return JSONResponse(
+            {"error": "stale_version", "version": e.current}, status_code=409
+        )
     except Exception as e:
         logger.error("Ошибка сохранения данных: %s", e, exc_info=True)
         return JSONResponse({"error": str(e)}, status_code=500)
-    return JSONResponse({"status": "ok"}, status_code=200)
+    return JSONResponse({"status": "ok", "version": version}, status_code=200)
 
 # --- Health helpers ----------------------------------------------------------
-def _check_positions_store() -> dict:
+async def _check_positions_store() -> dict:
     """
-    Пытается загрузить позиции и возвращает краткий статус.
-    Не делает тяжёлых операций — годится для readiness.
+    Проверяет доступность базы позиций и возвращает краткий статус.
+    Выполняет запрос за константное время, не зависящее от объёма
+    данных, — годится для readiness.
     """
     try:
-        data = load_positions() or {}
-        ok = isinstance(data, dict)
+        schema_version = await db.ping()
         return {
-            "status": "ok" if ok else "error",
-            "groups": len(data) if ok else 0,
-            "type": type(data).__name__,
+            "status": "ok",
+            "schema_version": schema_version,
         }
     except Exception as e:
         return {"status": "error", "error": str(e)}
@@ -331,11 +491,11 @@ async def health():
 
     Возвращает общий статус, аптайм и детали:
     - наличие шаблона receipt.html
-    - доступность хранилища позиций (load_positions)
+    - доступность хранилища позиций (ping базы данных)
     """
     details = {
         "template_receipt_html": _check_template(),
-        "positions_store": _check_positions_store(),
+        "positions_store": await _check_positions_store(),
     }
     # Если что-то 'error' или 'missing' — считаем degraded, но 200 оставляем,
     # чтобы не флапать liveness без крайней необходимости.
@@ -355,6 +515,23 @@ async def health():
     )
 
 
+@app.get("/metrics", response_class=JSONResponse)
+async def get_metrics(request: Request):
+    """
+    Внутренние метрики процесса веб‑приложения (см. ``app.metrics``).
+
+    Приложение доступно из интернета, поэтому метрики отдаются только с
+    заголовком ``Authorization: Bearer <METRICS_TOKEN>``; без METRICS_TOKEN
+    эндпоинта нет (как и /metrics бота, доступного только администратору).
+    """
+    if not settings.metrics_token:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    supplied = request.headers.get("authorization", "")
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {settings.metrics_token}".encode()):
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    return JSONResponse(metrics.snapshot())
+
+
 # if __name__ == "__main__":
 #     # На Linux пути с обратным слешем интерпретируются как имя файла, а
 #     # сертификаты лежат в директории cert. Используем os.path.join для
@@ -0,0 +1,129 @@
+"""
+Стоимости и балансы группы: агрегация в SQL против расчёта в Python.
+
+Группы заполняются случайными позициями, выборами и платежами напрямую в
+таблицы, после чего проекции строятся заново (rebuild_group_balances).
+
+1. Паритет: на 400 группах с крайними случаями (отрицательные цены, NULL
+   количества, выборы без позиции, повторные отметки «поровну»)
+   check_group_balances не находит расхождений, а get_unassigned_positions
+   совпадает с эталоном в Python.
+2. Медианное время на группу: Python (load_group_snapshot +
+   compute_costs), SQL‑агрегация (rebuild_group_balances +
+   load_group_balances) и чтение готовой проекции (load_group_balances).
+"""
+
+import random
+import statistics
+import time
+from typing import Callable
+
+import common  # noqa: F401
+
+from app import database as db
+from app.settlement import build_snapshot, check_group_balances, compute_balances, compute_costs
+
+
+def seed(group: str, positions: int, users: int, rng: random.Random, edge: bool = False) -> None:
+    with db.db_connection() as conn:
+        ids = []
+        for i in range(positions):
+            price = rng.choice([rng.randint(1, 500_000), rng.randint(-5000, -1)]) if edge else rng.randint(100, 300_000)
+            quantity = rng.choice([1, 2, 3, 0.5, 1.5, None]) if edge else rng.choice([1, 1, 2, 3])
+            cur = conn.execute(
+                "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
+                (group, f"p{i % 7}", quantity, price),
+            )
+            ids.append(cur.lastrowid)
+        rows = []
+        for user in range(1, users + 1):
+            uid = str(user * 1_000_003 % 99_991)
+            for pid in rng.sample(ids, min(len(ids), rng.randint(1, max(1, positions // 3)))):
+                quantity = rng.choice([-1, -1, 1, 0.5, 1 / 3, 2] + ([0, None] if edge else []))
+                rows.append((group, uid, pid, quantity, rng.randint(1, 9999)))
+            if edge and rng.random() < 0.2:
+                # Выбор без позиции в чеке или со ссылкой на удалённую позицию
+                pid = None if rng.random() < 0.5 else 10**9
+                rows.append((group, uid, pid, rng.choice([-1, 1, 2.5]), rng.randint(-100, 9999)))
+        conn.executemany(
+            "INSERT INTO selected_positions (group_id, user_tg_id, position_id, quantity, price) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        payments = [
+            (str(rng.randint(1, users) * 1_000_003 % 99_991), group, rng.randint(0, 10**6))
+            for _ in range(rng.randint(0, 5))
+        ]
+        if edge:
+            payments.append(("777", group, None))
+        conn.executemany("INSERT INTO payments (tg_user_id, group_id, amount) VALUES (?, ?, ?)", payments)
+    db.rebuild_group_balances(group)
+
+
+def python_path(group: str) -> dict[int, int]:
+    snapshot = build_snapshot(*db.load_group_snapshot(group))
+    return compute_balances(compute_costs(snapshot), snapshot.payments)
+
+
+def sql_path(group: str) -> list:
+    db.rebuild_group_balances(group)
+    return db.load_group_balances(group)[1]
+
+
+def unassigned_reference(group: str) -> list[dict]:
+    """Эталон по position_id: явные выборы вычитаются, отметка «поровну» закрывает позицию."""
+    with db.db_connection() as conn:
+        positions = conn.execute(
+            "SELECT id, name, quantity, price FROM positions WHERE group_id = ? ORDER BY id", (group,)
+        ).fetchall()
+        selections = conn.execute(
+            "SELECT position_id, quantity FROM selected_positions WHERE group_id = ?", (group,)
+        ).fetchall()
+    chosen: dict[int, float] = {}
+    split: set[int] = set()
+    for row in selections:
+        quantity = row["quantity"] or 0
+        if quantity < 0:
+            split.add(row["position_id"])
+        elif quantity > 0:
+            chosen[row["position_id"]] = chosen.get(row["position_id"], 0) + quantity
+    result = []
+    for row in positions:
+        remaining = (row["quantity"] or 0) - chosen.get(row["id"], 0)
+        if row["id"] not in split and remaining > 0.01:
+            result.append({"name": row["name"], "quantity": round(remaining, 2), "price": (row["price"] or 0) / 100})
+    return result
+
+
+def median_ms(func: Callable[[str], object], group: str, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(group)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    rng = random.Random(16)
+    groups = [f"edge-{k}" for k in range(400)]
+    for group in groups:
+        seed(group, rng.randint(0, 30), rng.randint(1, 12), rng, edge=True)
+    balances_ok = sum(not check_group_balances(group) for group in groups)
+    unassigned_ok = sum(unassigned_reference(group) == db.get_unassigned_positions(group) for group in groups)
+    print(f"balances parity: {balances_ok}/{len(groups)}, unassigned parity: {unassigned_ok}/{len(groups)}")
+
+    print(f"{'positions':>9} {'users':>5} {'selections':>10} | {'python ms':>9} {'rebuild ms':>10} {'projection ms':>13}")
+    for positions, users in ((10, 4), (50, 10), (200, 30), (1000, 60), (3000, 100)):
+        group = f"bench-{positions}"
+        seed(group, positions, users, rng)
+        with db.db_connection() as conn:
+            selections = conn.execute(
+                "SELECT COUNT(*) FROM selected_positions WHERE group_id = ?", (group,)
+            ).fetchone()[0]
+        repeat = 200 if positions < 500 else 20
+        timings = [median_ms(func, group, repeat) for func in (python_path, sql_path, db.load_group_balances)]
+        print(f"{positions:>9} {users:>5} {selections:>10} | {timings[0]:9.3f} {timings[1]:10.3f} {timings[2]:13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Пакетная запись строк (executemany) в ``app.database``.
+
+Для чеков из 10, 100 и 1000 строк печатается время одного вызова
+set_positions, save_selected_positions и save_debts, а также запись
+стольких же платежей: по одному (add_payment в цикле — отдельная
+транзакция на платёж) и одним вызовом add_payments.
+"""
+
+import common
+
+from app import database as db
+
+
+def main() -> None:
+    columns = ["set_positions", "save_selected", "save_debts", "add_payment xN", "add_payments"]
+    print("ms per call\n" + f"{'lines':>5}" + "".join(f"{name:>16}" for name in columns))
+    for n in (10, 100, 1000):
+        group = f"bench-{n}"
+        positions = [{"name": f"item{i}", "quantity": 1.0, "price": float(100 + i)} for i in range(n)]
+        payments = [(uid, 10.0, None) for uid in range(n)]
+        repeat = max(3, 2000 // n)
+        timings = [
+            common.median_ms(lambda: db.set_positions(group, positions), repeat),
+            common.median_ms(lambda: db.save_selected_positions(group, 1, positions), repeat),
+            common.median_ms(lambda: db.save_debts(group, {uid: 1000 for uid in range(n)}), repeat),
+            common.median_ms(lambda: [db.add_payment(group, *payment) for payment in payments], 3),
+            common.median_ms(lambda: db.add_payments(group, payments), 3),
+        ]
+        print(f"{n:>5}" + "".join(f"{value:16.2f}" for value in timings))
+
+
+if __name__ == "__main__":
+    main()
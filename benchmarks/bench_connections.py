@@ -0,0 +1,79 @@
+"""
+Пул соединений SQLite против отдельного соединения на каждый вызов.
+
+Режим «per-call» воспроизводит прежнее поведение: каждая функция
+``app.database`` открывает новое соединение без PRAGMA‑настроек и
+закрывает его. Остальные режимы — соединение потока из пула с профилями
+DB_PROFILE. Печатается число операций в секунду (один поток, чек из 20
+позиций).
+"""
+
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+import common  # noqa: F401
+
+from app import database as db
+
+SELECTION = [{"name": "p1", "quantity": 1, "price": 101}, {"name": "p2", "quantity": 1, "price": 102}]
+
+
+def operations(group: str) -> list[tuple[str, Callable[[int], object], int]]:
+    # Каждый режим работает со своей группой: платежи, добавленные
+    # предыдущим режимом, не замедляют чтение следующего.
+    db.add_positions(group, [{"name": f"p{i}", "quantity": 2, "price": 100 + i} for i in range(20)])
+    return [
+        ("get_positions", lambda i: db.get_positions(group), 3000),
+        ("get_payments", lambda i: db.get_payments(group), 3000),
+        ("get_user", lambda i: db.get_user(i), 3000),
+        ("add_payment", lambda i: db.add_payment(group, i % 5, 10.0), 1000),
+        ("save_selected_positions", lambda i: db.save_selected_positions(group, i % 5, SELECTION), 1000),
+        ("calculate_group_balance", lambda i: db.calculate_group_balance(group), 1000),
+    ]
+
+
+@contextmanager
+def per_call_connection():
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def ops_per_second(func: Callable[[int], object], count: int) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - started)
+
+
+def main() -> None:
+    pooled = db.db_connection
+    modes = ["per-call", "low_memory", "default", "throughput"]
+    results: dict[str, dict[str, float]] = {}
+    for mode in modes:
+        db.close_all_connections()
+        if mode == "per-call":
+            db.db_connection = per_call_connection
+        else:
+            db.db_connection = pooled
+            db.DB_PROFILE = mode
+        results[mode] = {name: ops_per_second(func, count) for name, func, count in operations(f"bench-{mode}")}
+    db.db_connection = pooled
+    db.close_all_connections()
+
+    print(f"{'ops/s':24}" + "".join(f"{mode:>12}" for mode in modes))
+    for name in results[modes[0]]:
+        print(f"{name:24}" + "".join(f"{results[mode][name]:12.0f}" for mode in modes))
+
+
+if __name__ == "__main__":
+    main()
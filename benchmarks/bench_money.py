@@ -0,0 +1,103 @@
+"""
+Расчёт в целых копейках против прежнего расчёта во float.
+
+Прежний движок берётся из истории git — app/settlement.py из коммита перед
+появлением app/money.py (или из ревизии, переданной аргументом):
+
+    python benchmarks/bench_money.py [REV]
+
+На одних и тех же случайных чеках печатается время settle_snapshot
+(минимум из 15 запусков, переводы — жадным алгоритмом) обоих движков и
+наибольшее расхождение балансов в копейках — округление каждой позиции
+до копейки, которого во float‑расчёте не было. Затем проверяется, что
+доли «поровну» в сумме дают ровно стоимость позиции.
+"""
+
+import random
+import subprocess
+import sys
+import time
+import types
+from typing import Callable
+
+import common
+
+from app import money, settlement
+
+
+def load_float_engine(revision: str | None) -> types.ModuleType:
+    if revision is None:
+        added = subprocess.check_output(
+            ["git", "log", "--diff-filter=A", "--format=%H", "--", "app/money.py"], cwd=common.ROOT, text=True
+        ).split()[-1]
+        revision = f"{added}^"
+    source = subprocess.check_output(["git", "show", f"{revision}:app/settlement.py"], cwd=common.ROOT, text=True)
+    module = types.ModuleType("float_settlement")
+    module.__file__ = f"{revision}:app/settlement.py"
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def receipt_rows(rng: random.Random, positions: int, users: int) -> tuple[list, list, list]:
+    """Строки positions, selected_positions и payments в рублях."""
+    pos_rows = [
+        {"id": i, "quantity": rng.choice([1, 2, 3, 0.5]), "price": round(rng.uniform(10, 3000), 2)}
+        for i in range(positions)
+    ]
+    sp_rows = []
+    for row in pos_rows:
+        for uid in rng.sample(range(1, users + 1), rng.randint(1, min(6, users))):
+            sp_rows.append(
+                {"user_tg_id": uid, "position_id": row["id"], "quantity": rng.choice([-1, -1, 1, 0.5]), "price": row["price"]}
+            )
+    pay_rows = [{"tg_user_id": uid, "total_amount": round(rng.uniform(0, 20000), 2)} for uid in range(1, users + 1)]
+    return pos_rows, sp_rows, pay_rows
+
+
+def in_kopecks(rows: list[dict], key: str) -> list[dict]:
+    return [dict(row, **{key: money.to_kopecks(row[key])}) for row in rows]
+
+
+def best_ms(func: Callable[[], object], repeat: int = 15) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return min(samples)
+
+
+def main() -> None:
+    old = load_float_engine(sys.argv[1] if len(sys.argv) > 1 else None)
+    # Сравнивается арифметика, а не поиск переводов: точный поиск при
+    # 15 участниках занимает десятки миллисекунд в обоих движках.
+    old.SETTLEMENT_MODE = settlement.SETTLEMENT_MODE = "greedy"
+    rng = random.Random(9)
+    print(f"{'positions':>9} {'users':>5} {'float ms':>9} {'kopecks ms':>11} {'max diff, коп.':>15}")
+    for positions, users in [(50, 8), (500, 15), (5000, 15), (20000, 40)]:
+        pos_rows, sp_rows, pay_rows = receipt_rows(rng, positions, users)
+        new_rows = in_kopecks(pos_rows, "price"), in_kopecks(sp_rows, "price"), in_kopecks(pay_rows, "total_amount")
+        float_ms = best_ms(lambda: old.settle_snapshot("g", old.build_snapshot(pos_rows, sp_rows, pay_rows)))
+        kopecks_ms = best_ms(lambda: settlement.settle_snapshot("g", settlement.build_snapshot(*new_rows)))
+        before = old.settle_snapshot("g", old.build_snapshot(pos_rows, sp_rows, pay_rows)).balances
+        after = settlement.settle_snapshot("g", settlement.build_snapshot(*new_rows)).balances
+        diff = max(abs(round(balance * 100) - after[uid]) for uid, balance in before.items())
+        print(f"{positions:>9} {users:>5} {float_ms:9.2f} {kopecks_ms:11.2f} {diff:>15}")
+
+    mismatches = 0
+    for _ in range(2000):
+        pos_rows = [
+            {"id": i, "quantity": rng.choice([1, 2, 3]), "price": rng.randint(1, 300_000)} for i in range(rng.randint(1, 20))
+        ]
+        sp_rows = [
+            {"user_tg_id": uid, "position_id": row["id"], "quantity": -1, "price": row["price"]}
+            for row in pos_rows
+            for uid in rng.sample(range(1, 10), rng.randint(1, 7))
+        ]
+        costs = settlement.compute_costs(settlement.build_snapshot(pos_rows, sp_rows, []))
+        mismatches += sum(costs.values()) != sum(row["quantity"] * row["price"] for row in pos_rows)
+    print(f"чеков «поровну», где доли не сошлись со стоимостью: {mismatches} из 2000")
+
+
+if __name__ == "__main__":
+    main()
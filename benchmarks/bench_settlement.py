@@ -0,0 +1,71 @@
+"""
+Число переводов и время расчёта: жадный алгоритм против оптимального.
+
+Балансы — как в ресторане: каждый тратит 300–1300 ₽, четверть участников
+оплачивает общий счёт. Для каждого n печатается среднее число переводов,
+доля сэкономленных переводов и медианное время обоих алгоритмов.
+Проверяется, что переводы закрывают балансы и их не больше, чем у
+жадного алгоритма.
+"""
+
+import random
+import statistics
+import time
+
+import common  # noqa: F401
+
+from app import settlement as st
+
+TRIALS = 30
+# Стоимость заказа одного участника в копейках
+DISHES = [30000, 45000, 50000, 60000, 75000, 90000, 120000]
+
+
+def scenario(rng: random.Random, n: int) -> dict[int, int]:
+    costs = [rng.choice(DISHES) + rng.choice([0, 0, 5000, 10000]) for _ in range(n)]
+    payers = rng.sample(range(n), max(1, n // 4))
+    paid = [0] * n
+    left = sum(costs)
+    for k, payer in enumerate(payers):
+        amount = left if k == len(payers) - 1 else rng.randint(0, left // 2) // 5000 * 5000
+        paid[payer] += amount
+        left -= amount
+    return {uid + 1: paid[uid] - costs[uid] for uid in range(n)}
+
+
+def closes(balances: dict[int, int], transfers: list[tuple[int, int, int]]) -> bool:
+    left = dict(balances)
+    for debtor, creditor, amount in transfers:
+        left[debtor] += amount
+        left[creditor] -= amount
+    return all(abs(value) <= st.DUST_KOPECKS for value in left.values())
+
+
+def main() -> None:
+    rng = random.Random(7)
+    print(f"{'n':>3} {'greedy':>7} {'optimal':>8} {'saved':>7} {'greedy ms':>10} {'optimal ms':>11}")
+    for n in (3, 5, 8, 10, 12, 15, 18, 20, 30, 50):
+        greedy_count = optimal_count = 0
+        greedy_ms: list[float] = []
+        optimal_ms: list[float] = []
+        for _ in range(TRIALS):
+            balances = scenario(rng, n)
+            started = time.perf_counter()
+            greedy = st.greedy_transfers(balances)
+            greedy_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            optimal = st.optimal_transfers(balances)
+            optimal_ms.append((time.perf_counter() - started) * 1000)
+            assert closes(balances, optimal), (balances, optimal)
+            assert len(optimal) <= len(greedy), (balances, greedy, optimal)
+            greedy_count += len(greedy)
+            optimal_count += len(optimal)
+        saved = 100 * (greedy_count - optimal_count) / max(greedy_count, 1)
+        print(
+            f"{n:>3} {greedy_count / TRIALS:7.2f} {optimal_count / TRIALS:8.2f} {saved:6.1f}% "
+            f"{statistics.median(greedy_ms):10.3f} {statistics.median(optimal_ms):11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Нагрузочный тест мини‑приложения при растущем числе групп.
+
+В базу добавляются группы по 20 позиций (100 → 30 000 групп), и на каждом
+шаге 8 параллельных клиентов FastAPI TestClient делают по 80 запросов к
+/webapp/api/positions, /webapp/receipt и /health (для TestClient нужен
+httpx). Печатаются p50 и p95 задержки. Время ответа не должно расти с
+числом групп: страница и API читают только позиции запрошенной группы, а
+/health — версию схемы.
+"""
+
+import sqlite3
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common  # noqa: F401
+from fastapi.testclient import TestClient
+
+from app import database as db
+from app.webapp import app
+
+PATHS = ["/webapp/api/positions?group_id=7", "/webapp/receipt?group_id=7", "/health"]
+CLIENTS = 8
+REQUESTS = 80
+
+
+def add_groups(start: int, stop: int) -> None:
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.executemany(
+        "INSERT INTO positions (group_id, name, quantity, price) VALUES (?, ?, ?, ?)",
+        [(str(group), f"p{i}", 1.0, 10_000 + i) for group in range(start, stop) for i in range(20)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def main() -> None:
+    client = TestClient(app)
+
+    def hit(path: str) -> float:
+        started = time.perf_counter()
+        assert client.get(path).status_code == 200
+        return (time.perf_counter() - started) * 1000
+
+    loaded = 0
+    for groups in (100, 1_000, 10_000, 30_000):
+        add_groups(loaded, groups)
+        loaded = groups
+        for path in PATHS:
+            hit(path)
+            with ThreadPoolExecutor(CLIENTS) as pool:
+                latencies = sorted(pool.map(hit, [path] * REQUESTS))
+            p95 = latencies[int(len(latencies) * 0.95)]
+            print(
+                f"groups={groups:>6} {path.split('?')[0]:<24} "
+                f"p50={statistics.median(latencies):7.2f}ms p95={p95:7.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
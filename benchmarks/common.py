@@ -0,0 +1,41 @@
+"""
+Общая настройка замеров производительности.
+
+Скрипты запускаются из корня репозитория:
+
+    python benchmarks/bench_settlement.py
+
+База данных создаётся заново во временном каталоге (DATABASE_PATH
+задаётся до импорта ``app.database``, который применяет миграции), поэтому
+рабочая database.db не меняется. Модули бота импортируются так же, как в
+контейнере (PYTHONPATH=app).
+"""
+
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, "app"), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+TMP_DIR = tempfile.mkdtemp(prefix="finopolis-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(TMP_DIR, "database.db")
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+logging.disable(logging.CRITICAL)
+
+
+def median_ms(func: Callable[[], object], repeat: int = 5) -> float:
+    """Медиана времени вызова func() в миллисекундах."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
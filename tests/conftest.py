@@ -0,0 +1,22 @@
+"""
+Общая настройка тестов.
+
+База данных создаётся заново во временном каталоге: путь передаётся
+через DATABASE_PATH до импорта ``app.database``, который при импорте
+применяет все миграции. Модули бота импортируются так же, как в
+контейнере (PYTHONPATH=app), поэтому в sys.path добавляются корень
+репозитория и каталог app.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, "app"), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="finopolis-tests-"), "database.db")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
@@ -0,0 +1,31 @@
+"""
+Параллельная рассылка с лимитами (services.messaging.MessageDispatcher).
+"""
+
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("aiogram")
+from services.messaging import MessageDispatcher  # noqa: E402
+
+
+class _Bot:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.sent: dict[int, list[float]] = {}
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        self.sent.setdefault(chat_id, []).append(time.monotonic() - self.started)
+
+
+def test_group_rate_limit_does_not_block_other_chats():
+    # Одно сообщение в группу в секунду и один слот: пока второе сообщение
+    # в группу ждёт свой маркер, личное сообщение уходит сразу
+    dispatcher = MessageDispatcher(concurrency=1, global_rate=100, group_rate_per_minute=60)
+    bot = _Bot()
+    report = asyncio.run(dispatcher.send_many(bot, [(-100, "a"), (-100, "b"), (7, "c")]))
+    assert report.ok and report.total == 3
+    assert bot.sent[7][0] < 0.5
+    assert bot.sent[-100][1] >= 0.9
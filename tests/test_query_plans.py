@@ -0,0 +1,162 @@
+"""
+EXPLAIN QUERY PLAN для каждого SQL‑запроса из app/database.py.
+
+Запросы собираются из аргументов execute/executemany: литералы берутся как
+есть, f‑строки (списки ``IN (...)`` порциями, выгрузки fetch_table) и
+шаблоны модуля (``ШАБЛОН.format(...)``) подставляются с примерами
+аргументов из SAMPLES. Запрос, который собрать не удалось, — ошибка: для
+новой переменной в f‑строке нужен пример. Не проверяются только PRAGMA и
+сами миграции (NOT_RENDERED).
+
+Запросы проверяются на базе после всех миграций. Любой шаг SCAN таблицы
+(полный просмотр таблицы или её индекса) — ошибка, если таблица не указана
+для этого запроса в ALLOWED. Просмотр промежуточных результатов CTE не
+проверяется: таблицы внутри CTE проверяются отдельными шагами плана.
+"""
+
+import ast
+import os
+import re
+
+import pytest
+
+from app import database
+
+SOURCE = os.path.join(os.path.dirname(database.__file__), "database.py")
+
+# Примеры значений переменных в f‑строках. Каждый набор пробуется по
+# очереди; подходит первый, в котором есть все переменные f‑строки.
+SAMPLES: list[dict[str, str]] = [
+    {"placeholders": "?, ?", "id_filter": ":p0, :p1"},
+    *({"table": table, "columns": columns} for table, columns in database.DEBUG_TABLES.items()),
+]
+
+# Аргументы execute, которые не собираются в текст запроса: цикл по
+# MIGRATIONS выполняется один раз при обновлении схемы.
+NOT_RENDERED = {"statement"}
+
+# Запрос → таблицы, которые ему разрешено просматривать целиком.
+ALLOWED: dict[str, set[str]] = {
+    # Выгрузки и сброс целой таблицы: без WHERE по определению
+    "SELECT telegram_id, phone_number, full_name, bank, telegram_login FROM accounts": {"accounts"},
+    "SELECT group_id, name, quantity, price FROM positions ORDER BY id": {"positions"},
+    "DELETE FROM positions": {"positions"},
+    "SELECT DISTINCT group_id FROM positions": {"positions"},
+    # Все группы с данными для rebuild_group_balances()
+    "SELECT group_id FROM selected_positions UNION SELECT group_id FROM payments "
+    "UNION SELECT group_id FROM group_balances": {"selected_positions", "payments", "group_balances"},
+    # Урезание кэша: N‑я по возрасту запись ищется обходом индекса
+    "SELECT expires_at FROM llm_cache ORDER BY expires_at DESC LIMIT 1 OFFSET ?": {"llm_cache"},
+    **{
+        f"SELECT {', '.join(columns)} FROM {table} ORDER BY id": {table}
+        for table, columns in database.DEBUG_TABLES.items()
+    },
+}
+
+
+def _render(node: ast.expr) -> list[str] | None:
+    """Текст запроса для аргумента execute или None, если его не собрать."""
+    if isinstance(node, ast.Constant):
+        return [node.value] if isinstance(node.value, str) else None
+    if isinstance(node, ast.Name):
+        value = getattr(database, node.id, None)
+        return [value] if isinstance(value, str) else None
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _render(node.left), _render(node.right)
+        if left is None or right is None:
+            return None
+        return [a + b for a in left for b in right]
+    if isinstance(node, ast.JoinedStr):
+        code = compile(ast.Expression(node), SOURCE, "eval")
+        names = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+        rendered = [eval(code, {}, sample) for sample in SAMPLES if names <= sample.keys()]
+        return rendered or None
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr == "format"
+        and not node.args
+    ):
+        templates = _render(node.func.value)
+        values = {keyword.arg: _render(keyword.value) for keyword in node.keywords}
+        if templates is None or any(value is None for value in values.values()):
+            return None
+        return [
+            template.format(**{name: value[0] for name, value in values.items()})
+            for template in templates
+        ]
+    return None
+
+
+def _collect() -> tuple[list[str], list[str]]:
+    with open(SOURCE, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    found: set[str] = set()
+    unrendered: list[str] = []
+    for node in ast.walk(tree):
+        if not (
+            isinstance(node, ast.Call)
+            and getattr(node.func, "attr", "") in ("execute", "executemany")
+            and node.args
+        ):
+            continue
+        arg = node.args[0]
+        text = ast.unparse(arg)
+        if text in NOT_RENDERED or re.match(r"f?['\"]+PRAGMA", text):
+            continue
+        rendered = _render(arg)
+        if rendered is None:
+            unrendered.append(f"{node.lineno}: {text}")
+            continue
+        for sql in rendered:
+            if re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)", sql, re.I):
+                found.add(" ".join(re.sub(r"--[^\n]*", "", sql).split()))
+    return sorted(found), unrendered
+
+
+STATEMENTS, UNRENDERED = _collect()
+
+
+def _tables(sql: str) -> dict[str, str]:
+    """Имя в плане (таблица или её алиас в запросе) → таблица базы."""
+    with database.db_connection() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    names = {table: table for table in tables}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+AS)?\s+(\w+)", sql, re.I):
+        if table in tables:
+            names[alias] = table
+    return names
+
+
+def _plan(sql: str) -> list[str]:
+    names = set(re.findall(r":(\w+)", sql))
+    params = {name: "1" for name in names} if names else ("1",) * sql.count("?")
+    with database.db_connection() as conn:
+        return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+
+def test_statements_found():
+    # Защита от того, что сбор запросов перестал что‑либо находить
+    assert len(STATEMENTS) > 25
+
+
+def test_every_statement_rendered():
+    assert not UNRENDERED, f"нет примера аргументов для запросов: {UNRENDERED}"
+
+
+def test_schema_migrated():
+    with database.db_connection() as conn:
+        assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("sql", STATEMENTS, ids=lambda sql: sql[:80])
+def test_no_full_table_scan(sql):
+    allowed = ALLOWED.get(sql, set())
+    tables = _tables(sql)
+    scans = [
+        step for step in _plan(sql)
+        if (match := re.match(r"SCAN (?:TABLE )?(\w+)", step))
+        and match.group(1) in tables
+        and tables[match.group(1)] not in allowed
+    ]
+    assert not scans, f"полный просмотр: {scans}"
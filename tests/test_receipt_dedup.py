@@ -0,0 +1,84 @@
+"""
+Повторно присланные чеки: разные чеки одной вёрстки не должны совпадать.
+"""
+
+import asyncio
+import io
+
+import pytest
+
+from app import database
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+from services import image_prep, receipt_dedup  # noqa: E402
+
+QR = "t=20240101T1200&s={total}&fn={fn}&i=41270&fp=2129340997&n=1"
+
+
+def _render_receipt(lines: list[str], qr: str | None = None) -> bytes:
+    """Чек одной и той же вёрстки: строки текста и QR‑код внизу."""
+    image = Image.new("L", (600, 900), 240)
+    draw = ImageDraw.Draw(image)
+    for row, line in enumerate(lines):
+        draw.text((60, 60 + row * 40), line, fill=20)
+    if qr is not None:
+        zxingcpp = pytest.importorskip("zxingcpp")
+        code = zxingcpp.write_barcode_to_image(
+            zxingcpp.create_barcode(qr, zxingcpp.BarcodeFormat.QRCode), scale=4
+        )
+        image.paste(code if isinstance(code, Image.Image) else Image.fromarray(code), (200, 560))
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+RECEIPT_A = ["КАФЕ ЛУНА", "Пицца 1 x 450.00", "Чай 2 x 120.00", "ИТОГ 690.00"]
+RECEIPT_B = ["КАФЕ ЛУНА", "Паста 1 x 520.00", "Кофе 2 x 150.00", "ИТОГ 820.00"]
+ITEMS_A = [{"name": "Пицца", "quantity": 1, "price": 450}, {"name": "Чай", "quantity": 2, "price": 120}]
+
+
+def test_same_layout_receipts_have_different_qr_keys():
+    pytest.importorskip("zxingcpp")
+    key_a = image_prep.read_fiscal_key(_render_receipt(RECEIPT_A, QR.format(total="690.00", fn="7380440700076549")))
+    key_b = image_prep.read_fiscal_key(_render_receipt(RECEIPT_B, QR.format(total="820.00", fn="7380440700076550")))
+    assert key_a == "7380440700076549:41270:2129340997"
+    assert key_b == "7380440700076550:41270:2129340997"
+
+
+def test_receipt_without_qr_has_no_key():
+    assert image_prep.read_fiscal_key(_render_receipt(RECEIPT_A)) is None
+
+
+def test_same_layout_receipt_is_not_matched():
+    # Первый чек распознан и сохранён; второй той же вёрстки — новый чек
+    async def scenario():
+        await receipt_dedup.remember(ITEMS_A, None, "file-layout-a")
+        try:
+            scan, key = await receipt_dedup.find_by_qr(_render_receipt(RECEIPT_B), "file-layout-b")
+        finally:
+            image_prep.shutdown()
+        return scan, key, await receipt_dedup.find_by_file("file-layout-b")
+
+    scan, key, by_file = asyncio.run(scenario())
+    assert scan is None and key is None and by_file is None
+
+
+def test_lookup_by_fiscal_key():
+    scan_id = database.save_receipt_scan(ITEMS_A, "fn-a:1:1", "file-qr-a")
+    assert database.find_receipt_scan("fn-b:1:1") is None
+    found_id, items = database.find_receipt_scan("fn-a:1:1")
+    assert found_id == scan_id
+    assert items == [{"name": "Пицца", "quantity": 1, "price": 450.0}, {"name": "Чай", "quantity": 2, "price": 120.0}]
+    assert database.get_receipt_scan_by_file("file-qr-a") == (scan_id, items)
+    # Тот же чек, распознанный параллельно, не создаёт вторую запись
+    assert database.save_receipt_scan(ITEMS_A, "fn-a:1:1") == scan_id
+
+
+def test_receipt_added_to_group_once():
+    scan_id = database.save_receipt_scan(ITEMS_A, None, "file-group")
+    assert database.add_positions("dedup-group-1", ITEMS_A, scan_id)
+    assert not database.add_positions("dedup-group-1", ITEMS_A, scan_id)
+    assert database.add_positions("dedup-group-2", ITEMS_A, scan_id)
+    assert len(database.get_positions("dedup-group-1")) == 2
@@ -0,0 +1,141 @@
+"""
+Минимальное число переводов (settlement.optimal_transfers) и сверка проекции
+балансов (settlement.check_group_balances).
+"""
+
+import random
+import threading
+from functools import lru_cache
+
+import pytest
+
+from app import database, settlement as st
+
+# Жадный алгоритм тратит здесь 5 переводов, оптимальное разбиение
+# {1, 5, 6}, {2, 3, 4} — 4.
+UNEVEN = {1: -100, 2: 300, 3: -500, 4: 200, 5: 700, 6: -600}
+
+
+def _zero_sum_balances(rng: random.Random, n: int) -> dict[int, int]:
+    amounts = [rng.choice([300, 450, 500, 600, 750, 900, 1200]) * rng.choice([1, -1]) for _ in range(n - 1)]
+    amounts.append(-sum(amounts))
+    return {uid: amount for uid, amount in enumerate(amounts, 1)}
+
+
+def _left(balances: dict[int, int], transfers: list[tuple[int, int, int]]) -> dict[int, int]:
+    """Балансы после переводов."""
+    left = dict(balances)
+    for debtor, creditor, amount in transfers:
+        assert amount > 0
+        left[debtor] += amount
+        left[creditor] -= amount
+    return left
+
+
+def _max_zero_sum_parts(amounts: tuple[int, ...]) -> int:
+    """Перебором: на сколько подгрупп с нулевой суммой можно разбить amounts."""
+
+    @lru_cache(maxsize=None)
+    def best(mask: int) -> int:
+        if not mask:
+            return 0
+        first = mask & -mask
+        result = -1
+        sub = mask
+        while sub:
+            if sub & first and sum(a for i, a in enumerate(amounts) if sub >> i & 1) == 0:
+                rest = best(mask ^ sub)
+                if rest >= 0:
+                    result = max(result, rest + 1)
+            sub = (sub - 1) & mask
+        return result
+
+    return best((1 << len(amounts)) - 1)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_transfers_close_every_balance(seed):
+    rng = random.Random(seed)
+    balances = _zero_sum_balances(rng, rng.randint(2, 10))
+    transfers = st.optimal_transfers(balances)
+    assert all(abs(value) <= st.DUST_KOPECKS for value in _left(balances, transfers).values())
+    assert len(transfers) <= len(st.greedy_transfers(balances))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_transfer_count_is_minimal(seed):
+    rng = random.Random(100 + seed)
+    balances = _zero_sum_balances(rng, rng.randint(2, 7))
+    amounts = tuple(value for value in balances.values() if value)
+    expected = len(amounts) - _max_zero_sum_parts(amounts) if amounts else 0
+    assert len(st.optimal_transfers(balances)) == expected
+
+
+def test_fewer_transfers_than_greedy():
+    assert len(st.greedy_transfers(UNEVEN)) == 5
+    transfers = st.optimal_transfers(UNEVEN)
+    assert len(transfers) == 4
+    assert not any(_left(UNEVEN, transfers).values())
+
+
+def test_zero_sum_groups_partition():
+    amounts = list(UNEVEN.values())
+    groups = st._zero_sum_groups(amounts, float("inf"))
+    assert sorted(i for group in groups for i in group) == list(range(len(amounts)))
+    assert all(sum(amounts[i] for i in group) == 0 for group in groups)
+    assert len(groups) == 2
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_residual_from_unassigned_positions(seed):
+    # Часть позиций никто не выбрал: платежи больше стоимостей, и сумма
+    # балансов не равна нулю. Непокрытый остаток остаётся у кредиторов.
+    rng = random.Random(200 + seed)
+    balances = _zero_sum_balances(rng, rng.randint(2, 9))
+    payer = rng.choice(list(balances))
+    balances[payer] += rng.choice([150, 400, 1000])
+    residual = sum(balances.values())
+
+    transfers = st.optimal_transfers(balances)
+    assert all(debtor in balances and creditor in balances for debtor, creditor, _ in transfers)
+    assert len(transfers) <= len(st.greedy_transfers(balances))
+    left = _left(balances, transfers)
+    for uid, value in left.items():
+        assert abs(value) <= abs(balances[uid]) and value * balances[uid] >= 0
+    assert all(value >= -st.DUST_KOPECKS for value in left.values())
+    assert sum(left.values()) == residual
+
+
+def test_fallback_on_too_many_participants():
+    assert st.optimal_transfers(UNEVEN, max_participants=5) == st.greedy_transfers(UNEVEN)
+
+
+def test_fallback_on_timeout():
+    # 13 балансов без противоположных пар: перебор 2^13 подмножеств
+    # проверяет время и при нулевом бюджете сдаётся.
+    balances = {uid: -(300 + uid * 10) for uid in range(10)}
+    balances.update({10: 1000, 11: 1150, 12: 1300})
+    assert sum(balances.values()) == 0
+    assert st._zero_sum_groups(list(balances.values()), 0.0) is None
+    assert st.optimal_transfers(balances, time_budget_ms=0) == st.greedy_transfers(balances)
+
+
+def test_check_group_balances_ignores_concurrent_write(monkeypatch):
+    # Платёж из другого потока между чтением проекции и сырых строк не
+    # должен выглядеть как расхождение
+    group = "check-concurrent"
+    database.add_positions(group, [{"name": "Суп", "quantity": 1, "price": 300}])
+    database.add_payment(group, 1, 100)
+    read_snapshot = database._read_group_snapshot
+
+    def read_after_write(cur, group_id):
+        writer = threading.Thread(target=database.add_payment, args=(group, 1, 50))
+        writer.start()
+        writer.join()
+        return read_snapshot(cur, group_id)
+
+    monkeypatch.setattr(database, "_read_group_snapshot", read_after_write)
+    assert st.check_group_balances(group) == {}
+    monkeypatch.undo()
+    assert st.check_group_balances(group) == {}
+    assert st.settle_group(group).payments[1] == 15_000
@@ -0,0 +1,101 @@
+"""
+Изменения выбора, присланные из мини‑приложения через web_app_data.
+"""
+
+import asyncio
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app import database
+
+pytest.importorskip("aiogram")
+from handlers import receipts  # noqa: E402
+
+USER = 501
+# id групповых чатов в Telegram отрицательные
+_GROUP_IDS = itertools.count(-1_000_501, -1)
+
+
+class _Message:
+    def __init__(self, data: dict) -> None:
+        self.web_app_data = SimpleNamespace(data=json.dumps(data))
+        self.chat = SimpleNamespace(id=USER, type="private")
+        self.from_user = SimpleNamespace(id=USER)
+        self.answers: list[str] = []
+
+    async def answer(self, text: str, **kwargs) -> None:
+        self.answers.append(text)
+
+
+def _send(group: str, data: dict) -> list[str]:
+    msg = _Message({"group_id": group, **data})
+    asyncio.run(receipts.handle_web_app_data(msg))
+    return msg.answers
+
+
+def _claims(group: str) -> dict[int, float]:
+    _version, _positions, claims = database.load_group_claims(group)
+    return {row["position_id"]: row["quantity"] for row in claims if row["user_id"] == USER}
+
+
+@pytest.fixture
+def group() -> str:
+    """Отдельная группа с одной позицией на каждый тест."""
+    group = str(next(_GROUP_IDS))
+    database.add_positions(group, [{"name": "Суп", "quantity": 2, "price": 300}])
+    return group
+
+
+def _position_id(group: str) -> int:
+    _version, positions, _claims = database.load_group_claims(group)
+    return positions[0]["id"]
+
+
+def test_current_version_is_saved(group):
+    position_id = _position_id(group)
+    answers = _send(group, {"changes": {str(position_id): 1}, "version": database.get_group_version(group)})
+    assert answers[0].startswith("✅")
+    assert _claims(group) == {position_id: 1}
+
+
+def test_stale_version_is_rejected(group):
+    position_id = _position_id(group)
+    database.apply_selection_changes(group, USER, {position_id: 1})
+    stale = database.get_group_version(group) - 1
+    answers = _send(group, {"changes": {str(position_id): 2}, "version": stale})
+    assert "Чек изменился" in answers[0]
+    assert _claims(group) == {position_id: 1}
+
+
+def test_failure_is_not_reported_as_success(group):
+    position_id = _position_id(group)
+    database.apply_selection_changes(group, USER, {position_id: 1})
+    answers = _send(group, {"changes": {str(position_id): 2}, "version": "not-a-number"})
+    assert answers[0].startswith("❌")
+    assert _claims(group) == {position_id: 1}
+
+
+def test_write_waits_for_group_lock(group):
+    # Выбор приходит в личный чат, но ждёт блокировку чата группы
+    position_id = _position_id(group)
+
+    async def scenario() -> list[str]:
+        msg = _Message({"group_id": group, "changes": {str(position_id): 1}})
+        async with receipts.chat_locks.hold(int(group)):
+            task = asyncio.create_task(receipts.handle_web_app_data(msg))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            assert _claims(group) == {}
+        await task
+        return msg.answers
+
+    assert asyncio.run(scenario())[0].startswith("✅")
+    assert _claims(group) == {position_id: 1}
+
+
+def test_invalid_group_id_is_rejected():
+    answers = _send("not-a-chat", {"changes": {"1": 1}})
+    assert "group_id" in answers[0]
@@ -0,0 +1,76 @@
+"""
+Доступ к потоку выбора группы (/webapp/api/live) и метрикам (/metrics).
+"""
+
+import dataclasses
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import webapp  # noqa: E402
+from config import settings  # noqa: E402
+
+
+def _init_data(
+    user_id: int, start_param: str | None = None, token: str | None = None, age: int = 60
+) -> str:
+    """initData, подписанный так же, как его подписывает Telegram, ``age`` секунд назад."""
+    fields = {"auth_date": str(int(time.time()) - age), "user": json.dumps({"id": user_id, "first_name": "A"})}
+    if start_param is not None:
+        fields["start_param"] = start_param
+    check = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", (token or settings.bot_token).encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def test_group_from_signed_start_param():
+    assert webapp._can_watch_group(_init_data(7, "group_-100"), "-100")
+
+
+def test_own_private_chat():
+    assert webapp._can_watch_group(_init_data(7), "7")
+
+
+def test_other_group_is_forbidden():
+    assert not webapp._can_watch_group(_init_data(7, "group_-100"), "-200")
+    assert not webapp._can_watch_group(_init_data(7), "8")
+
+
+def test_unsigned_or_missing_init_data_is_forbidden():
+    assert not webapp._can_watch_group(None, "-100")
+    assert not webapp._can_watch_group(_init_data(7, "group_-100", token="2:other"), "-100")
+
+
+def test_stale_init_data_is_forbidden():
+    max_age = settings.init_data_max_age
+    assert webapp._can_watch_group(_init_data(7, "group_-100", age=max_age - 60), "-100")
+    assert not webapp._can_watch_group(_init_data(7, "group_-100", age=max_age + 60), "-100")
+
+
+def test_live_endpoint_requires_auth():
+    client = TestClient(webapp.app)
+    assert client.get("/webapp/api/live", params={"group_id": "-100"}).status_code == 403
+    forged = _init_data(7, "group_-100", token="2:other")
+    assert client.get("/webapp/api/live", params={"group_id": "-100", "auth": forged}).status_code == 403
+
+
+def test_metrics_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(webapp, "settings", dataclasses.replace(settings, metrics_token=""))
+    assert TestClient(webapp.app).get("/metrics").status_code == 404
+
+
+def test_metrics_require_token(monkeypatch):
+    monkeypatch.setattr(webapp, "settings", dataclasses.replace(settings, metrics_token="s3cret"))
+    client = TestClient(webapp.app)
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    response = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200 and "counters" in response.json()